@@ -0,0 +1,849 @@
+"""
+Benchmarks for molgenis-impute
+
+All benchmarks run on synthetic data that are generated in a temporary directory.
+No network access and no external tools are needed.
+
+Synthetic data (impute2 reference panels, SHAPEIT haps, VCF and PED / MAP files) depend only on 
+their size and a seed, so the results of different commits can be compared. Every benchmark runs in a 
+separate process and the increase of its peak memory is reported.
+
+Example:
+python benchmark.py --benchmark convert_impute2_reference_to_shapeit --variants 100000 --haplotypes 5008
+python benchmark.py --benchmark all --variants 100000 --samples 1000 --results results.json
+
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import gzip
+import random
+import hashlib
+import itertools
+import platform
+import resource
+import traceback
+import subprocess
+import multiprocessing
+import shutil
+import filecmp
+import tempfile
+import argparse
+
+import numpy
+
+import imputation
+
+def legacy_convert_impute2_reference_to_shapeit(
+	input_haps_filename = None,
+	input_legend_filename = None,
+	input_sample_filename = None,
+	output_haps_filename = None,
+	output_sample_filename = None,
+	chromosome = None,
+	input_gzip = True,
+):
+	'''
+	The line by line implementation of imputation.convert_impute2_reference_to_shapeit
+	Kept as a baseline for benchmarks and for checking that the outputs are identical
+	'''
+
+	if input_gzip:
+		input_haps_file = gzip.open(input_haps_filename, 'rb')
+		input_legend_file = gzip.open(input_legend_filename, 'rb')
+	else:
+		input_haps_file = open(input_haps_filename)
+		input_legend_file = open(input_legend_filename)
+
+	output_haps_file = open(output_haps_filename, 'w')
+	output_sample_file = open(output_sample_filename, 'w')
+
+	with open(input_sample_filename) as input_sample_file:
+		input_sample_file.readline()
+		input_sample = [x.replace('\n', '').split() for x in input_sample_file]
+
+	output_sample_file.write('ID_1 ID_2 missing father mother sex plink_pheno\n')
+	output_sample_file.write('0 0 0 D D D B\n')
+
+	input_legend_file.readline()
+
+	first_line = True
+	for input_haps_line in input_haps_file:
+		input_haps_s = input_haps_line.replace('\n', '').split()
+		input_legend_s = input_legend_file.readline().replace('\n', '').split()
+
+		if first_line:
+			output_sample_file.write('\n'.join([' '.join([str(i+1), str(i+1), '0', '0', '0', input_sample[i][3], '-9']) for i in range(len(input_haps_s)/2)]) + '\n')
+			first_line = False
+
+		to_print = [chromosome, input_legend_s[0], input_legend_s[1], input_legend_s[2], input_legend_s[3]]
+		to_print += input_haps_s
+		output_haps_file.write(' '.join(to_print) + '\n')
+
+	output_haps_file.close()
+	output_sample_file.close()
+	input_haps_file.close()
+	input_legend_file.close()
+
+def legacy_column_generator(filename, batch_size=10000):
+	'''
+	The multi-pass implementation of imputation.bioinformatics_file_helper.column_generator
+	The file is read once for every 'batch_size' columns. Kept as a baseline for benchmarks
+	'''
+
+	start_column = 0
+	line_counter = 0
+	while True:
+		to_return = []
+		finished = False
+
+		f = imputation.bioinformatics_file_helper.open_file_read(filename)
+		for l in f:
+			s = l.replace('\n', '').split()
+			current_line_batch = s[start_column: start_column + batch_size]
+
+			if not len(current_line_batch):
+				finished = True
+				break
+
+			to_return += [current_line_batch]
+
+		if finished:
+			break
+
+		imputation.bioinformatics_file_helper.close_file(f)
+
+		for line in imputation.numpy.transpose(to_return):
+			line_counter += 1
+			yield line_counter, list(line)
+
+		start_column += batch_size
+
+def legacy_column_writer(filename, batch_size=10000):
+	'''
+	The previous implementation of imputation.bioinformatics_file_helper.column_writer
+	The accumulated temporary file is rewritten for every 'batch_size' records. Kept as a baseline for benchmarks
+	'''
+
+	bfh = imputation.bioinformatics_file_helper
+
+	old_temp_filename = None
+	finished = False
+	while not finished:
+		current_batch = []
+		for current_record in range(batch_size):
+			data = (yield True)
+			if not data:
+				finished = True
+				break
+			current_batch += [data]
+
+		if current_batch:
+			current_batch_transposed = imputation.numpy.transpose(current_batch)
+
+			new_temp_file = tempfile.NamedTemporaryFile(delete=False)
+
+			if old_temp_filename:
+				old_temp_generator = bfh.line_generator(old_temp_filename)
+				for line in current_batch_transposed:
+					bfh.line_writer(new_temp_file, old_temp_generator.next()[1] + list(line))
+
+				for line in old_temp_generator:
+					pass
+
+				os.unlink(old_temp_filename)
+			else:
+				for line in current_batch_transposed:
+					bfh.line_writer(new_temp_file, line)
+
+			old_temp_filename = new_temp_file.name
+			new_temp_file.close()
+
+	shutil.move(old_temp_filename, filename)
+	yield False
+
+def synthetic_blocks(variants, seed=1, block_size=1000):
+	'''
+	Generates the variants of synthetic data in blocks. The data depend only on the seed
+	Generates tuples: (numpy random state, index of the first variant, positions, allele frequencies) of every block
+	'''
+
+	rand = numpy.random.RandomState(seed)
+	position = 0
+	for first_variant in range(0, variants, block_size):
+		block_variants = min(block_size, variants - first_variant)
+		positions = position + numpy.cumsum(rand.randint(1, 201, block_variants))
+		position = positions[-1]
+		yield rand, first_variant, positions, rand.random_sample(block_variants)
+
+def haplotype_lines(rand, frequencies, haplotypes, separator=' ', pair_separator=' '):
+	'''
+	Returns random haplotypes (0 or 1 with the given frequencies of allele 1) as lines of text. One line per frequency
+	Haplotypes of the same sample are separated with pair_separator. For example '0 1 1 0' or '0|1\t1|0'
+	'''
+
+	codes = (rand.random_sample((len(frequencies), haplotypes)) < frequencies[:, None]).astype(numpy.uint8)
+	text = numpy.empty((len(frequencies), haplotypes * 2), dtype=numpy.uint8)
+	text[:, 0::2] = codes + ord('0')
+	text[:, 1::4] = ord(pair_separator)
+	text[:, 3::4] = ord(separator)
+	text[:, -1] = ord('\n')
+
+	return [line + '\n' for line in text.tostring().split('\n')[:-1]]
+
+def synthetic_impute2_reference(directory, variants, haplotypes, seed=1):
+	'''
+	Creates an impute2 reference panel (chr1.haps.gz, chr1.legend.gz, panel.sample) in directory
+	Returns the filenames of the haps, legend and sample files
+	'''
+
+	haps_filename = os.path.join(directory, 'chr1.haps.gz')
+	legend_filename = os.path.join(directory, 'chr1.legend.gz')
+	sample_filename = os.path.join(directory, 'panel.sample')
+
+	with open(sample_filename, 'w') as sample_file:
+		sample_file.write('sample population group sex\n')
+		for i in range(haplotypes/2):
+			sample_file.write('SAMPLE_%i POP GROUP %i\n' % (i+1, i % 2 + 1))
+
+	haps_file = gzip.open(haps_filename, 'wb', 1)
+	legend_file = gzip.open(legend_filename, 'wb', 1)
+	legend_file.write('ID pos allele0 allele1\n')
+	for rand, first_variant, positions, frequencies in synthetic_blocks(variants, seed):
+		alleles = rand.randint(0, 2, (len(positions), 2))
+		legend_file.write(''.join(['rs%i %i %s %s\n' % (first_variant + i + 1, position, 'AC'[alleles[i, 0]], 'GT'[alleles[i, 1]]) for i, position in enumerate(positions)]))
+		haps_file.write(''.join(haplotype_lines(rand, frequencies, haplotypes)))
+	haps_file.close()
+	legend_file.close()
+
+	return haps_filename, legend_filename, sample_filename
+
+def synthetic_shapeit_haps(directory, variants, haplotypes, seed=1, gzipped=False):
+	'''
+	Creates a SHAPEIT haps file (chr1_SHAPEIT.haps) and sample file (chr1_SHAPEIT.sample) in directory. 
+	Returns the filenames of the haps and sample files
+	'''
+
+	haps_filename = os.path.join(directory, 'chr1_SHAPEIT.haps' + ('.gz' if gzipped else ''))
+	sample_filename = os.path.join(directory, 'chr1_SHAPEIT.sample')
+
+	with open(sample_filename, 'w') as sample_file:
+		sample_file.write('ID_1 ID_2 missing father mother sex plink_pheno\n')
+		sample_file.write('0 0 0 D D D B\n')
+		for i in range(haplotypes/2):
+			sample_file.write('SAMPLE_%i SAMPLE_%i 0 0 0 %i -9\n' % (i+1, i+1, i % 2 + 1))
+
+	haps_file = gzip.open(haps_filename, 'wb', 1) if gzipped else open(haps_filename, 'w')
+	for rand, first_variant, positions, frequencies in synthetic_blocks(variants, seed):
+		alleles = rand.randint(0, 2, (len(positions), 2))
+		haps_lines = haplotype_lines(rand, frequencies, haplotypes)
+		haps_file.write(''.join(['1 rs%i %i %s %s %s' % (first_variant + i + 1, position, 'AC'[alleles[i, 0]], 'GT'[alleles[i, 1]], haps_lines[i]) for i, position in enumerate(positions)]))
+	haps_file.close()
+
+	return haps_filename, sample_filename
+
+def synthetic_vcf(directory, variants, samples, seed=1, gzipped=False):
+	'''
+	Creates a phased VCF file (chr1.vcf or chr1.vcf.gz) with only GT fields in directory. Returns the filename
+	'''
+
+	vcf_filename = os.path.join(directory, 'chr1.vcf' + ('.gz' if gzipped else ''))
+	vcf_file = gzip.open(vcf_filename, 'wb', 1) if gzipped else open(vcf_filename, 'w')
+	vcf_file.write('##fileformat=VCFv4.1\n')
+	vcf_file.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+	vcf_file.write('\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO', 'FORMAT'] + ['SAMPLE_%i' % (i+1) for i in range(samples)]) + '\n')
+	for rand, first_variant, positions, frequencies in synthetic_blocks(variants, seed):
+		alleles = rand.randint(0, 2, (len(positions), 2))
+		gt_lines = haplotype_lines(rand, frequencies, samples * 2, separator='\t', pair_separator='|')
+		vcf_file.write(''.join(['1\t%i\trs%i\t%s\t%s\t100\tPASS\t.\tGT\t%s' % (position, first_variant + i + 1, 'AC'[alleles[i, 0]], 'GT'[alleles[i, 1]], gt_lines[i]) for i, position in enumerate(positions)]))
+	vcf_file.close()
+
+	return vcf_filename
+
+def synthetic_ped_map(directory, variants, samples, seed=1, missing=0.01, samples_per_block=100):
+	'''
+	Creates a study panel in PED / MAP format (chr1.ped, chr1.map) in directory. 
+	A fraction 'missing' of the genotypes is missing (0 0). Returns the filenames of the ped and map files
+	'''
+
+	ped_filename = os.path.join(directory, 'chr1.ped')
+	map_filename = os.path.join(directory, 'chr1.map')
+
+	alleles = []
+	frequencies = []
+	with open(map_filename, 'w') as map_file:
+		for rand, first_variant, positions, block_frequencies in synthetic_blocks(variants, seed):
+			map_file.write(''.join(['1 rs%i 0 %i\n' % (first_variant + i + 1, position) for i, position in enumerate(positions)]))
+			alleles += [numpy.array([ord('A'), ord('C')], dtype=numpy.uint8)[rand.randint(0, 2, len(positions))]]
+			alleles += [numpy.array([ord('G'), ord('T')], dtype=numpy.uint8)[rand.randint(0, 2, len(positions))]]
+			frequencies += [block_frequencies]
+	allele0 = numpy.concatenate(alleles[0::2])
+	allele1 = numpy.concatenate(alleles[1::2])
+	frequencies = numpy.concatenate(frequencies)
+
+	rand = numpy.random.RandomState(seed)
+	with open(ped_filename, 'w') as ped_file:
+		for first_sample in range(0, samples, samples_per_block):
+			block_samples = min(samples_per_block, samples - first_sample)
+			codes = rand.random_sample((block_samples, variants, 2)) < frequencies[None, :, None]
+			genotypes = numpy.where(codes, allele1[None, :, None], allele0[None, :, None]).astype(numpy.uint8)
+			genotypes[rand.random_sample((block_samples, variants)) < missing] = ord('0')
+
+			text = numpy.empty((block_samples, variants * 4), dtype=numpy.uint8)
+			text[:, 0::2] = genotypes.reshape(block_samples, variants * 2)
+			text[:, 1::2] = ord(' ')
+			text[:, -1] = ord('\n')
+			for i, line in enumerate(text.tostring().split('\n')[:-1]):
+				ped_file.write('FAM_%i IND_%i 0 0 %i -9 %s\n' % (first_sample + i + 1, first_sample + i + 1, (first_sample + i) % 2 + 1, line))
+
+	return ped_filename, map_filename
+
+def measured(function, *args, **kwargs):
+	'''
+	Runs function in a separate process.
+	Returns a tuple: (elapsed wall time in seconds, increase of the peak resident memory of the process in MB, return value of function)
+	The return value should be picklable
+	'''
+
+	def child(connection):
+		try:
+			start_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			start = time.time()
+			value = function(*args, **kwargs)
+			seconds = time.time() - start
+			connection.send((seconds, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_memory) / 1024.0, value, None))
+		except Exception:
+			connection.send((None, None, None, traceback.format_exc()))
+		connection.close()
+
+	parent_connection, child_connection = multiprocessing.Pipe()
+	process = multiprocessing.Process(target=child, args=(child_connection,))
+	process.start()
+	#Otherwise recv would wait forever if the process dies
+	child_connection.close()
+	try:
+		seconds, memory, value, error = parent_connection.recv()
+	except EOFError:
+		seconds, memory, value, error = None, None, None, 'Process exited with code: %s' % str(process.exitcode)
+	process.join()
+
+	if error:
+		raise Exception('Benchmark failed:\n' + error)
+
+	return seconds, memory, value
+
+#The measurements of this run. Saved with --results
+results = []
+
+def report(name, seconds, rows, size, memory=None):
+	'''
+	Prints the throughput of a benchmark in rows/sec and MB/sec (if size is not None) and the increase of the peak memory (if measured)
+	'''
+
+	megabytes_per_second = size / seconds / 1024.0 / 1024.0 if size is not None else None
+	print '%-45s %10.2f sec %12.0f rows/sec %14s %14s' % (name, seconds, rows / seconds, 
+		'%.2f MB/sec' % megabytes_per_second if size is not None else '', '%.1f MB peak' % memory if memory is not None else '')
+	results.append({
+		'name' : name,
+		'seconds' : seconds,
+		'rows' : rows,
+		'bytes' : size,
+		'rows_per_second' : rows / seconds,
+		'megabytes_per_second' : megabytes_per_second,
+		'peak_memory_increase_mb' : memory,
+	})
+
+def git_commit():
+	'''
+	Returns a tuple: (commit of the git repository of this file, True if there are uncommitted changes)
+	Returns (None, None) if git is not available
+	'''
+
+	directory = os.path.dirname(os.path.abspath(__file__))
+	try:
+		with open(os.devnull, 'w') as devnull:
+			commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=directory, stderr=devnull).strip()
+			dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=directory, stderr=devnull).strip())
+	except (OSError, subprocess.CalledProcessError):
+		return None, None
+
+	return commit, dirty
+
+def benchmark_convert_impute2_reference_to_shapeit(args, directory):
+	'''
+	Compares the block engine of convert_impute2_reference_to_shapeit with the line by line implementation
+	MB/sec is measured on the size of the output (uncompressed) SHAPEIT haps file
+	'''
+
+	haps_filename, legend_filename, sample_filename = synthetic_impute2_reference(directory, args.variants, args.haplotypes)
+
+	outputs = {}
+	for name, function, kwargs in [
+		('line by line', legacy_convert_impute2_reference_to_shapeit, {}),
+		('block engine (block_size=%i)' % args.block_size, imputation.convert_impute2_reference_to_shapeit, {'block_size' : args.block_size}),
+	]:
+		output_haps_filename = os.path.join(directory, 'chr1_%i_SHAPEIT.haps' % len(outputs))
+		output_sample_filename = os.path.join(directory, 'chr1_%i_SHAPEIT.sample' % len(outputs))
+		seconds, memory, value = measured(function,
+			input_haps_filename = haps_filename,
+			input_legend_filename = legend_filename,
+			input_sample_filename = sample_filename,
+			output_haps_filename = output_haps_filename,
+			output_sample_filename = output_sample_filename,
+			chromosome = '1',
+			**kwargs
+		)
+		outputs[name] = (seconds, memory, output_haps_filename, output_sample_filename)
+
+	print
+	for name, (seconds, memory, output_haps_filename, output_sample_filename) in sorted(outputs.iteritems()):
+		report(name, seconds, args.variants, os.path.getsize(output_haps_filename), memory)
+
+	first, second = outputs.values()
+	if filecmp.cmp(first[2], second[2], shallow=False) and filecmp.cmp(first[3], second[3], shallow=False):
+		print 'Outputs are identical'
+	else:
+		print 'ERROR: Outputs differ'
+		return 1
+
+	return 0
+
+def gzip_reference_window(haps_filename, legend_filename, from_pos, to_pos):
+	'''
+	Reads the variants of a genomic window from gzipped haps and legend files
+	This is what all methods have to do without a binary reference
+	'''
+
+	legend = []
+	haplotypes = []
+	haps_file = gzip.open(haps_filename, 'rb')
+	legend_file = gzip.open(legend_filename, 'rb')
+	legend_file.readline()
+	for legend_line in legend_file:
+		haps_line = haps_file.readline()
+		legend_s = legend_line.split()
+		position = int(legend_s[1])
+		if position > to_pos:
+			break
+		if position >= from_pos:
+			legend += [legend_s]
+			haplotypes += [haps_line.split()]
+	haps_file.close()
+	legend_file.close()
+
+	return legend, haplotypes
+
+def benchmark_binary_reference(args, directory):
+	'''
+	Compares reading genomic windows from the gzipped haps and legend files with reading from the binary reference
+	The windows are evenly spaced along the chromosome
+	'''
+
+	haps_filename, legend_filename, sample_filename = synthetic_impute2_reference(directory, args.variants, args.haplotypes)
+
+	seconds, memory, value = measured(imputation.build_binary_reference, haps_filename, legend_filename)
+	report('build binary reference', seconds, args.variants, os.path.getsize(haps_filename), memory)
+
+	binary_reference = imputation.Binary_reference(haps_filename)
+	last_position = binary_reference.legend['pos'][-1]
+	windows = [(from_pos, from_pos + args.window_size - 1) for from_pos in range(1, last_position, max(1, last_position / args.windows))]
+
+	for name, function in [
+		('gzip window', lambda from_pos, to_pos : gzip_reference_window(haps_filename, legend_filename, from_pos, to_pos)),
+		('binary reference window', binary_reference.window),
+	]:
+		seconds, memory, rows = measured(lambda : sum([len(function(from_pos, to_pos)[0]) for from_pos, to_pos in windows]))
+		report('%s (%i windows)' % (name, len(windows)), seconds, rows, None, memory)
+
+	return 0
+
+def benchmark_column_generator(args, directory):
+	'''
+	Compares the single pass column_generator with the multi-pass implementation on a wide SHAPEIT haps file
+	Both read batches of args.block_size columns
+	'''
+
+	haps_filename, sample_filename = synthetic_shapeit_haps(directory, args.variants, args.haplotypes, gzipped=args.gzip)
+	columns = args.haplotypes + 5
+
+	def read_columns(function):
+		checksum = hashlib.md5()
+		for column_counter, column in function(haps_filename, batch_size=args.block_size):
+			checksum.update(' '.join(column))
+		return checksum.hexdigest()
+
+	checksums = []
+	for name, function in [
+		('multi-pass column_generator', legacy_column_generator),
+		('single pass column_generator', imputation.bioinformatics_file_helper.column_generator),
+	]:
+		seconds, memory, checksum = measured(read_columns, function)
+		report(name, seconds, columns, os.path.getsize(haps_filename), memory)
+		checksums += [checksum]
+
+	if len(set(checksums)) == 1:
+		print 'Outputs are identical'
+	else:
+		print 'ERROR: Outputs differ'
+		return 1
+
+	return 0
+
+def write_columns(writer, filename, records, record_length, batch_size, seed=1):
+	'''
+	Sends 'records' random records of 'record_length' values to a column writer generator
+	'''
+
+	rand = random.Random(seed)
+	#Generating random values is slower than writing them. Use a small set of records repeatedly
+	random_records = [[str(rand.randint(0, 2)) for x in range(record_length)] for record in range(100)]
+	g = writer(filename, batch_size=batch_size, **({'silent' : True} if writer is not legacy_column_writer else {}))
+	g.next()
+	for record in range(records):
+		g.send(random_records[record % 100])
+	g.send(None)
+
+def benchmark_column_writer(args, directory):
+	'''
+	Compares the time and the memory of column_writer with the previous implementation.
+	args.variants records of args.haplotypes values are written in batches of args.block_size records.
+	For a 100k x 10k matrix use: --variants 100000 --haplotypes 10000
+	'''
+
+	outputs = []
+	for name, writer in [
+		('column_writer (rewrites temporary file)', legacy_column_writer),
+		('column_writer (single merge)', imputation.bioinformatics_file_helper.column_writer),
+	]:
+		output_filename = os.path.join(directory, 'columns_%i.txt' % len(outputs))
+		seconds, memory, value = measured(write_columns, writer, output_filename, args.variants, args.haplotypes, args.block_size)
+		report(name, seconds, args.variants, os.path.getsize(output_filename), memory)
+		outputs += [output_filename]
+
+	if filecmp.cmp(outputs[0], outputs[1], shallow=False):
+		print 'Outputs are identical'
+	else:
+		print 'ERROR: Outputs differ'
+		return 1
+
+	return 0
+
+def gzip_file_lines(filename):
+	'''
+	Returns the lines of a gzipped file
+	'''
+
+	with gzip.open(filename) as f:
+		return f.readlines()
+
+def benchmark_convert_shapeit_reference_to_impute2(args, directory):
+	'''
+	Measures convert_shapeit_reference_to_impute2 on a SHAPEIT haps file.
+	The input is created from an impute2 reference panel with convert_impute2_reference_to_shapeit,
+	so the output should be the same as this reference panel.
+	MB/sec is measured on the size of the input SHAPEIT haps file
+	'''
+
+	haps_filename, legend_filename, sample_filename = synthetic_impute2_reference(directory, args.variants, args.haplotypes)
+	shapeit_haps_filename = os.path.join(directory, 'chr1_SHAPEIT.haps')
+	shapeit_sample_filename = os.path.join(directory, 'chr1_SHAPEIT.sample')
+	imputation.convert_impute2_reference_to_shapeit(
+		input_haps_filename = haps_filename,
+		input_legend_filename = legend_filename,
+		input_sample_filename = sample_filename,
+		output_haps_filename = shapeit_haps_filename,
+		output_sample_filename = shapeit_sample_filename,
+		chromosome = '1',
+	)
+
+	output_haps_filename = os.path.join(directory, 'output.haps.gz')
+	output_legend_filename = os.path.join(directory, 'output.legend.gz')
+	seconds, memory, value = measured(imputation.convert_shapeit_reference_to_impute2,
+		input_haps_filename = shapeit_haps_filename,
+		input_sample_filename = shapeit_sample_filename,
+		output_haps_filename = output_haps_filename,
+		output_legend_filename = output_legend_filename,
+		output_sample_filename = os.path.join(directory, 'output.sample'),
+		chromosome = '1',
+	)
+	report('convert_shapeit_reference_to_impute2', seconds, args.variants, os.path.getsize(shapeit_haps_filename), memory)
+
+	if gzip_file_lines(output_haps_filename) == gzip_file_lines(haps_filename) and gzip_file_lines(output_legend_filename) == gzip_file_lines(legend_filename):
+		print 'Outputs are identical'
+	else:
+		print 'ERROR: Outputs differ'
+		return 1
+
+	return 0
+
+def benchmark_convert_vcf_to_impute2(args, directory):
+	'''
+	Measures convert_vcf_to_impute2 on a phased VCF file (synthetic, or --vcf). 
+	MB/sec is measured on the size of the (uncompressed or gzipped) VCF file
+	With --vcftools the outputs are compared line by line with the outputs of vcftools --IMPUTE
+	'''
+
+	vcf_filename = args.vcf if args.vcf else synthetic_vcf(directory, args.variants, args.haplotypes / 2, gzipped=args.gzip)
+	output_haps_filename = os.path.join(directory, 'chr1.haps.gz')
+	output_legend_filename = os.path.join(directory, 'chr1.legend.gz')
+
+	seconds, memory, value = measured(imputation.convert_vcf_to_impute2,
+		input_vcf_filename = vcf_filename,
+		output_haps_filename = output_haps_filename,
+		output_legend_filename = output_legend_filename,
+		block_size = args.block_size,
+	)
+	converted = imputation.bioinformatics_file_helper.line_counter(output_haps_filename)
+	report('convert_vcf_to_impute2', seconds, converted, os.path.getsize(vcf_filename), memory)
+
+	if not args.vcf:
+		if converted == args.variants:
+			print 'All variants converted'
+		else:
+			print 'ERROR: Output has a different number of variants'
+			return 1
+
+	if not args.vcftools:
+		print 'Outputs are not compared with vcftools (see: --vcftools)'
+		return 0
+
+	vcftools_prefix = os.path.join(directory, 'vcftools')
+	start = time.time()
+	subprocess.check_call([args.vcftools, '--gzvcf' if vcf_filename.endswith('.gz') else '--vcf', vcf_filename, '--IMPUTE', '--out', vcftools_prefix])
+	report('vcftools --IMPUTE', time.time() - start, converted, os.path.getsize(vcf_filename))
+
+	for output_filename, vcftools_filename in [(output_haps_filename, vcftools_prefix + '.impute.hap'), (output_legend_filename, vcftools_prefix + '.impute.legend')]:
+		output_file = imputation.bioinformatics_file_helper.open_file_read(output_filename)
+		with open(vcftools_filename) as vcftools_file:
+			for index, (line, vcftools_line) in enumerate(itertools.izip_longest(output_file, vcftools_file)):
+				if line is None or vcftools_line is None or line.split() != vcftools_line.split():
+					print 'ERROR: Line %i of %s is different from vcftools:\n%s\n%s' % (index + 1, os.path.basename(output_filename), (line or '').rstrip(), (vcftools_line or '').rstrip())
+					imputation.bioinformatics_file_helper.close_file(output_file)
+					return 1
+		imputation.bioinformatics_file_helper.close_file(output_file)
+
+	print 'Outputs are identical to vcftools'
+	return 0
+
+def python_line_counter(filename):
+	'''
+	Counts lines by iterating over the file. Baseline for line_counter
+	'''
+
+	f = imputation.bioinformatics_file_helper.open_file_read(filename)
+	count = sum(1 for line in f)
+	imputation.bioinformatics_file_helper.close_file(f)
+	return count
+
+def benchmark_line_counter(args, directory):
+	'''
+	Compares line_counter (with and without the .count cache) with iterating over the lines of a file.
+	The files are a PED file (few long lines) and a SHAPEIT haps file (many lines)
+	'''
+
+	ped_filename, map_filename = synthetic_ped_map(directory, args.variants, args.haplotypes / 2)
+	haps_filename, sample_filename = synthetic_shapeit_haps(directory, args.variants, args.haplotypes, gzipped=args.gzip)
+
+	line_counter = imputation.bioinformatics_file_helper.line_counter
+	counts = []
+	for filename in [ped_filename, haps_filename]:
+		file_counts = []
+		for name, function in [
+			('python line loop', python_line_counter),
+			('line_counter', line_counter),
+			('line_counter (cached)', lambda filename : line_counter(filename, cache=True)),
+		]:
+			if name == 'line_counter (cached)':
+				#Create the cache
+				line_counter(filename, cache=True)
+			seconds, memory, count = measured(function, filename)
+			report('%s %s' % (name, os.path.basename(filename)), seconds, count, os.path.getsize(filename), memory)
+			file_counts += [count]
+		counts += [file_counts]
+
+	if counts[0] == [args.haplotypes / 2] * 3 and counts[1] == [args.variants] * 3:
+		print 'Counts are correct'
+	else:
+		print 'ERROR: Counts differ'
+		return 1
+
+	return 0
+
+def ped_genotypes(ped_filename):
+	'''
+	Returns the genotypes of a PED file per SNP: a list with a list of (allele, allele) tuples for every SNP
+	'''
+
+	with open(ped_filename) as ped_file:
+		samples = [line.split()[6:] for line in ped_file]
+
+	return [[(sample[snp * 2], sample[snp * 2 + 1]) for sample in samples] for snp in range(len(samples[0]) / 2)]
+
+def ped_genotype_matrix(ped_filename):
+	'''
+	Returns the genotypes of a PED file with single character alleles as a (SNPs x 2*samples) uint8 array of allele codes
+	'''
+
+	with open(ped_filename) as ped_file:
+		samples = numpy.array([numpy.frombuffer(line.split(None, 6)[6], dtype=numpy.uint8)[0::2] for line in ped_file])
+
+	return numpy.ascontiguousarray(samples.reshape(len(samples), -1, 2).transpose(1, 0, 2).reshape(-1, len(samples) * 2))
+
+def benchmark_get_alleles(args, directory):
+	'''
+	Compares get_alleles_batch on the genotype matrix of a PED file with get_alleles on every SNP
+	'''
+
+	ped_filename, map_filename = synthetic_ped_map(directory, args.variants, args.haplotypes / 2)
+	genotypes = ped_genotypes(ped_filename)
+	genotype_matrix = ped_genotype_matrix(ped_filename)
+
+	outputs = []
+	for name, function in [
+		('get_alleles', lambda : [imputation.bioinformatics_file_helper.get_alleles(snp_genotypes)[:2] for snp_genotypes in genotypes]),
+		('get_alleles_batch', lambda : imputation.bioinformatics_file_helper.get_alleles_batch(genotype_matrix)),
+	]:
+		seconds, memory, alleles = measured(function)
+		report(name, seconds, args.variants, os.path.getsize(ped_filename), memory)
+		outputs += [alleles]
+
+	#Alleles with the same count can be in a different order. Compare the counts of the alleles
+	major, minor, major_count, minor_count = outputs[1]
+	for snp, snp_genotypes in enumerate(genotypes):
+		flat_genotypes = [genotype for genotype_pair in snp_genotypes for genotype in genotype_pair]
+		counts = [flat_genotypes.count(allele) if allele != '0' else 0 for allele in outputs[0][snp]]
+		if counts != [major_count[snp], minor_count[snp]]:
+			print 'ERROR: Alleles differ in SNP %i: %s %s' % (snp + 1, outputs[0][snp], (chr(major[snp]), chr(minor[snp])))
+			return 1
+
+	print 'Outputs are identical'
+	return 0
+
+def benchmark_convert_ped_to_bed(args, directory):
+	'''
+	Compares reading a PED file as text genotypes (ped_genotypes) with reading it as a packed genotype matrix (Packed_genotypes)
+	and checks the PLINK binary files that are written from the packed matrix
+	'''
+
+	ped_filename, map_filename = synthetic_ped_map(directory, args.variants, args.haplotypes / 2)
+	bed_filename = os.path.join(directory, 'chr1.bed')
+
+	seconds, memory, genotypes = measured(ped_genotypes, ped_filename)
+	report('PED as text genotypes', seconds, args.variants, os.path.getsize(ped_filename), memory)
+
+	seconds, memory, ret = measured(lambda : imputation.Packed_genotypes.read_ped(ped_filename, map_filename).packed.shape)
+	report('PED as packed genotypes', seconds, args.variants, os.path.getsize(ped_filename), memory)
+
+	seconds, memory, ret = measured(imputation.convert_ped_to_bed, ped_filename, map_filename, bed_filename)
+	report('convert_ped_to_bed', seconds, args.variants, os.path.getsize(ped_filename), memory)
+
+	packed = imputation.Packed_genotypes.read_bed(bed_filename)
+	for snp, (snp_genotypes, snp_packed) in enumerate(zip(genotypes, packed.genotypes())):
+		copies = [-1 if '0' in genotype else genotype.count(packed.allele1[snp]) for genotype in snp_genotypes]
+		if copies != list(snp_packed):
+			print 'ERROR: Genotypes differ in SNP %i' % (snp + 1)
+			return 1
+
+	print 'Outputs are identical'
+	return 0
+
+def benchmark_add_custom_reference_panels(args, directory):
+	'''
+	Measures the scan of the reference panels directory when an Imputation object is created. 
+	The directory has an impute2 panel (converted to SHAPEIT) and a SHAPEIT panel (converted to impute2). 
+	The first scan converts both panels. The second scan reads the panels from the manifest.
+	'''
+
+	reference_dir = os.path.join(directory, 'reference')
+	for panel in ['impute2_panel', 'shapeit_panel']:
+		os.makedirs(os.path.join(reference_dir, panel))
+	synthetic_impute2_reference(os.path.join(reference_dir, 'impute2_panel'), args.variants, args.haplotypes)
+	synthetic_shapeit_haps(os.path.join(reference_dir, 'shapeit_panel'), args.variants, args.haplotypes)
+
+	def scan():
+		imp = imputation.Imputation(installation_dir=os.path.join(directory, 'installation'), reference_dir=reference_dir)
+		return sorted([panel for panel in imp.reference_panels if panel.endswith('_panel')])
+
+	panels = []
+	for name in ['first scan (conversions)', 'second scan (manifest)']:
+		seconds, memory, value = measured(scan)
+		report('add_custom_reference_panels %s' % name, seconds, args.variants * 2, sum([os.path.getsize(x) for x in glob.glob(os.path.join(reference_dir, '*', '*'))]), memory)
+		panels += [value]
+
+	if panels == [['impute2_panel', 'shapeit_panel']] * 2:
+		print 'Both panels added'
+	else:
+		print 'ERROR: Panels found:', panels
+		return 1
+
+	return 0
+
+benchmarks = {
+	'convert_impute2_reference_to_shapeit' : benchmark_convert_impute2_reference_to_shapeit,
+	'binary_reference' : benchmark_binary_reference,
+	'column_generator' : benchmark_column_generator,
+	'column_writer' : benchmark_column_writer,
+	'convert_shapeit_reference_to_impute2' : benchmark_convert_shapeit_reference_to_impute2,
+	'convert_vcf_to_impute2' : benchmark_convert_vcf_to_impute2,
+	'line_counter' : benchmark_line_counter,
+	'get_alleles' : benchmark_get_alleles,
+	'add_custom_reference_panels' : benchmark_add_custom_reference_panels,
+	'convert_ped_to_bed' : benchmark_convert_ped_to_bed,
+}
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='molgenis-impute benchmarks')
+	parser.add_argument('--benchmark', help='Benchmark to run. all: run all benchmarks', choices=sorted(benchmarks) + ['all'], required=True)
+	parser.add_argument('--variants', help='Number of variants in synthetic data. Default: 10000', default=10000, type=int)
+	parser.add_argument('--haplotypes', help='Number of haplotypes in synthetic data. Default: 1000', default=1000, type=int)
+	parser.add_argument('--samples', help='Number of samples in synthetic data. Same as --haplotypes 2*SAMPLES', type=int)
+	parser.add_argument('--block_size', help='Number of variants (or columns) per block. Default: 1000', default=1000, type=int)
+	parser.add_argument('--window_size', help='Length of genomic windows. Default: 500000', default=500000, type=int)
+	parser.add_argument('--windows', help='Number of genomic windows to read. Default: 10', default=10, type=int)
+	parser.add_argument('--vcf', help='convert_vcf_to_impute2: convert this VCF file instead of synthetic data (for example a chromosome of the test reference panel)')
+	parser.add_argument('--vcftools', help='convert_vcf_to_impute2: the vcftools executable. The outputs are compared with the outputs of vcftools --IMPUTE')
+	parser.add_argument('--gzip', help='Compress the synthetic input files with gzip', action='store_true')
+	parser.add_argument('--keep', help='Do not delete the temporary directory with the synthetic data', action='store_true')
+	parser.add_argument('--results', help='Save the results in this file (JSON). The file also has the git commit and the parameters of the run, for comparisons between commits')
+
+	args = parser.parse_args()
+	if args.samples:
+		args.haplotypes = args.samples * 2
+
+	directory = tempfile.mkdtemp(prefix='molgenis_benchmark_')
+	print 'Temporary directory:', directory
+	ret = 0
+	runs = []
+	try:
+		for benchmark in sorted(benchmarks) if args.benchmark == 'all' else [args.benchmark]:
+			print 'Benchmark:', benchmark
+			benchmark_directory = os.path.join(directory, benchmark)
+			os.mkdir(benchmark_directory)
+			first_result = len(results)
+			benchmark_ret = benchmarks[benchmark](args, benchmark_directory)
+			runs += [{'benchmark' : benchmark, 'passed' : benchmark_ret == 0, 'results' : results[first_result:]}]
+			ret = ret or benchmark_ret
+	finally:
+		if not args.keep:
+			shutil.rmtree(directory)
+
+	if args.results:
+		commit, dirty = git_commit()
+		with open(args.results, 'w') as results_file:
+			json.dump({
+				'commit' : commit,
+				'uncommitted_changes' : dirty,
+				'date' : time.strftime('%Y-%m-%d %H:%M:%S'),
+				'hostname' : platform.node(),
+				'python' : platform.python_version(),
+				'cpus' : multiprocessing.cpu_count(),
+				'parameters' : vars(args),
+				'benchmarks' : runs,
+			}, results_file, indent=1, sort_keys=True)
+		print 'Results saved in:', args.results
+
+	sys.exit(ret)
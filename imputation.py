@@ -32,7 +32,10 @@ def Length_of_chromosomes_build_37():
 	}
 
 
+import io
 import gzip
+import itertools
+
 def convert_impute2_reference_to_shapeit(
 	input_haps_filename = None,
 	input_legend_filename = None,
@@ -41,7 +44,16 @@ def convert_impute2_reference_to_shapeit(
 	output_sample_filename = None,
 	chromosome = None,
 	input_gzip = True,
+	block_size = 1000,
 ):
+	'''
+	Converts an impute2 reference panel (haps, legend, sample) to the SHAPEIT phased format.
+
+	The haps file is read in blocks of 'block_size' variants. Each block is parsed into a
+	uint8 array of allele codes (see: impute2_haps_block_encoder) and written with one
+	bulk write. Blocks that are not in the canonical layout of impute2 haps files are
+	converted line by line. In both cases the output is the same.
+	'''
 
 	if not input_haps_filename or not input_legend_filename or not input_sample_filename or not output_haps_filename or not output_sample_filename:
 		print 'Missing parameters'
@@ -56,8 +68,9 @@ def convert_impute2_reference_to_shapeit(
 	print '    ' + output_sample_filename
 
 	if input_gzip:
-		input_haps_file = gzip.open(input_haps_filename, 'rb')
-		input_legend_file = gzip.open(input_legend_filename, 'rb')
+		#BufferedReader makes line iteration over gzip files considerably faster
+		input_haps_file = Compressed_io.open_read(input_haps_filename)
+		input_legend_file = Compressed_io.open_read(input_legend_filename)
 	else:
 		input_haps_file = open(input_haps_filename)
 		input_legend_file = open(input_legend_filename)
@@ -81,27 +94,30 @@ def convert_impute2_reference_to_shapeit(
 
 	first_line = True
 	line_counter = 0
-	for input_haps_line in input_haps_file:
+	while True:
+		input_haps_lines = list(itertools.islice(input_haps_file, block_size))
+		if not input_haps_lines:
+			break
 
-		input_haps_s = input_haps_line.replace('\n', '').split()
-		input_legend_line = input_legend_file.readline()
-		input_legend_s = input_legend_line.replace('\n', '').split()
+		input_legend_s = [input_legend_file.readline().replace('\n', '').split() for x in input_haps_lines]
+		prefixes = [' '.join([chromosome, x[0], x[1], x[2], x[3]]) for x in input_legend_s]
 
-		line_counter += 1
-		if line_counter % 10000 == 0:
-			print 'Lines:', line_counter
+		for counter in range(line_counter - line_counter % 10000 + 10000, line_counter + len(input_haps_lines) + 1, 10000):
+			print 'Lines:', counter
+		line_counter += len(input_haps_lines)
+
+		haps_codes = impute2_haps_block_encoder(input_haps_lines)
 
 		if first_line:
-			output_sample_file.write('\n'.join([' '.join([str(i+1), str(i+1), '0', '0', '0', input_sample[i][3], '-9']) for i in range(len(input_haps_s)/2)]) + '\n')
+			haplotypes = haps_codes.shape[1] if haps_codes is not None else len(input_haps_lines[0].replace('\n', '').split())
+			output_sample_file.write('\n'.join([' '.join([str(i+1), str(i+1), '0', '0', '0', input_sample[i][3], '-9']) for i in range(haplotypes/2)]) + '\n')
 			first_line = False
 
-		
-		to_print = [chromosome, input_legend_s[0], input_legend_s[1], input_legend_s[2], input_legend_s[3]]
-
-		to_print += input_haps_s
-
-		output_haps_file.write(' '.join(to_print) + '\n')
-
+		if haps_codes is not None:
+			output_haps_file.write(impute2_haps_block_decoder(haps_codes, prefixes))
+		else:
+			#Not canonical. Convert line by line
+			output_haps_file.write(''.join([' '.join([prefix] + input_haps_line.replace('\n', '').split()) + '\n' for prefix, input_haps_line in zip(prefixes, input_haps_lines)]))
 
 	output_haps_file.close()
 	output_sample_file.close()
@@ -111,6 +127,56 @@ def convert_impute2_reference_to_shapeit(
 	print 'Output file 1:', output_haps_filename
 	print 'Output file 2:', output_sample_filename
 
+def impute2_haps_block_encoder(haps_lines):
+	'''
+	haps_lines: a list of lines from an impute2 haps file. i.e: ['0 1 1 0\n', '1 1 0 0\n']
+	returns: a (variants x haplotypes) uint8 numpy array with the allele code of each haplotype.
+
+	This works only for the canonical layout of haps files: every allele is a single
+	character and alleles are separated by a single space. Every line should have the same
+	length and end with a newline. If this does not hold then None is returned and the
+	lines should be parsed one by one.
+	'''
+
+	width = len(haps_lines[0])
+	if width < 2 or width % 2:
+		return None
+
+	if any(len(x) != width for x in haps_lines):
+		return None
+
+	block = numpy.frombuffer(''.join(haps_lines), dtype=numpy.uint8).reshape(len(haps_lines), width)
+
+	#Separators should be single spaces and the last character a newline
+	if not (block[:, 1:-1:2] == ord(' ')).all() or not (block[:, -1] == ord('\n')).all():
+		return None
+
+	codes = block[:, 0::2]
+
+	#Alleles should not be whitespace
+	if numpy.in1d(codes, numpy.array([ord(x) for x in ' \t\n\r\x0b\x0c'], dtype=numpy.uint8)).any():
+		return None
+
+	return numpy.ascontiguousarray(codes)
+
+def impute2_haps_block_decoder(haps_codes, prefixes):
+	'''
+	haps_codes: a (variants x haplotypes) uint8 array as returned from impute2_haps_block_encoder
+	prefixes: a list of strings. One for every variant
+
+	returns: a string with one line per variant: the prefix followed by the alleles. Separated by spaces
+	'''
+
+	variants, haplotypes = haps_codes.shape
+	width = 2 * haplotypes
+	block = numpy.empty((variants, width), dtype=numpy.uint8)
+	block[:, 0::2] = haps_codes
+	block[:, 1::2] = ord(' ')
+	block[:, -1] = ord('\n')
+	block = block.tostring()
+
+	return ''.join([prefix + ' ' + block[i*width:(i+1)*width] for i, prefix in enumerate(prefixes)])
+
 import gzip
 
 def convert_shapeit_reference_to_impute2(
@@ -135,8 +201,8 @@ def convert_shapeit_reference_to_impute2(
 	print 'Format: impute2'
 
 	if output_gzip:
-		output_haps_file = gzip.open(output_haps_filename, 'w')
-		output_legend_file = gzip.open(output_legend_filename, 'w')
+		output_haps_file = Compressed_io.open_write(output_haps_filename)
+		output_legend_file = Compressed_io.open_write(output_legend_filename)
 	else:
 		output_haps_file = open(output_haps_filename, 'w')
 		output_legend_file = open(output_legend_filename, 'w')
@@ -191,8 +257,654 @@ def convert_shapeit_reference_to_impute2(
 
 
 
+import gzip
+import zlib
+import struct
+import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+def bgzf_compressed_blocks(input_file):
+	'''
+	Generates the compressed BGZF blocks of an open file (http://samtools.github.io/hts-specs/SAMv1.pdf , section 4.1)
+	Every block is a complete gzip member. Raises an Exception if the file is not in BGZF format
+	'''
+
+	while True:
+		header = input_file.read(12)
+		if not header:
+			break
+		if len(header) < 12 or header[:4] != '\x1f\x8b\x08\x04':
+			raise Exception('Not a BGZF file')
+
+		xlen = struct.unpack('<H', header[10:12])[0]
+		extra = input_file.read(xlen)
+
+		#Find the BC subfield that has the size of the block
+		block_size = None
+		index = 0
+		while index + 4 <= len(extra):
+			subfield_length = struct.unpack('<H', extra[index+2:index+4])[0]
+			if extra[index:index+2] == 'BC':
+				block_size = struct.unpack('<H', extra[index+4:index+6])[0] + 1
+			index += 4 + subfield_length
+
+		if not block_size:
+			raise Exception('Not a BGZF file')
+
+		yield header + extra + input_file.read(block_size - 12 - xlen)
+
+def bgzf_decompress_blocks(blocks):
+	'''
+	Decompresses a list of BGZF blocks. Returns a string
+	'''
+
+	ret = []
+	for block in blocks:
+		xlen = struct.unpack('<H', block[10:12])[0]
+		ret += [zlib.decompress(block[12 + xlen:-8], -15)]
+
+	return ''.join(ret)
+
+def is_bgzf(filename):
+	'''
+	Checks the first bytes of a file for the BGZF header
+	'''
+
+	with open(filename, 'rb') as f:
+		header = f.read(16)
+
+	return len(header) == 16 and header[:4] == '\x1f\x8b\x08\x04' and header[12:14] == 'BC'
+
+def compressed_chunk_reader(filename, threads=1, blocks_per_chunk=64):
+	'''
+	Generates the decompressed content of filename in chunks (strings)
+	BGZF files are decompressed in parallel with 'threads' threads. Every thread decompresses 'blocks_per_chunk' blocks (~64KB each).
+	Other gzip files are decompressed serially. Uncompressed files are read as they are.
+	'''
+
+	chunk_size = blocks_per_chunk * 65536
+
+	if not is_bgzf(filename):
+		with open(filename, 'rb') as f:
+			gzipped = f.read(2) == '\x1f\x8b'
+		input_file = gzip.open(filename, 'rb') if gzipped else open(filename, 'rb')
+		try:
+			while True:
+				chunk = input_file.read(chunk_size)
+				if not chunk:
+					break
+				yield chunk
+		finally:
+			input_file.close()
+		return
+
+	pool = ThreadPool(threads) if threads > 1 else None
+	try:
+		with open(filename, 'rb') as input_file:
+			blocks = bgzf_compressed_blocks(input_file)
+			while True:
+				#Keep at most 2 chunks per thread in memory
+				chunks = [list(itertools.islice(blocks, blocks_per_chunk)) for x in range(2 * threads)]
+				chunks = [chunk for chunk in chunks if chunk]
+				if not chunks:
+					break
+				for chunk in (pool.map(bgzf_decompress_blocks, chunks) if pool else itertools.imap(bgzf_decompress_blocks, chunks)):
+					yield chunk
+	finally:
+		if pool:
+			pool.close()
+			pool.join()
+
+def chunk_line_splitter(chunks):
+	'''
+	Generates the lines (without newline) from a generator of strings
+	'''
+
+	remainder = ''
+	for chunk in chunks:
+		lines = (remainder + chunk).split('\n')
+		remainder = lines.pop()
+		for line in lines:
+			yield line
+
+	if remainder:
+		yield remainder
+
+def vcf_gt_block_encoder(samples_lines, n_samples):
+	'''
+	samples_lines: the sample columns (as one string) of VCF lines with FORMAT GT
+	Returns a block of haps lines (one string) or None if the lines do not all have the canonical layout:
+	  <allele>|<allele>[TAB]... with alleles 0, 1 or . (missing)
+
+	The genotypes are parsed as one uint8 array of shape (lines, 4*n_samples). 
+	Columns 4*i and 4*i+2 are the alleles of sample i, 4*i+1 is the phase separator.
+	'''
+
+	width = 4 * n_samples
+	data = '\t'.join(samples_lines) + '\t'
+	if len(data) != width * len(samples_lines):
+		return None
+
+	codes = numpy.frombuffer(data, dtype=numpy.uint8).reshape(len(samples_lines), width)
+	if not numpy.all(codes[:, 1::4] == ord('|')) or not numpy.all(codes[:, 3::4] == ord('\t')):
+		return None
+
+	alleles = codes[:, 0::2]
+	if not numpy.all((alleles == ord('0')) | (alleles == ord('1')) | (alleles == ord('.'))):
+		return None
+
+	haps = codes.copy()
+	haps[haps == ord('.')] = ord('-')
+	haps[:, 1::2] = ord(' ')
+	haps[:, -1] = ord('\n')
+
+	return haps.tostring()
+
+def vcf_gt_line_encoder(samples, gt_index):
+	'''
+	samples: the sample columns of a VCF line
+	Returns a haps line or None if any genotype is not phased and diploid
+	'''
+
+	ret = []
+	for sample in samples:
+		gt = sample.split(':')[gt_index].split('|')
+		if len(gt) != 2 or '/' in gt[0] or '/' in gt[1]:
+			return None
+		ret += [x if x != '.' else '-' for x in gt]
+
+	return ' '.join(ret) + '\n'
+
+def convert_vcf_to_impute2(
+	input_vcf_filename = None,
+	output_haps_filename = None,
+	output_legend_filename = None,
+	threads = None,
+	block_size = 1000,
+):
+	'''
+	Converts a (bgzipped) VCF file to the haps and legend files of impute2.
+	This is the conversion of vcftools --IMPUTE :
+	  * Only sites with at most two alleles are converted
+	  * Only sites where all genotypes are phased and diploid are converted
+	  * Missing alleles are saved as -
+	  * Missing IDs (.) are saved as <CHROM>-<POS>
+
+	BGZF blocks are decompressed in parallel with 'threads' threads (Default: number of CPUs).
+	Lines are processed in blocks of 'block_size'. Blocks where all genotypes are GT-only and 
+	in the canonical layout are parsed with numpy (see: vcf_gt_block_encoder). Other lines are parsed one by one.
+	'''
+
+	if not input_vcf_filename or not output_haps_filename or not output_legend_filename:
+		print 'Missing parameters'
+		return
+
+	print 'Converting:'
+	print '   ' + input_vcf_filename
+	print 'From VCF to:'
+	print '   ' + output_haps_filename
+	print '   ' + output_legend_filename
+	print 'Format: impute2'
+
+	if not threads:
+		threads = multiprocessing.cpu_count()
+
+	output_haps_file = Compressed_io.open_write(output_haps_filename) if output_haps_filename.endswith('.gz') else open(output_haps_filename, 'wb')
+	output_legend_file = Compressed_io.open_write(output_legend_filename) if output_legend_filename.endswith('.gz') else open(output_legend_filename, 'wb')
+
+	output_legend_file.write('ID pos allele0 allele1\n')
+
+	n_samples = None
+	stats = {'sites' : 0, 'converted' : 0, 'multiallelic' : 0, 'unphased' : 0}
+
+	def flush(legend_lines, samples_lines, gt_indexes, gt_only):
+		'''
+		Saves a block of sites
+		'''
+
+		haps = vcf_gt_block_encoder(samples_lines, n_samples) if gt_only and samples_lines else None
+		legend = legend_lines
+		if haps is None:
+			haps = []
+			legend = []
+			for legend_line, samples_line, gt_index in zip(legend_lines, samples_lines, gt_indexes):
+				haps_line = vcf_gt_line_encoder(samples_line.split('\t'), gt_index)
+				if haps_line is None:
+					stats['unphased'] += 1
+					continue
+				haps += [haps_line]
+				legend += [legend_line]
+			haps = ''.join(haps)
+
+		stats['converted'] += len(legend)
+		output_legend_file.write(''.join(legend))
+		output_haps_file.write(haps)
+
+	legend_lines = []
+	samples_lines = []
+	gt_indexes = []
+	gt_only = True
+
+	for line in chunk_line_splitter(compressed_chunk_reader(input_vcf_filename, threads)):
+		if not line or line[0] == '#':
+			if line.startswith('#CHROM'):
+				n_samples = len(line.split('\t')) - 9
+			continue
+
+		stats['sites'] += 1
+		if stats['sites'] % 100000 == 0:
+			print 'Sites:', stats['sites']
+
+		fields = line.split('\t', 9)
+		chrom, pos, variant_id, ref, alt, format_field = fields[0], fields[1], fields[2], fields[3], fields[4], fields[8]
+
+		if ',' in alt:
+			stats['multiallelic'] += 1
+			continue
+
+		if variant_id == '.':
+			variant_id = chrom + '-' + pos
+
+		format_field = format_field.split(':')
+		if 'GT' not in format_field:
+			stats['unphased'] += 1
+			continue
+
+		legend_lines += [' '.join([variant_id, pos, ref, alt]) + '\n']
+		samples_lines += [fields[9]]
+		gt_indexes += [format_field.index('GT')]
+		gt_only = gt_only and len(format_field) == 1
+
+		if len(legend_lines) == block_size:
+			flush(legend_lines, samples_lines, gt_indexes, gt_only)
+			legend_lines = []
+			samples_lines = []
+			gt_indexes = []
+			gt_only = True
+
+	flush(legend_lines, samples_lines, gt_indexes, gt_only)
+
+	output_haps_file.close()
+	output_legend_file.close()
+
+	print 'Sites: %i Converted: %i Skipped (more than 2 alleles): %i Skipped (unphased or not diploid): %i' % (stats['sites'], stats['converted'], stats['multiallelic'], stats['unphased'])
+	print 'Output 1:', output_haps_filename
+	print 'Output 2:', output_legend_filename
+
+
+
+import io
+import zlib
+import struct
+import itertools
+from multiprocessing.pool import ThreadPool
+
+#The empty block at the end of every BGZF file
+bgzf_eof_block = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+def bgzf_compress_block(data, level=6):
+	'''
+	Compresses a string of at most 65280 bytes as a BGZF block (a gzip member with the BC extra field)
+	'''
+
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+	compressed = compressor.compress(data) + compressor.flush()
+
+	header = struct.pack('<4sIBBH2sHH', '\x1f\x8b\x08\x04', 0, 0, 255, 6, 'BC', 2, len(compressed) + 25)
+	footer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+	return header + compressed + footer
+
+class Bgzf_writer(object):
+	'''
+	A file-like object that writes BGZF files (the format of bgzip). These files can be read with gzip, tabix and impute2.
+	The data are split in blocks of 65280 bytes (as bgzip does). Blocks are compressed in parallel
+	with 'threads' threads and are written in order.
+	'''
+
+	block_size = 65280
+
+	def __init__(self, filename, threads=1, level=6, blocks_per_task=16):
+		self.output_file = open(filename, 'wb')
+		self.threads = threads
+		self.level = level
+		self.blocks_per_task = blocks_per_task
+		self.pool = ThreadPool(threads) if threads > 1 else None
+		self.buffer = []
+		self.buffer_length = 0
+
+	def compress(self, block):
+		return bgzf_compress_block(block, self.level)
+
+	def write(self, data):
+		self.buffer.append(data)
+		self.buffer_length += len(data)
+		if self.buffer_length >= self.block_size * self.blocks_per_task * self.threads:
+			self.flush_blocks()
+
+	def writelines(self, lines):
+		for line in lines:
+			self.write(line)
+
+	def flush_blocks(self, final=False):
+		'''
+		Compresses and writes the complete blocks of the buffer (all the buffer if final is True)
+		'''
+
+		data = ''.join(self.buffer)
+		length = len(data) if final else (len(data) / self.block_size) * self.block_size
+		blocks = [data[index:index+self.block_size] for index in range(0, length, self.block_size)]
+		self.buffer = [data[length:]]
+		self.buffer_length = len(data) - length
+
+		if self.pool:
+			compressed = self.pool.map(self.compress, blocks, chunksize=self.blocks_per_task)
+		else:
+			compressed = itertools.imap(self.compress, blocks)
+
+		for block in compressed:
+			self.output_file.write(block)
+
+	def close(self):
+		if self.output_file.closed:
+			return
+
+		self.flush_blocks(final=True)
+		self.output_file.write(bgzf_eof_block)
+		self.output_file.close()
+		if self.pool:
+			self.pool.close()
+			self.pool.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+class Compressed_chunk_stream(io.RawIOBase):
+	'''
+	A raw stream over the decompressed content of a file (see: compressed_chunk_reader)
+	'''
+
+	def __init__(self, filename, threads=1):
+		self.chunks = compressed_chunk_reader(filename, threads)
+		self.chunk = ''
+		self.offset = 0
+
+	def readable(self):
+		return True
+
+	def readinto(self, b):
+		while self.offset >= len(self.chunk):
+			self.chunk = next(self.chunks, None)
+			self.offset = 0
+			if self.chunk is None:
+				self.chunk = ''
+				return 0
+
+		length = min(len(b), len(self.chunk) - self.offset)
+		b[:length] = self.chunk[self.offset:self.offset+length]
+		self.offset += length
+		return length
+
+	def close(self):
+		self.chunks.close()
+		io.RawIOBase.close(self)
+
+class Compressed_file_reader(io.BufferedReader):
+	'''
+	A buffered reader of a compressed file. BGZF files are decompressed in parallel
+	'''
+
+	def __init__(self, filename, threads=1):
+		io.BufferedReader.__init__(self, Compressed_chunk_stream(filename, threads), buffer_size=1024*1024)
+
+class Compressed_io:
+	'''
+	Opens gzip files for reading and writing.
+	threads: number of threads that compress and decompress
+	level: compression level (1-9)
+	'''
+
+	threads = 1
+	level = 6
+
+	@staticmethod
+	def open_read(filename):
+		'''
+		Returns a file-like object with the decompressed content of a gzip (or BGZF) file
+		'''
+
+		return Compressed_file_reader(filename, Compressed_io.threads)
+
+	@staticmethod
+	def open_write(filename):
+		'''
+		Returns a file-like object that writes a BGZF file
+		'''
+
+		return Bgzf_writer(filename, Compressed_io.threads, Compressed_io.level)
+
+
+
+import os
+import re
+import json
+import time
+import atexit
+import cProfile
+import resource
+import functools
+import contextlib
+
+class Instrumentation:
+	'''
+	Records the resources that every stage of a run uses: wall time, cpu time of this process and of its finished subprocesses, 
+	peak resident memory and bytes read and written (from /proc/self/io, only in Linux).
+	Every stage is saved as a line of JSON in events_filename and a summary per stage is printed at the end of the run.
+	Nothing is recorded unless events_filename or cprofile_dir is set (see: configure).
+
+	If cprofile_dir is set, the python stages that are marked for profiling are also profiled with cProfile. 
+	A .prof file is saved for every such stage. A profiled stage includes the stages that are nested in it.
+	'''
+
+	events_filename = None
+	cprofile_dir = None
+
+	#Identifies the events of this run in events_filename. Processes that are forked during the run keep the same id
+	run_id = None
+	#The process that configured the instrumentation. Only this process prints the summary
+	main_pid = None
+
+	#The events of this process
+	events = []
+	profiling = False
+	profile_index = 0
+
+	@staticmethod
+	def configure(events_filename=None, cprofile_dir=None):
+		'''
+		Starts the instrumentation of this run
+		events_filename: file where the events are appended as JSON lines
+		cprofile_dir: directory for the cProfile files of the python stages
+		'''
+
+		Instrumentation.events_filename = events_filename
+		Instrumentation.cprofile_dir = cprofile_dir
+		Instrumentation.run_id = '%s_%i' % (time.strftime('%Y%m%d%H%M%S'), os.getpid())
+		Instrumentation.main_pid = os.getpid()
+		Instrumentation.events = []
+
+		if cprofile_dir:
+			Install_tool_helper.mkdir(cprofile_dir, ignore_if_exist=True)
+
+		if Instrumentation.enabled():
+			atexit.register(Instrumentation.report)
+
+	@staticmethod
+	def enabled():
+		return bool(Instrumentation.events_filename or Instrumentation.cprofile_dir)
+
+	@staticmethod
+	def io_counters():
+		'''
+		Returns the I/O counters of this process (including its finished subprocesses): 
+		rchar, wchar (bytes read and written with system calls) and read_bytes, write_bytes (bytes read and written from storage)
+		Returns zeros if /proc/self/io is not available
+		'''
+
+		counters = {'rchar' : 0, 'wchar' : 0, 'read_bytes' : 0, 'write_bytes' : 0}
+		try:
+			with open('/proc/self/io') as io_file:
+				for line in io_file:
+					key, value = line.split(':')
+					if counters.has_key(key):
+						counters[key] = int(value)
+		except (IOError, ValueError):
+			pass
+
+		return counters
+
+	@staticmethod
+	def counters():
+		'''
+		Returns the current counters of this process
+		'''
+
+		self_usage = resource.getrusage(resource.RUSAGE_SELF)
+		children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+		ret = Instrumentation.io_counters()
+		ret.update({
+			'time' : time.time(),
+			'cpu' : self_usage.ru_utime + self_usage.ru_stime,
+			'children_cpu' : children_usage.ru_utime + children_usage.ru_stime,
+			#ru_maxrss is in KB in Linux
+			'max_rss' : max(self_usage.ru_maxrss, children_usage.ru_maxrss),
+		})
+		return ret
+
+	@staticmethod
+	def event(stage, **fields):
+		'''
+		Saves an event of a stage
+		'''
+
+		event = {'run' : Instrumentation.run_id, 'pid' : os.getpid(), 'stage' : stage}
+		event.update(fields)
+		Instrumentation.events += [event]
+
+		if Instrumentation.events_filename:
+			#One write per event. Processes of the same run append to the same file
+			with open(Instrumentation.events_filename, 'a') as events_file:
+				events_file.write(json.dumps(event, sort_keys=True) + '\n')
+
+	@staticmethod
+	@contextlib.contextmanager
+	def stage(stage, profile=False, **details):
+		'''
+		Measures the code in a with statement as a stage:
+			with Instrumentation.stage('reference_scan', reference='1000GP'):
+				...
+		profile: if True and cprofile_dir is set, the stage is also profiled with cProfile
+		details: saved in the event of the stage
+		'''
+
+		if not Instrumentation.enabled():
+			yield
+			return
+
+		start = Instrumentation.counters()
+		profiler = None
+		if profile and Instrumentation.cprofile_dir and not Instrumentation.profiling:
+			Instrumentation.profiling = True
+			profiler = cProfile.Profile()
+			profiler.enable()
+
+		status = 'ok'
+		try:
+			yield
+		except:
+			status = 'error'
+			raise
+		finally:
+			end = Instrumentation.counters()
+			if profiler:
+				profiler.disable()
+				Instrumentation.profiling = False
+				Instrumentation.profile_index += 1
+				details['cprofile'] = os.path.join(Instrumentation.cprofile_dir, '%s_%i_%i.prof' % (re.sub(r'\W', '_', stage), os.getpid(), Instrumentation.profile_index))
+				profiler.dump_stats(details['cprofile'])
+
+			Instrumentation.event(stage, 
+				status=status,
+				start=start['time'],
+				wall=end['time'] - start['time'],
+				cpu=end['cpu'] - start['cpu'],
+				children_cpu=end['children_cpu'] - start['children_cpu'],
+				max_rss_mb=end['max_rss'] / 1024.0,
+				read_bytes=end['rchar'] - start['rchar'],
+				write_bytes=end['wchar'] - start['wchar'],
+				disk_read_bytes=end['read_bytes'] - start['read_bytes'],
+				disk_write_bytes=end['write_bytes'] - start['write_bytes'],
+				**details)
+
+	@staticmethod
+	def instrumented(stage, profile=False):
+		'''
+		Decorator that measures every call of a function as a stage (see: stage)
+		'''
+
+		def decorator(function):
+			@functools.wraps(function)
+			def wrapper(*args, **kwargs):
+				with Instrumentation.stage(stage, profile):
+					return function(*args, **kwargs)
+			return wrapper
+		return decorator
+
+	@staticmethod
+	def report():
+		'''
+		Prints a summary of the events of this run per stage. 
+		Stages can be nested, so the times of different stages can overlap
+		'''
+
+		if not Instrumentation.enabled() or os.getpid() != Instrumentation.main_pid:
+			return
+
+		events = Instrumentation.events
+		if Instrumentation.events_filename and os.path.exists(Instrumentation.events_filename):
+			with open(Instrumentation.events_filename) as events_file:
+				events = [event for event in (json.loads(line) for line in events_file) if event.get('run') == Instrumentation.run_id]
+
+		summary = {}
+		for event in events:
+			stage_summary = summary.setdefault(event['stage'], {'count' : 0, 'failed' : 0, 'wall' : 0.0, 'cpu' : 0.0, 'max_rss_mb' : 0.0, 'read_bytes' : 0, 'write_bytes' : 0})
+			stage_summary['count'] += 1
+			stage_summary['failed'] += event['status'] != 'ok'
+			stage_summary['wall'] += event['wall']
+			stage_summary['cpu'] += event['cpu'] + event.get('children_cpu', 0.0)
+			stage_summary['max_rss_mb'] = max(stage_summary['max_rss_mb'], event['max_rss_mb'])
+			stage_summary['read_bytes'] += event['read_bytes']
+			stage_summary['write_bytes'] += event['write_bytes']
+
+		print 'Instrumentation summary (run: %s):' % Instrumentation.run_id
+		print '%-36s %6s %6s %11s %11s %10s %11s %11s' % ('stage', 'count', 'failed', 'wall time', 'cpu time', 'peak RSS', 'read', 'written')
+		for stage, stage_summary in sorted(summary.iteritems(), key=lambda x : x[1]['wall'], reverse=True):
+			print '%-36s %6i %6i %10.1fs %10.1fs %8.1fMB %9.1fMB %9.1fMB' % (stage, stage_summary['count'], stage_summary['failed'], stage_summary['wall'], stage_summary['cpu'], 
+				stage_summary['max_rss_mb'], stage_summary['read_bytes'] / 1024.0 / 1024.0, stage_summary['write_bytes'] / 1024.0 / 1024.0)
+		if Instrumentation.events_filename:
+			print 'Events saved in:', Instrumentation.events_filename
+		if Instrumentation.cprofile_dir:
+			print 'cProfile files saved in:', Instrumentation.cprofile_dir
+
+
+
 import os
 import uuid 
+import hashlib
 
 class Molgenis_compute:
 	'''
@@ -227,12 +939,16 @@ class Molgenis_compute:
 
 	constants_filename = 'molgenis-pipelines-master/compute5/Imputation_impute2/constants.csv'
 
-	def __init__(self, pipeline_root_directory, molgenis_directory, root_directory, tools_directory):
+	#Worksheet columns that contain the id of the run. These are ignored when jobs of the native backend are compared between runs
+	native_run_specific_columns = ['project', 'study']
+
+	def __init__(self, pipeline_root_directory, molgenis_directory, root_directory, tools_directory, native_scheduler=None):
 		'''
 		pipeline_root_directory: The directory of the pipelines
 		molgenis_directory: the directory of molgenis compute
 		root_directory: The directory for the generated scripts
 		tools_directory: The directory where the tools are installed
+		native_scheduler: The Native_scheduler that runs the jobs of the 'native' backend
 		'''
 
 		self.job_id = self.get_job_id()
@@ -243,6 +959,7 @@ class Molgenis_compute:
 			self.root_directory = os.getcwd()
 		self.tools_directory = tools_directory
 		self.install_tool_helper = Install_tool_helper()
+		self.native_scheduler = native_scheduler if native_scheduler else Native_scheduler()
 		
 		self.molgenis_compute_sh = os.path.join(molgenis_directory, self.molgenis_compute_sh)
 
@@ -302,10 +1019,10 @@ class Molgenis_compute:
 		'''
 		Saves the information of the root directory for all files and tools in the pipelines
 		'''
-		root_worksheet = os.path.join(self.generated_dir_namer(pipeline_name, self.job_id), 'root_' + self.job_id + '.csv')
+		root_worksheet = os.path.join(self.generated_dir_namer(pipeline_name, job_id), 'root_' + job_id + '.csv')
 		with open(root_worksheet, 'w') as root_worksheet_f:
 			root_worksheet_f.write('root,randomUUID\n')
-			root_worksheet_f.write(self.tools_directory + ',' + job_id)
+			root_worksheet_f.write(self.tools_directory + ',' + self.job_id)
 			
 		self.root_worksheet = root_worksheet
 
@@ -364,49 +1081,401 @@ class Molgenis_compute:
 		#Remove empty worksheets
 		worksheet_data = [w for w in worksheet_data if w]
 
-		for worksheet_index, current_worksheet_data in enumerate(worksheet_data):
-			self.create_worksheet(self.job_id, pipeline_name, current_worksheet_data, worksheet_index, verbose=True)
+		if backend == 'native':
+			#One job per row of the first worksheet
+			self.native_generate_submit([{
+				'name' : '%s_%i' % (pipeline_name, row),
+				'pipeline' : pipeline_name,
+				'worksheet_data' : [self.worksheet_row(worksheet_data[0], row)] + worksheet_data[1:],
+				'dependencies' : [],
+			} for row in range(len(worksheet_data[0][0]) - 1)], submit)
+			return
 
-		self.create_root_worksheet(pipeline_name, self.job_id)
+		with Instrumentation.stage('worksheet_generation', pipeline=pipeline_name):
+			for worksheet_index, current_worksheet_data in enumerate(worksheet_data):
+				self.create_worksheet(self.job_id, pipeline_name, current_worksheet_data, worksheet_index, verbose=True)
+
+			self.create_root_worksheet(pipeline_name, self.job_id)
 
 		command = self.molgenis_command_formatter(pipeline_name, self.job_id, len(worksheet_data), backend)
 
-		self.install_tool_helper.execute(' '.join(command))
+		with Instrumentation.stage('script_generation', pipeline=pipeline_name):
+			self.install_tool_helper.execute(' '.join(command))
 
 		if submit:
 			self.submit_generated_script(pipeline_name, self.job_id, backend)
 
 		generated_dir = self.generated_dir_namer(pipeline_name, self.job_id)
 
+	def worksheet_row(self, worksheet_data, row):
+		'''
+		Returns a worksheet with only one row of worksheet_data. 
+		'''
 
+		return self.worksheet_rows(worksheet_data, [row])
 
-import os
-from subprocess import call
+	def worksheet_rows(self, worksheet_data, rows):
+		'''
+		Returns a worksheet with only the given rows of worksheet_data
+		'''
 
-class Install_tool_helper:
-	'''
-	This is a collection of static methods useful for installing tools in the system
-	'''
+		return [[column[0]] + [column[row+1] for row in rows] for column in worksheet_data]
 
-	@staticmethod
-	def which(program):
-		'''
-		Emulates the behavior of the unix 'which' command
-		Code taken and adjusted from here: http://stackoverflow.com/questions/377017/test-if-executable-exists-in-python
+	def worksheet_generate_submit_per_chromosome(self, pipeline_name, chromosome_worksheet_data, backend, submit=True):
 		'''
+		Create worksheets, generate and submit scripts separately for every chromosome
+		chromosome_worksheet_data: a list of (chromosome, worksheet_data) pairs
 
-		def is_exe(fpath):
-			return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
+		With a combined pipeline (for example phase_impute) the jobs of a chromosome depend
+		only on the jobs of the same chromosome. For the pbs and grid backends the scheduler
+		of the cluster resolves these dependencies. For the local backend the generated scripts
+		of the chromosomes run in parallel with the native scheduler (see: Native_scheduler).
+		'''
 
-		fpath, fname = os.path.split(program)
-		if fpath:
-			if is_exe(program):
-				return program
+		generated_dirs = []
+		for chromosome, worksheet_data in chromosome_worksheet_data:
+			#Remove empty worksheets
+			worksheet_data = [w for w in worksheet_data if w]
+
+			job_id = self.job_id + '_chr' + chromosome
+			with Instrumentation.stage('worksheet_generation', pipeline=pipeline_name, chromosome=chromosome):
+				for worksheet_index, current_worksheet_data in enumerate(worksheet_data):
+					self.create_worksheet(job_id, pipeline_name, current_worksheet_data, worksheet_index, verbose=True)
+
+				self.create_root_worksheet(pipeline_name, job_id)
+
+			command = self.molgenis_command_formatter(pipeline_name, job_id, len(worksheet_data), backend)
+			with Instrumentation.stage('script_generation', pipeline=pipeline_name, chromosome=chromosome):
+				self.install_tool_helper.execute(' '.join(command))
+			generated_dirs += [(chromosome, self.generated_dir_namer(pipeline_name, job_id))]
+
+		if not submit:
+			print 'Generated %s scripts in: %s' % (backend, ', '.join([x[1] for x in generated_dirs]))
+		elif backend == 'local':
+			status = self.native_scheduler.run([{
+				'name' : '%s_chr%s' % (pipeline_name, chromosome),
+				'command' : 'sh submit.sh',
+				'dependencies' : [],
+				'directory' : generated_dir,
+				'log' : os.path.join(generated_dir, 'run.log'),
+				'limits' : False,
+			} for chromosome, generated_dir in generated_dirs])
+
+			print 'RANDOM ID FOR THIS RUN WAS: ', str(self.job_id)
+			print 'Generated scripts are saved in: ', self.generated_dir_namer(pipeline_name, self.job_id + '_chr*')
+
+			failed = [name for name, job_status in status.iteritems() if job_status != 'finished']
+			if failed:
+				raise Exception('%i chromosomes did not finish. See the run.log files in the generated directories' % len(failed))
 		else:
-			for path in os.environ["PATH"].split(os.pathsep):
-				path = path.strip('"')
-				exe_file = os.path.join(path, program)
-				if is_exe(exe_file):
+			for chromosome, generated_dir in generated_dirs:
+				self.submit_generated_script(pipeline_name, self.job_id + '_chr' + chromosome, backend)
+
+	def native_job_id(self, pipeline_name, worksheet_data):
+		'''
+		Returns a job id that depends only on the content of the worksheets (and not on the id of this run).
+		Jobs with the same worksheets reuse the same generated directory when a run is repeated.
+		The id does not depend on the content of the input files, so it is not used to decide if a job has finished.
+		'''
+
+		content = pipeline_name + repr([[column for column in worksheet if column[0] not in self.native_run_specific_columns] for worksheet in worksheet_data])
+		return 'native_' + hashlib.md5(content).hexdigest()[:12]
+
+	def native_generate_submit(self, jobs, submit=True, extra_jobs=None):
+		'''
+		Generates and runs scripts with the native scheduler (see: Native_scheduler)
+		jobs: a list of dictionaries with keys:
+			name : a unique name of the job
+			pipeline : the name of the pipeline
+			worksheet_data : the worksheets of this job. Usually a single row
+			dependencies : a list of names of jobs that should finish before this job starts
+
+		The scripts of every job are generated with molgenis compute (local backend) in a separate directory.
+		The generation of the scripts is also a job of the scheduler. The run of the generated scripts of a job
+		depends on its generation and on the runs of its dependencies.
+		Every job is run. The generated scripts skip the steps whose outputs are in place.
+		extra_jobs: jobs for the Native_scheduler that are run together with the generated scripts (for example merging the results)
+		If submit is False, the scripts are only generated.
+		'''
+
+		scheduler_jobs = []
+		for job in jobs:
+			job_id = self.native_job_id(job['pipeline'], job['worksheet_data'])
+			generated_dir = self.generated_dir_namer(job['pipeline'], job_id)
+
+			with Instrumentation.stage('worksheet_generation', pipeline=job['pipeline'], job=job['name']):
+				for worksheet_index, current_worksheet_data in enumerate(job['worksheet_data']):
+					self.create_worksheet(job_id, job['pipeline'], current_worksheet_data, worksheet_index, verbose=False)
+				self.create_root_worksheet(job['pipeline'], job_id)
+
+			scheduler_jobs += [{
+				'name' : 'generate_' + job['name'],
+				'command' : ' '.join(self.molgenis_command_formatter(job['pipeline'], job_id, len(job['worksheet_data']), 'local')),
+				'dependencies' : [],
+				'log' : os.path.join(generated_dir, 'generate.log'),
+				#Java reserves a lot of virtual memory. Do not apply memory limits
+				'limits' : False,
+			}]
+
+			if submit:
+				scheduler_jobs += [{
+					'name' : job['name'],
+					'command' : 'sh submit.sh',
+					'dependencies' : ['generate_' + job['name']] + job['dependencies'],
+					'directory' : generated_dir,
+					'log' : os.path.join(generated_dir, 'run.log'),
+					#The generated scripts start java tools. Do not apply memory limits
+					'limits' : False,
+				}]
+
+		if submit and extra_jobs:
+			scheduler_jobs += extra_jobs
+
+		print 'Running %i jobs with the native scheduler' % len(scheduler_jobs)
+		status = self.native_scheduler.run(scheduler_jobs)
+
+		print 'RANDOM ID FOR THIS RUN WAS: ', str(self.job_id)
+		print 'Generated scripts are saved in: ', os.path.join(self.root_directory, '*_native_*')
+
+		failed = [name for name, job_status in status.iteritems() if job_status not in ['finished', 'done']]
+		if failed:
+			raise Exception('%i jobs did not finish. See the log files in the generated directories' % len(failed))
+
+
+
+import os
+import re
+import sys
+import time
+import resource
+import traceback
+import subprocess
+import multiprocessing
+
+class Native_scheduler:
+	'''
+	Runs jobs as local processes according to their dependencies (a DAG)
+	A job is a dictionary with the keys:
+		name : a unique name
+		command : a shell command or function calls: a tuple (function, args[, kwargs]) or a list of tuples (see: Install_tool_helper.execute). 
+			Function calls run in a separate process
+		dependencies : a list with the names of the jobs that should finish successfully before this job starts
+		directory : (optional) the working directory of the command
+		log : (optional) the file for the standard output and error of the command
+		limits : (optional) if False, the cpu and memory limits are not applied to this job. Default: True
+		finished : (optional) a marker file. It is created when the job finishes successfully.
+			If it already exists, the job is not run again
+
+	The wall time, cpu time, peak memory and I/O of every job are recorded as events of the stage 'job:<name without chromosome and index>' (see: Instrumentation)
+	'''
+
+	def __init__(self, workers=None, max_memory=None, max_cpu_time=None, poll_interval=1.0):
+		'''
+		workers: Maximum number of jobs that run at the same time. Default: number of CPUs
+		max_memory: Maximum memory (virtual address space) of every process of a job in MB. None for no limit
+		max_cpu_time: Maximum cpu time of every process of a job in seconds. None for no limit
+		poll_interval: Seconds to wait between checks for finished jobs
+		'''
+
+		self.workers = workers if workers else multiprocessing.cpu_count()
+		self.max_memory = max_memory
+		self.max_cpu_time = max_cpu_time
+		self.poll_interval = poll_interval
+
+	def set_limits(self):
+		'''
+		Applies the cpu and memory limits. This runs in the process of the job, before the command
+		'''
+
+		if self.max_memory:
+			resource.setrlimit(resource.RLIMIT_AS, (self.max_memory * 1024 * 1024, self.max_memory * 1024 * 1024))
+		if self.max_cpu_time:
+			resource.setrlimit(resource.RLIMIT_CPU, (self.max_cpu_time, self.max_cpu_time))
+
+	def run_function(self, command, log, limits):
+		'''
+		Runs a function call job. This runs in the (forked) process of the job
+		'''
+
+		if limits:
+			self.set_limits()
+		if log:
+			sys.stdout.flush()
+			os.dup2(log.fileno(), 1)
+			os.dup2(log.fileno(), 2)
+
+		try:
+			Install_tool_helper.execute(command)
+		except Exception:
+			traceback.print_exc()
+			sys.stdout.flush()
+			os._exit(1)
+
+		sys.stdout.flush()
+		os._exit(0)
+
+	def reap(self, pid):
+		'''
+		Checks if the process of a job has finished. 
+		Returns None if it is still running or (exit code, resource usage, I/O counters) of the process and all its subprocesses.
+		The I/O of a finished process is added to the I/O counters of its parent when it is reaped. 
+		'''
+
+		io_before = Instrumentation.io_counters()
+		finished_pid, exit_status, usage = os.wait4(pid, os.WNOHANG)
+		if not finished_pid:
+			return None
+		io_after = Instrumentation.io_counters()
+
+		returncode = -os.WTERMSIG(exit_status) if os.WIFSIGNALED(exit_status) else os.WEXITSTATUS(exit_status)
+		return returncode, usage, dict([(x, io_after[x] - io_before[x]) for x in io_after])
+
+	def check_jobs(self, jobs):
+		'''
+		Checks that the names are unique, that all dependencies exist and that there are no cycles
+		'''
+
+		names = [job['name'] for job in jobs]
+		if len(set(names)) != len(names):
+			raise Exception('Job names are not unique')
+
+		dependencies = {job['name'] : job['dependencies'] for job in jobs}
+		for name, job_dependencies in dependencies.iteritems():
+			for dependency in job_dependencies:
+				if dependency not in dependencies:
+					raise Exception('Job %s depends on unknown job: %s' % (name, dependency))
+
+		#Remove jobs without unresolved dependencies until nothing is left
+		resolved = set()
+		while len(resolved) < len(names):
+			ready = [name for name in names if name not in resolved and all([x in resolved for x in dependencies[name]])]
+			if not ready:
+				raise Exception('Cyclic dependencies between jobs: %s' % (', '.join([name for name in names if name not in resolved])))
+			resolved.update(ready)
+
+	def run(self, jobs):
+		'''
+		Runs all jobs. A job starts when all its dependencies have finished successfully.
+		If a job fails, the jobs that depend on it are skipped but all other jobs continue.
+		Prints the progress and a summary with the wall time of every job.
+		Returns a dictionary: job name -> 'finished', 'done' (finished in a previous run), 'failed' or 'skipped'
+		'''
+
+		self.check_jobs(jobs)
+
+		status = {}
+		wall_time = {}
+		pending = list(jobs)
+		running = []
+
+		while pending or running:
+			changed = False
+
+			#Check running jobs
+			for job, process, log, start in running[:]:
+				#process is a Popen of a shell command or the pid of a forked function call
+				finished = self.reap(process.pid if type(process) is subprocess.Popen else process)
+				if finished is None:
+					continue
+				returncode, usage, io_counters = finished
+				if type(process) is subprocess.Popen:
+					process.returncode = returncode
+				changed = True
+				running.remove((job, process, log, start))
+				if log:
+					log.close()
+				wall_time[job['name']] = time.time() - start
+				status[job['name']] = 'finished' if returncode == 0 else 'failed'
+				if Instrumentation.enabled():
+					Instrumentation.event('job:' + re.sub(r'(_chr.*|_\d+)$', '', job['name']), job=job['name'], 
+						status='ok' if returncode == 0 else 'error', 
+						start=start, 
+						wall=wall_time[job['name']], 
+						cpu=usage.ru_utime + usage.ru_stime,
+						max_rss_mb=usage.ru_maxrss / 1024.0,
+						read_bytes=io_counters['rchar'],
+						write_bytes=io_counters['wchar'],
+						disk_read_bytes=io_counters['read_bytes'],
+						disk_write_bytes=io_counters['write_bytes'])
+				if returncode == 0 and job.get('finished'):
+					open(job['finished'], 'w').close()
+				print '[%i/%i] %s %s in %.1f sec%s' % (len(status), len(jobs), job['name'], status[job['name']], wall_time[job['name']], '' if returncode == 0 else ' (exit code: %i)' % returncode)
+
+			#Start or skip pending jobs
+			for job in pending[:]:
+				if job.get('finished') and os.path.exists(job['finished']):
+					pending.remove(job)
+					changed = True
+					status[job['name']] = 'done'
+					print '[%i/%i] %s has already finished' % (len(status), len(jobs), job['name'])
+					continue
+
+				if any([status.get(x) in ['failed', 'skipped'] for x in job['dependencies']]):
+					pending.remove(job)
+					changed = True
+					status[job['name']] = 'skipped'
+					print '[%i/%i] %s skipped. A dependency did not finish' % (len(status), len(jobs), job['name'])
+					continue
+
+				if len(running) >= self.workers:
+					continue
+
+				if all([status.get(x) in ['finished', 'done'] for x in job['dependencies']]):
+					pending.remove(job)
+					changed = True
+					print 'Running: %s' % job['name']
+					log = open(job['log'], 'a') if job.get('log') else None
+					if type(job['command']) in [tuple, list]:
+						sys.stdout.flush()
+						process = os.fork()
+						if process == 0:
+							try:
+								self.run_function(job['command'], log, job.get('limits', True))
+							finally:
+								os._exit(1)
+					else:
+						process = subprocess.Popen(job['command'], shell=True, cwd=job.get('directory'), stdout=log, stderr=subprocess.STDOUT if log else None, preexec_fn=self.set_limits if job.get('limits', True) else None)
+					running += [(job, process, log, time.time())]
+
+			if not changed:
+				time.sleep(self.poll_interval)
+
+		print 'Summary of jobs:'
+		print '%-40s %-10s %10s' % ('job', 'status', 'wall time')
+		for job in jobs:
+			print '%-40s %-10s %9.1fs' % (job['name'], status[job['name']], wall_time.get(job['name'], 0.0))
+
+		return status
+
+
+
+import os
+from subprocess import call
+
+class Install_tool_helper:
+	'''
+	This is a collection of static methods useful for installing tools in the system
+	'''
+
+	@staticmethod
+	def which(program):
+		'''
+		Emulates the behavior of the unix 'which' command
+		Code taken and adjusted from here: http://stackoverflow.com/questions/377017/test-if-executable-exists-in-python
+		'''
+
+		def is_exe(fpath):
+			return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
+
+		fpath, fname = os.path.split(program)
+		if fpath:
+			if is_exe(program):
+				return program
+		else:
+			for path in os.environ["PATH"].split(os.pathsep):
+				path = path.strip('"')
+				exe_file = os.path.join(path, program)
+				if is_exe(exe_file):
 					return exe_file
 
 		return None
@@ -450,7 +1519,8 @@ class Install_tool_helper:
 		if type(command) is str:
 			print 'Running:', command
 			stdf = open(stdout, 'wb') if stdout else None
-			ret = call(command.split(), stdout=stdf)
+			with Instrumentation.stage('execute', command=command[:200]):
+				ret = call(command.split(), stdout=stdf)
 
 			if ret:
 				if stop_if_error:
@@ -461,9 +1531,11 @@ class Install_tool_helper:
 		elif type(command) is tuple:
 			if len(command) == 2:
 				print command
-				command[0](*command[1])
+				with Instrumentation.stage(getattr(command[0], '__name__', 'function'), profile=True):
+					command[0](*command[1])
 			elif len(command) == 3:
-				command[0](*command[1], **command[2])
+				with Instrumentation.stage(getattr(command[0], '__name__', 'function'), profile=True):
+					command[0](*command[1], **command[2])
 			else:
 				raise Exception('Don\'t know how to run: %s. tuple should have 2 or 3 items' % (str(command))) 
 			return 0
@@ -617,6 +1689,9 @@ except ImportError as e:
 '''
 	sys.exit(1)
 
+import json
+import mmap
+import shutil
 import tempfile
 import mimetypes
 
@@ -632,6 +1707,7 @@ class bioinformatics_file_helper:
 		genotypes: a list with tuples of genotypes for the same SNP. i.e: [('A', 'A'), ('A', 'G'), ('G', '0')]
 		returns: a tuple with the different alleles. i.e ('A', 'G')
 		The alleles in the tuple are sorted according to their frequency.
+		For many SNPs use get_alleles_batch
 		'''
 
 		flat_genotypes = [genotype for genotype_pair in genotypes for genotype in genotype_pair]
@@ -646,6 +1722,67 @@ class bioinformatics_file_helper:
 			count_sorted = {x : flat_genotypes.count(x) for x in all_alleles}
 			return sorted(count_sorted, key=lambda x : count_sorted[x])[::-1] #Sort and revert
 
+	@staticmethod
+	def allele_counts_batch(genotypes, block_size=None):
+		'''
+		genotypes: a 2D numpy array of uint8 allele codes (SNPs x 2*samples). For example the bytes of the alleles of a PED file
+		Returns a tuple: (codes, counts). codes: a sorted array with the allele codes that exist in genotypes. 
+		counts: a (SNPs x len(codes)) array with the number of times every code exists in every SNP.
+		SNPs are counted in blocks of 'block_size' (Default: 4M genotypes per block)
+		'''
+
+		genotypes = numpy.asarray(genotypes, dtype=numpy.uint8)
+		if genotypes.ndim != 2:
+			raise Exception('genotypes should be a 2D array (SNPs x 2*samples)')
+		snps, columns = genotypes.shape
+
+		block_size = block_size if block_size else max(1, (4 * 1024 * 1024) // max(1, columns))
+
+		#bincount converts its input to intp. Count in blocks to keep the memory bounded
+		code_counts = numpy.zeros(256, dtype=numpy.int64)
+		for first_snp in range(0, snps, block_size):
+			code_counts += numpy.bincount(genotypes[first_snp:first_snp + block_size].ravel(), minlength=256)
+		codes = numpy.flatnonzero(code_counts)
+		code_index = numpy.zeros(256, dtype=numpy.intp)
+		code_index[codes] = numpy.arange(len(codes))
+
+		counts = numpy.zeros((snps, len(codes)), dtype=numpy.int64)
+		for first_snp in range(0, snps, block_size):
+			block = genotypes[first_snp:first_snp + block_size]
+			#Every SNP of the block has its own range of bins
+			bins = code_index[block] + (numpy.arange(len(block)) * len(codes))[:, None]
+			counts[first_snp:first_snp + block_size] = numpy.bincount(bins.ravel(), minlength=len(block) * len(codes)).reshape(len(block), len(codes))
+
+		return codes, counts
+
+	@staticmethod
+	def get_alleles_batch(genotypes, missing=ord('0'), block_size=None):
+		'''
+		genotypes: a 2D numpy array of uint8 allele codes (SNPs x 2*samples). 'missing' is the code of a missing allele
+		Returns a tuple of arrays with one item per SNP: (major allele, minor allele, major allele count, minor allele count)
+		A SNP without alleles has major and minor allele 'missing'. A SNP with one allele has minor allele 'missing'. 
+		If more than two alleles exist, the minor allele is the second most frequent. Alleles with the same count are sorted by code.
+		'''
+
+		codes, counts = bioinformatics_file_helper.allele_counts_batch(genotypes, block_size)
+		counts[:, codes == missing] = 0
+		if not len(codes):
+			#No SNPs or no samples
+			codes = numpy.array([missing], dtype=numpy.uint8)
+			counts = numpy.zeros((counts.shape[0], 1), dtype=numpy.int64)
+
+		rows = numpy.arange(counts.shape[0])
+		major_index = counts.argmax(axis=1)
+		major_count = counts[rows, major_index]
+		counts[rows, major_index] = -1
+		minor_index = counts.argmax(axis=1)
+		minor_count = numpy.maximum(counts[rows, minor_index], 0)
+
+		major = numpy.where(major_count > 0, codes[major_index], missing).astype(numpy.uint8)
+		minor = numpy.where(minor_count > 0, codes[minor_index], missing).astype(numpy.uint8)
+
+		return major, minor, major_count, minor_count
+
 	@staticmethod
 	def get_chromosome_files(path, chromosome_exp=r'chr%(chromosome)s'):
 		'''
@@ -731,7 +1868,7 @@ class bioinformatics_file_helper:
 		if type(filename) is str:
 			#Check if file is a gzip
 			if mimetypes.guess_type(filename)[1] == 'gzip':
-				return gzip.open(filename,'rb')
+				return Compressed_io.open_read(filename)
 
 			return open(filename, 'rU')
 		else:
@@ -746,7 +1883,7 @@ class bioinformatics_file_helper:
 		if type(filename) is str:
 
 			if mimetypes.guess_type(filename)[1] == 'gzip':
-				return gzip.open(filename, 'wb')
+				return Compressed_io.open_write(filename)
 
 			return open(filename, 'w')
 		else:
@@ -757,7 +1894,7 @@ class bioinformatics_file_helper:
 		'''
 		Checks the type of filesource and closes the file
 		'''
-		if type(stream) is file:
+		if type(stream) is file or isinstance(stream, (Compressed_file_reader, Bgzf_writer)):
 			stream.close()
 
 	@staticmethod
@@ -777,69 +1914,158 @@ class bioinformatics_file_helper:
 
 		bioinformatics_file_helper.close_file(read_from)
 
+	#The extension of the files that cache the result of line_counter
+	line_count_suffix = '.count'
+
 	@staticmethod
-	def line_counter(filename):
+	def line_counter(filename, cache=False, block_size=16*1024*1024):
 		'''
 		filename: a filename or open file
-		Returns the number of lines in filename
+		Returns the number of lines in filename (None if it is empty)
+
+		Lines are not parsed. Newlines are counted in blocks of 'block_size' bytes. 
+		Uncompressed files are memory mapped. 
+		If cache is True, the count is saved in <filename>.count together with the size and
+		modification time of filename. The next call reads the count from this file if filename has not changed.
 		'''
 
-		line_g = bioinformatics_file_helper.line_generator(filename)
+		if type(filename) is not str:
+			ret = None
+			for l in bioinformatics_file_helper.line_generator(filename):
+				ret = l[0]
+			return ret
 
-		ret = None
-		for l in line_g:
-			ret = l[0]
+		stat = os.stat(filename)
+		cache_filename = filename + bioinformatics_file_helper.line_count_suffix
+		if cache and os.path.exists(cache_filename):
+			try:
+				with open(cache_filename) as cache_file:
+					cached = json.load(cache_file)
+				if cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+					return cached['count']
+			except (IOError, ValueError, KeyError):
+				print 'Warning: Could not read: %s' % cache_filename
+
+		ret = 0
+		last_character = '\n'
+		if mimetypes.guess_type(filename)[1] == 'gzip':
+			read_from = Compressed_io.open_read(filename)
+			while True:
+				block = read_from.read(block_size)
+				if not block:
+					break
+				ret += block.count('\n')
+				last_character = block[-1]
+			read_from.close()
+		elif stat.st_size:
+			with open(filename, 'rb') as read_from:
+				mapped = mmap.mmap(read_from.fileno(), 0, access=mmap.ACCESS_READ)
+				for start in xrange(0, len(mapped), block_size):
+					ret += mapped[start:start+block_size].count('\n')
+				last_character = mapped[-1]
+				mapped.close()
+
+		#The last line may not end with a newline
+		if last_character != '\n':
+			ret += 1
+
+		if not ret:
+			ret = None
+
+		if cache:
+			try:
+				with open(cache_filename, 'w') as cache_file:
+					json.dump({'size' : stat.st_size, 'mtime' : stat.st_mtime, 'count' : ret}, cache_file)
+			except IOError:
+				print 'Warning: Could not save: %s' % cache_filename
 
 		return ret
 
 	@staticmethod
-	def column_generator(filename, batch_size=10000):
+	def column_generator(filename, batch_size=10000, memory_budget=256*1024*1024):
 		'''
 		filename: a filename or open file
-		Reads a column of a file.
-		After 'batch_size' reads reopens the file
+		Reads a file column by column.
+		The file is read once. Blocks of lines are transposed and saved in temporary .npy files.
+		The columns are read from these files (memory mapped) in batches of at most 'batch_size' columns.
+		memory_budget: Approximate number of bytes to keep in memory for a block of lines or a batch of columns
 		yields a tuple: current column, line
 		'''
 
-		start_column = 0
-		line_counter = 0
-		while True:
-			to_return = []
-			finished = False
-
-			f = bioinformatics_file_helper.open_file_read(filename)
-			for l in f:
-				s = l.replace('\n', '').split()
-				#Store a batch_size at most records
-				current_line_batch = s[start_column: start_column + batch_size]
-				
-				if not len(current_line_batch):
-					finished = True
+		scratch_dir = tempfile.mkdtemp()
+		try:
+			#Read the file once and spill transposed blocks of lines
+			spills = []
+			rows = 0
+			columns = None
+			block = []
+			block_tokens = 0
+			read_from = bioinformatics_file_helper.open_file_read(filename)
+			for l in read_from:
+				s = l.split()
+				if not s:
 					break
 
-				to_return += [current_line_batch]
-
-			if finished:
-				break
-
-			bioinformatics_file_helper.close_file(f)
-
-			#Transpose
-			to_return_transposed = numpy.transpose(to_return)
+				if columns is None:
+					columns = len(s)
+				elif len(s) != columns:
+					raise Exception('Line %i has %i columns instead of %i' % (rows + len(block) + 1, len(s), columns))
+
+				block += [s]
+				block_tokens += columns
+				#A token in a list of strings takes approximately 64 bytes
+				if block_tokens * 64 >= memory_budget:
+					spills += [bioinformatics_file_helper.spill_transposed(block, scratch_dir, len(spills))]
+					rows += len(block)
+					block = []
+					block_tokens = 0
+
+			if block:
+				spills += [bioinformatics_file_helper.spill_transposed(block, scratch_dir, len(spills))]
+				rows += len(block)
+			block = None
+
+			if type(filename) is str:
+				read_from.close()
+
+			if not spills:
+				return
+
+			#Read batches of columns from the spilled blocks
+			spills = [numpy.load(spill, mmap_mode='r') for spill in spills]
+			itemsize = max([spill.dtype.itemsize for spill in spills])
+			columns_per_batch = max(1, min(batch_size, memory_budget / (2 * rows * itemsize)))
+
+			line_counter = 0
+			for start_column in range(0, columns, columns_per_batch):
+				to_return_transposed = numpy.concatenate([spill[start_column:start_column+columns_per_batch] for spill in spills], axis=1)
+				for line in to_return_transposed:
+					line_counter += 1
+					yield line_counter, line.tolist()
+
+		finally:
+			shutil.rmtree(scratch_dir)
 
-			#Yield columns
-			for line in to_return_transposed:
-				line_counter += 1
-				yield line_counter, list(line)
+	@staticmethod
+	def spill_transposed(block, directory, index):
+		'''
+		block: a list of lines. Each line is a list of strings
+		Saves the transposed block as a .npy file in directory. Returns the filename
+		'''
 
-			start_column += batch_size
+		spill_filename = os.path.join(directory, 'spill_%i.npy' % index)
+		numpy.save(spill_filename, numpy.ascontiguousarray(numpy.array(block).T))
+		return spill_filename
 
 	@staticmethod
-	def column_writer(filename, batch_size=10000, silent=False):
+	def column_writer(filename, batch_size=10000, silent=False, memory_budget=256*1024*1024):
 		'''
 		Saves to file column by column.
 		It is implemented as a generator
-		If this method consumes too much memory, try lowering the batch_size    
+		Every 'batch_size' records are transposed and saved once in a temporary .npy file.
+		When the generator receives None, these files are merged (memory mapped) in a single pass.
+		If this method consumes too much memory, try lowering the batch_size or the memory_budget
+		memory_budget: Approximate number of bytes to keep in memory while merging
 		To suppress output set silent=True
 
 		Example:
@@ -851,82 +2077,1545 @@ class bioinformatics_file_helper:
 		g.send(None)
 		'''
 
-		old_temp_filename = None
-		finished = False
-		while not finished:
-			current_batch = []
-			for current_record in range(batch_size):
-				data = (yield True)
-				if not data:
-					finished = True
+		scratch_dir = tempfile.mkdtemp()
+		try:
+			spills = []
+			finished = False
+			while not finished:
+				current_batch = []
+				for current_record in range(batch_size):
+					data = (yield True)
+					if not data:
+						finished = True
+						break
+					current_batch += [data]
+
+				if current_batch:
+					spills += [bioinformatics_file_helper.spill_transposed(current_batch, scratch_dir, len(spills))]
+					if not silent:
+						print 'Created: ', spills[-1]
+
+			spills = [numpy.load(spill, mmap_mode='r') for spill in spills]
+			if len(set([spill.shape[0] for spill in spills])) > 1:
+				raise Exception('All records should have the same length')
+
+			write_to = bioinformatics_file_helper.open_file_write(filename)
+			if spills:
+				lines = spills[0].shape[0]
+				record_bytes = sum([spill.shape[1] * spill.dtype.itemsize for spill in spills])
+				lines_per_batch = max(1, memory_budget / (2 * record_bytes))
+				for start_line in range(0, lines, lines_per_batch):
+					merged = numpy.concatenate([spill[start_line:start_line+lines_per_batch] for spill in spills], axis=1)
+					write_to.write(''.join(['\t'.join(line) + '\n' for line in merged.tolist()]))
+			spills = None
+
+			if type(filename) is str:
+				write_to.close()
+				if not silent:
+					print 'Saved: ', filename
+
+		finally:
+			shutil.rmtree(scratch_dir)
+			if not silent:
+				print 'Deleted: ', scratch_dir
+
+		yield False
+
+	@staticmethod
+	def position_reader(filename, column, header=False):
+		'''
+		filename: a filename or open file
+		column: the (0-based) column of the positions. For example 1 for impute2 legend files, 2 for SHAPEIT haps files, 3 for plink map files
+		header: if True the first line is skipped
+		Returns a numpy array with the positions
+		'''
+
+		read_from = bioinformatics_file_helper.open_file_read(filename)
+		if header:
+			read_from.readline()
+
+		positions = numpy.fromiter((int(l.split(None, column + 1)[column]) for l in read_from if l.strip()), dtype=numpy.int64)
+
+		if type(filename) is str:
+			read_from.close()
+
+		return positions
+
+	@staticmethod
+	def region_reader(filename):
+		'''
+		filename: a BED file of regions (it can be gzipped). Lines that start with #, track or browser are skipped
+		Returns a dictionary: chromosome -> list of (from, to) 1-based, inclusive intervals. The chr prefix of chromosome names is removed
+		'''
+
+		regions = {}
+		read_from = bioinformatics_file_helper.open_file_read(filename)
+		for line_index, l in enumerate(read_from):
+			s = l.split()
+			if not s or s[0].startswith('#') or s[0] in ['track', 'browser']:
+				continue
+			if len(s) < 3 or not s[1].isdigit() or not s[2].isdigit() or int(s[1]) >= int(s[2]):
+				raise Exception('Line %i of %s is not a valid BED region: %s' % (line_index + 1, filename, l.strip()))
+
+			chromosome = s[0][3:] if s[0].lower().startswith('chr') else s[0]
+			regions.setdefault(chromosome, []).append((int(s[1]) + 1, int(s[2])))
+
+		if type(filename) is str:
+			read_from.close()
+
+		return regions
+
+	@staticmethod
+	def path_splitter(path):
+		'''
+		http://stackoverflow.com/questions/3167154/how-to-split-a-dos-path-into-its-components-in-python
+		'''
+
+		folders=[]
+		while True:
+			path,folder=os.path.split(path)
+
+			if folder!="":
+				folders.append(folder)
+			else:
+				if path!="":
+ 					folders.append(path)
+
+        			break
+
+		folders.reverse()
+		return folders
+
+
+import os
+import io
+import gzip
+import json
+import itertools
+
+class Binary_reference:
+	'''
+	A binary, memory mapped copy of one chromosome of an impute2 reference panel (haps and legend files).
+	For a haps file chr1.haps.gz the following files are created:
+		chr1.haps.gz.bits.npy : The haplotypes as a (variants x haplotypes/8) uint8 array. 8 haplotypes per byte (numpy.packbits)
+		chr1.haps.gz.legend.npy : The legend as a structured array with fields: ID, pos, allele0, allele1
+		chr1.haps.gz.binary.json : Number of variants and haplotypes and the size and modification time of the haps and legend files 
+
+	Reading a genomic window is a binary search in the positions and a slice of the memory mapped arrays.
+	'''
+
+	suffixes = {
+		'bits' : '.bits.npy',
+		'legend' : '.legend.npy',
+		'info' : '.binary.json',
+	}
+
+	def __init__(self, haps_filename):
+		'''
+		haps_filename: The haps file that was used to build the binary reference
+		'''
+
+		with open(haps_filename + self.suffixes['info']) as info_file:
+			self.info = json.load(info_file)
+
+		self.haplotypes = self.info['haplotypes']
+		self.bits = numpy.load(haps_filename + self.suffixes['bits'], mmap_mode='r')
+		self.legend = numpy.load(haps_filename + self.suffixes['legend'], mmap_mode='r')
+
+	def window(self, from_pos, to_pos):
+		'''
+		Returns the variants with from_pos <= position <= to_pos
+		Returns a tuple: (legend, haplotypes). legend is a structured array. haplotypes is a (variants x haplotypes) uint8 array of 0s and 1s
+		'''
+
+		start = numpy.searchsorted(self.legend['pos'], from_pos, 'left')
+		end = numpy.searchsorted(self.legend['pos'], to_pos, 'right')
+
+		return numpy.array(self.legend[start:end]), numpy.unpackbits(self.bits[start:end], axis=1)[:, :self.haplotypes]
+
+	@staticmethod
+	def files_info(haps_filename, legend_filename):
+		'''
+		Size and modification time of the files that a binary reference is built from
+		'''
+
+		return {os.path.split(x)[1] : [os.path.getsize(x), int(os.path.getmtime(x))] for x in [haps_filename, legend_filename]}
+
+	@staticmethod
+	def is_built(haps_filename, legend_filename):
+		'''
+		Returns True if a binary reference exists and it is built from the current haps and legend files
+		'''
+
+		info_filename = haps_filename + Binary_reference.suffixes['info']
+		if not os.path.isfile(info_filename):
+			return False
+
+		with open(info_filename) as info_file:
+			info = json.load(info_file)
+
+		return info.get('files') == Binary_reference.files_info(haps_filename, legend_filename)
+
+def build_binary_reference(haps_filename, legend_filename, block_size=1000):
+	'''
+	Builds the binary reference (see: Binary_reference) of a haps and legend file pair. The files can be gzipped.
+	The legend is read twice. Once to get the number of variants and the width of the fields, and once to fill the arrays.
+	Only haps files with 0 and 1 alleles are supported.
+	'''
+
+	def open_input(filename):
+		if filename.endswith('.gz'):
+			return Compressed_io.open_read(filename)
+		return open(filename)
+
+	print 'Building binary reference for: %s' % haps_filename
+
+	#First pass on legend
+	variants = 0
+	widths = [1, 1, 1]
+	with open_input(legend_filename) as legend_file:
+		legend_file.readline()
+		for l in legend_file:
+			s = l.split()
+			widths = [max(widths[0], len(s[0])), max(widths[1], len(s[2])), max(widths[2], len(s[3]))]
+			variants += 1
+
+	with open_input(haps_filename) as haps_file:
+		haplotypes = len(haps_file.readline().split())
+
+	legend_dtype = [('ID', 'S%i' % widths[0]), ('pos', numpy.int64), ('allele0', 'S%i' % widths[1]), ('allele1', 'S%i' % widths[2])]
+	bits = numpy.lib.format.open_memmap(haps_filename + Binary_reference.suffixes['bits'], mode='w+', dtype=numpy.uint8, shape=(variants, (haplotypes + 7) / 8))
+	legend = numpy.lib.format.open_memmap(haps_filename + Binary_reference.suffixes['legend'], mode='w+', dtype=legend_dtype, shape=(variants,))
+
+	try:
+		haps_file = open_input(haps_filename)
+		legend_file = open_input(legend_filename)
+		legend_file.readline()
+
+		variant = 0
+		while True:
+			haps_lines = list(itertools.islice(haps_file, block_size))
+			if not haps_lines:
+				break
+
+			if variant + len(haps_lines) > variants:
+				raise Exception('File %s has more lines than %s' % (haps_filename, legend_filename))
+
+			codes = impute2_haps_block_encoder(haps_lines)
+			if codes is None:
+				#Alleles with more than one character are encoded as 0, so that they are rejected below
+				rows = [[ord(x) if len(x) == 1 else 0 for x in l.split()] for l in haps_lines]
+				if any(len(row) != haplotypes for row in rows):
+					raise Exception('File %s has lines with different number of haplotypes' % haps_filename)
+				codes = numpy.array(rows, dtype=numpy.uint8)
+
+			if codes.shape[1] != haplotypes or ((codes != ord('0')) & (codes != ord('1'))).any():
+				raise Exception('File %s has lines with different number of haplotypes or alleles other than 0 and 1' % haps_filename)
+
+			bits[variant:variant+len(haps_lines)] = numpy.packbits(codes - ord('0'), axis=1)
+			legend[variant:variant+len(haps_lines)] = [(s[0], int(s[1]), s[2], s[3]) for s in [legend_file.readline().split() for x in haps_lines]]
+			variant += len(haps_lines)
+
+		haps_file.close()
+		legend_file.close()
+
+		if variant != variants:
+			raise Exception('File %s has less lines than %s' % (haps_filename, legend_filename))
+
+		if (numpy.diff(legend['pos']) < 0).any():
+			raise Exception('Positions in %s are not sorted' % legend_filename)
+
+	except Exception:
+		del bits, legend
+		os.remove(haps_filename + Binary_reference.suffixes['bits'])
+		os.remove(haps_filename + Binary_reference.suffixes['legend'])
+		raise
+
+	bits.flush()
+	legend.flush()
+
+	with open(haps_filename + Binary_reference.suffixes['info'], 'w') as info_file:
+		json.dump({'variants' : variants, 'haplotypes' : haplotypes, 'files' : Binary_reference.files_info(haps_filename, legend_filename)}, info_file)
+
+	print 'Binary reference: %i variants, %i haplotypes, %.1f MB' % (variants, haplotypes, (bits.nbytes + legend.nbytes) / 1024.0 / 1024.0)
+
+
+
+import os
+import json
+import hashlib
+import itertools
+
+class Reference_cache:
+	'''
+	A local cache of genomic windows (slices) of impute2 reference panels.
+	A slice is a pair of gzipped haps and legend files with the reference variants of one window of a chromosome.
+	impute2 jobs read these instead of the full haps and legend files of the chromosome.
+
+	The name of a slice has a hash of the window and of the path, size and modification time of the reference files,
+	so slices of reference files that have changed are not used again.
+	The modification time of a slice is the time that it was last used. If the size of the cache is more than max_size (bytes)
+	the least recently used slices are removed (see: evict). A cache directory should not be shared by runs that submit jobs at the same time.
+	'''
+
+	haps_suffix = '.haps.gz'
+	legend_suffix = '.legend.gz'
+
+	def __init__(self, directory, max_size=None):
+		self.directory = directory
+		self.max_size = max_size
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+
+	def slice_filenames(self, chromosome, haps_filename, legend_filename, from_pos, to_pos):
+		'''
+		Returns the haps and legend filenames of the slice of a window
+		'''
+
+		key = json.dumps([[os.path.abspath(x), os.path.getsize(x), int(os.path.getmtime(x))] for x in [haps_filename, legend_filename]] + [from_pos, to_pos])
+		prefix = os.path.join(self.directory, 'chr%s_%i-%i_%s' % (chromosome, from_pos, to_pos, hashlib.sha1(key).hexdigest()[:12]))
+		return prefix + self.haps_suffix, prefix + self.legend_suffix
+
+	def is_cached(self, slice_filenames):
+		return all(os.path.isfile(x) for x in slice_filenames)
+
+	def touch(self, slice_filenames):
+		'''
+		Marks a slice as used now
+		'''
+
+		for filename in slice_filenames:
+			os.utime(filename, None)
+
+	def build_slices(self, haps_filename, legend_filename, windows):
+		'''
+		Creates the slices of the windows of a chromosome. windows: a list of (from, to, haps slice filename, legend slice filename)
+		The legend file is read once and the header and every line are copied to the slices of the windows that contain it.
+		The haplotypes of the windows are read from the binary reference (see: Binary_reference) if it is built. 
+		Otherwise the haps file is read together with the legend file. Both ways create the same slices.
+		Every slice is written to temporary files that are renamed at the end. The legend file is the last one.
+		'''
+
+		print 'Building %i reference slices of: %s' % (len(windows), haps_filename)
+		outputs = []
+		for from_pos, to_pos, haps_slice, legend_slice in windows:
+			outputs.append((from_pos, to_pos, Compressed_io.open_write(haps_slice + '.tmp'), Compressed_io.open_write(legend_slice + '.tmp')))
+
+		try:
+			binary_reference = Binary_reference(haps_filename) if Binary_reference.is_built(haps_filename, legend_filename) else None
+			haps_input = None if binary_reference else bioinformatics_file_helper.open_file_read(haps_filename)
+			legend_input = bioinformatics_file_helper.open_file_read(legend_filename)
+			header = legend_input.readline()
+			for from_pos, to_pos, haps_file, legend_file in outputs:
+				legend_file.write(header)
+
+			last_to_pos = max(x[1] for x in outputs)
+			while True:
+				legend_lines = list(itertools.islice(legend_input, 10000))
+				if not legend_lines:
+					break
+				if haps_input:
+					haps_lines = list(itertools.islice(haps_input, len(legend_lines)))
+					if len(haps_lines) != len(legend_lines):
+						raise Exception('File %s has less lines than %s' % (haps_filename, legend_filename))
+
+				positions = numpy.array([int(l.split(None, 2)[1]) for l in legend_lines], dtype=numpy.int64)
+				for from_pos, to_pos, haps_file, legend_file in outputs:
+					selected = numpy.flatnonzero((positions >= from_pos) & (positions <= to_pos))
+					legend_file.write(''.join([legend_lines[x] for x in selected]))
+					if haps_input:
+						haps_file.write(''.join([haps_lines[x] for x in selected]))
+
+				if positions[-1] > last_to_pos:
 					break
-				current_batch += [data]
 
-			if current_batch:
-				current_batch_transposed = numpy.transpose(current_batch)
+			if haps_input:
+				bioinformatics_file_helper.close_file(haps_input)
+			bioinformatics_file_helper.close_file(legend_input)
+
+			if binary_reference:
+				for from_pos, to_pos, haps_file, legend_file in outputs:
+					haplotypes = binary_reference.window(from_pos, to_pos)[1]
+					text = numpy.empty((haplotypes.shape[0], 2 * haplotypes.shape[1]), dtype=numpy.uint8)
+					text[:, 0::2] = haplotypes + ord('0')
+					text[:, 1::2] = ord(' ')
+					text[:, -1:] = ord('\n')
+					haps_file.write(text.tostring())
+
+		except:
+			for (from_pos, to_pos, haps_slice, legend_slice), (from_pos, to_pos, haps_file, legend_file) in zip(windows, outputs):
+				haps_file.close()
+				legend_file.close()
+				os.remove(haps_slice + '.tmp')
+				os.remove(legend_slice + '.tmp')
+			raise
+
+		for (from_pos, to_pos, haps_slice, legend_slice), (from_pos, to_pos, haps_file, legend_file) in zip(windows, outputs):
+			haps_file.close()
+			legend_file.close()
+			os.rename(haps_slice + '.tmp', haps_slice)
+			os.rename(legend_slice + '.tmp', legend_slice)
+
+	def evict(self, keep):
+		'''
+		Removes the least recently used slices until the size of the cache is at most max_size.
+		keep: a list of slice filenames that are not removed (the slices of the current run)
+		Returns the size of the cache (bytes)
+		'''
+
+		keep = set(os.path.abspath(x) for x in keep)
+		slices = {}
+		for filename in os.listdir(self.directory):
+			for suffix in [self.haps_suffix, self.legend_suffix]:
+				if filename.endswith(suffix):
+					path = os.path.join(self.directory, filename)
+					stat = os.stat(path)
+					size, mtime, paths = slices.get(filename[:-len(suffix)], (0, 0, []))
+					slices[filename[:-len(suffix)]] = (size + stat.st_size, max(mtime, stat.st_mtime), paths + [path])
+
+		total = sum(x[0] for x in slices.values())
+		if self.max_size is None:
+			return total
+
+		removed = 0
+		for name, (size, mtime, paths) in sorted(slices.iteritems(), key=lambda x : x[1][1]):
+			if total <= self.max_size:
+				break
+			if any(os.path.abspath(x) in keep for x in paths):
+				continue
+			for path in paths:
+				os.remove(path)
+			total -= size
+			removed += 1
+
+		if removed:
+			print 'Removed %i least recently used reference slices from: %s' % (removed, self.directory)
+		if total > self.max_size:
+			print 'Warning: The reference slices of this run (%.1f MB) do not fit in the reference cache size (%.1f MB)' % (total / 1024.0 / 1024.0, self.max_size / 1024.0 / 1024.0)
+
+		return total
 
-				new_temp_file = tempfile.NamedTemporaryFile(delete=False)
-				if not silent:
-					print 'Created: ', new_temp_file.name
 
-				if old_temp_filename:
-					old_temp_generator = line_generator(old_temp_filename)
-					for line in current_batch_transposed:
-						line_writer(new_temp_file, old_temp_generator.next()[1] + list(line))
 
-					#Close old_temp_file
-					for line in old_temp_generator:
-						pass
+import os
+import numpy
+
+class Packed_genotypes:
+	'''
+	The genotypes of a study panel with 2 bits per genotype, in the SNP-major layout of PLINK .bed files.
+	Every SNP is a row of ceil(samples/4) bytes. Every byte has the genotypes of 4 samples, starting from the low bits.
+	Genotype codes: 0 : homozygous allele1, 1 : missing, 2 : heterozygous, 3 : homozygous allele2
+	allele1 is the minor allele. It is '0' for monomorphic SNPs.
+
+	packed : (SNPs x ceil(samples/4)) uint8 array
+	allele1, allele2 : The alleles of every SNP (the allele lookup table)
+	snps : (chromosome, SNP id, genetic distance, position) of every SNP. The columns of a MAP file
+	samples : (family id, individual id, paternal id, maternal id, sex, phenotype) of every sample. The columns of a FAM file
+	'''
+
+	bed_magic = '\x6c\x1b\x01'
+	missing_allele = '0'
+	#Swaps homozygous allele1 with homozygous allele2
+	swap_codes = numpy.array([3, 1, 2, 0], dtype=numpy.uint8)
+	#Copies of allele1 in every genotype code. -1 is missing
+	allele1_copies = numpy.array([2, -1, 1, 0], dtype=numpy.int8)
+
+	def __init__(self, packed, allele1, allele2, snps, samples):
+		self.packed = packed
+		self.allele1 = allele1
+		self.allele2 = allele2
+		self.snps = snps
+		self.samples = samples
+
+	@staticmethod
+	def pack(codes):
+		'''
+		codes: (rows x columns) array of 2-bit genotype codes
+		Returns a (rows x ceil(columns/4)) uint8 array with 4 codes per byte, starting from the low bits. Padding bits are 0
+		'''
+
+		rows, columns = codes.shape
+		padded = numpy.zeros((rows, (columns + 3) / 4 * 4), dtype=numpy.uint8)
+		padded[:, :columns] = codes
+		padded = padded.reshape(rows, -1, 4)
+		return padded[:, :, 0] | (padded[:, :, 1] << 2) | (padded[:, :, 2] << 4) | (padded[:, :, 3] << 6)
+
+	@staticmethod
+	def unpack(packed, columns):
+		'''
+		The opposite of pack. Returns a (rows x columns) uint8 array of 2-bit genotype codes
+		'''
+
+		codes = numpy.empty(packed.shape + (4,), dtype=numpy.uint8)
+		for shift in range(4):
+			codes[:, :, shift] = (packed >> (2 * shift)) & 3
+		return codes.reshape(packed.shape[0], -1)[:, :columns]
+
+	def genotypes(self, from_snp=0, to_snp=None):
+		'''
+		Returns the genotypes of SNPs from_snp to to_snp as a (SNPs x samples) int8 array with the copies of allele1. Missing is -1
+		'''
+
+		return self.allele1_copies[self.unpack(self.packed[from_snp:to_snp], len(self.samples))]
+
+	def snp_blocks(self, block_size=10000):
+		'''
+		Generator of (first SNP, genotypes) of blocks of block_size SNPs (see: genotypes)
+		'''
+
+		for from_snp in range(0, len(self.snps), block_size):
+			yield from_snp, self.genotypes(from_snp, from_snp + block_size)
+
+	@staticmethod
+	def read_ped(ped_filename, map_filename, block_size=10000):
+		'''
+		Reads a PED / MAP file pair.
+		Every line (sample) of the PED file is parsed with numpy and saved as a packed row of a sample-major matrix.
+		The alleles of every SNP are collected while reading. Only SNPs with at most two alleles are supported.
+		The matrix is transposed to SNP-major in blocks of block_size SNPs.
+		SNPs with a negative position in the MAP file are excluded (as in PLINK). Genotypes with one missing allele are missing.
+		'''
+
+		snps = []
+		keep = []
+		with open(map_filename) as map_file:
+			for l in map_file:
+				s = l.split()
+				if not s:
+					continue
+				if len(s) == 3:
+					#MAP file without genetic distance
+					s = [s[0], s[1], '0', s[2]]
+				keep.append(int(s[3]) >= 0)
+				if keep[-1]:
+					snps.append(tuple(s[:4]))
+
+		all_snps = len(keep)
+		keep = numpy.array(keep, dtype=bool)
+		n_samples = bioinformatics_file_helper.line_counter(ped_filename) or 0
+		row_bytes = (len(snps) + 3) / 4
+
+		missing = ord(Packed_genotypes.missing_allele)
+		#Alleles with more than one character get the codes 128-255
+		long_alleles = {}
+		def allele_code(allele):
+			if len(allele) == 1 and ord(allele) < 128:
+				return ord(allele)
+			if not long_alleles.has_key(allele):
+				if len(long_alleles) == 128:
+					raise Exception('File %s has more than 128 alleles that are longer than one character' % ped_filename)
+				long_alleles[allele] = 128 + len(long_alleles)
+			return long_alleles[allele]
+
+		#The first (x) and second (y) allele of every SNP in the order that they are found. 0 is not found yet
+		x = numpy.zeros(len(snps), dtype=numpy.uint8)
+		y = numpy.zeros(len(snps), dtype=numpy.uint8)
+		sample_major = numpy.empty((n_samples, row_bytes), dtype=numpy.uint8)
+		samples = []
+
+		with open(ped_filename) as ped_file:
+			for line_index, l in enumerate(ped_file):
+				s = l.split(None, 6)
+				if len(s) < 6:
+					raise Exception('Line %i of %s has less than 6 columns' % (line_index + 1, ped_filename))
+				if line_index == n_samples:
+					raise Exception('File %s changed while reading' % ped_filename)
+				samples.append(tuple(s[:6]))
+
+				#Fast path: single character alleles separated by single white spaces
+				text = s[6].rstrip() if len(s) == 7 else ''
+				line_codes = numpy.frombuffer(text, dtype=numpy.uint8)
+				if len(line_codes) == 4 * all_snps - 1 and (line_codes[0::2] > 32).all() and (line_codes[1::2] <= 32).all():
+					line_codes = line_codes[0::2]
+				else:
+					line_codes = numpy.array([allele_code(allele) for allele in text.split()], dtype=numpy.uint8)
+
+				if len(line_codes) != 2 * all_snps:
+					raise Exception('Line %i of %s has %i alleles. Expected %i (two for every SNP in %s)' % (line_index + 1, ped_filename, len(line_codes), 2 * all_snps, map_filename))
+
+				a = line_codes[0::2][keep]
+				b = line_codes[1::2][keep]
+				for allele in [a, b]:
+					found = allele != missing
+					new = found & (x == 0)
+					x[new] = allele[new]
+					new = found & (allele != x) & (y == 0)
+					y[new] = allele[new]
+					other = found & (allele != x) & (allele != y)
+					if other.any():
+						raise Exception('SNP %s has more than two alleles (line %i of %s)' % (snps[numpy.flatnonzero(other)[0]][1], line_index + 1, ped_filename))
+
+				codes = numpy.where(a == y, 1, 0) + numpy.where(b == y, 1, 0)
+				#0 1 2 copies of y -> 0 2 3. Missing -> 1
+				codes = numpy.array([0, 2, 3], dtype=numpy.uint8)[codes]
+				codes[(a == missing) | (b == missing)] = 1
+				sample_major[line_index] = Packed_genotypes.pack(codes[numpy.newaxis, :])[0]
+
+		if len(samples) != n_samples:
+			raise Exception('File %s changed while reading' % ped_filename)
+
+		#Transpose to SNP-major. allele1 is the minor allele
+		names = {v : k for k, v in long_alleles.iteritems()}
+		names[0] = Packed_genotypes.missing_allele
+		allele_name = lambda code: names[code] if names.has_key(code) else chr(code)
+		allele1 = [allele_name(code) for code in x]
+		allele2 = [allele_name(code) for code in y]
+		packed = numpy.empty((len(snps), (n_samples + 3) / 4), dtype=numpy.uint8)
+		block_size = max(4, block_size / 4 * 4)
+		for from_snp in range(0, len(snps), block_size):
+			to_snp = min(from_snp + block_size, len(snps))
+			codes = Packed_genotypes.unpack(sample_major[:, from_snp / 4 : (to_snp + 3) / 4], to_snp - from_snp).T
+			x_copies = 2 * (codes == 0).sum(axis=1) + (codes == 2).sum(axis=1)
+			y_copies = 2 * (codes == 3).sum(axis=1) + (codes == 2).sum(axis=1)
+			swap = y_copies < x_copies
+			codes[swap] = Packed_genotypes.swap_codes[codes[swap]]
+			packed[from_snp:to_snp] = Packed_genotypes.pack(codes)
+			for snp in numpy.flatnonzero(swap) + from_snp:
+				allele1[snp], allele2[snp] = allele2[snp], allele1[snp]
+
+		return Packed_genotypes(packed, allele1, allele2, snps, samples)
+
+	@staticmethod
+	def read_bed(bed_filename):
+		'''
+		Reads a SNP-major PLINK .bed file and the .bim and .fam files with the same name. The genotypes are memory mapped
+		'''
+
+		prefix = os.path.splitext(bed_filename)[0]
+		with open(prefix + '.bim') as bim_file:
+			bim = [l.split() for l in bim_file if l.strip()]
+		with open(prefix + '.fam') as fam_file:
+			samples = [tuple(l.split()[:6]) for l in fam_file if l.strip()]
+		with open(bed_filename, 'rb') as bed_file:
+			if bed_file.read(3) != Packed_genotypes.bed_magic:
+				raise Exception('File %s is not a SNP-major PLINK .bed file' % bed_filename)
+
+		shape = (len(bim), (len(samples) + 3) / 4)
+		if os.path.getsize(bed_filename) != 3 + shape[0] * shape[1]:
+			raise Exception('The size of %s does not match the number of SNPs and samples in the .bim and .fam files' % bed_filename)
+		packed = numpy.memmap(bed_filename, dtype=numpy.uint8, mode='r', offset=3, shape=shape) if shape[0] * shape[1] else numpy.zeros(shape, dtype=numpy.uint8)
+
+		return Packed_genotypes(packed, [s[4] for s in bim], [s[5] for s in bim], [tuple(s[:4]) for s in bim], samples)
+
+	def write_bed(self, bed_filename):
+		'''
+		Saves the genotypes as PLINK binary files: bed_filename and the .bim and .fam files with the same name.
+		Every file is written to a temporary file and renamed. The .fam file is the last one.
+		'''
+
+		prefix = os.path.splitext(bed_filename)[0]
+
+		with open(bed_filename + '.tmp', 'wb') as bed_file:
+			bed_file.write(self.bed_magic)
+			self.packed.tofile(bed_file)
+		os.rename(bed_filename + '.tmp', bed_filename)
+
+		with open(prefix + '.bim.tmp', 'w') as bim_file:
+			for snp, allele1, allele2 in zip(self.snps, self.allele1, self.allele2):
+				bim_file.write('\t'.join(snp + (allele1, allele2)) + '\n')
+		os.rename(prefix + '.bim.tmp', prefix + '.bim')
+
+		with open(prefix + '.fam.tmp', 'w') as fam_file:
+			for sample in self.samples:
+				fam_file.write(' '.join(sample) + '\n')
+		os.rename(prefix + '.fam.tmp', prefix + '.fam')
+
+	@staticmethod
+	def is_converted(ped_filename, map_filename, bed_filename):
+		'''
+		Returns True if the PLINK binary files of bed_filename exist and are newer than the PED and MAP files
+		'''
+
+		fam_filename = os.path.splitext(bed_filename)[0] + '.fam'
+		if not all(os.path.isfile(x) for x in [bed_filename, os.path.splitext(bed_filename)[0] + '.bim', fam_filename]):
+			return False
+
+		return os.path.getmtime(fam_filename) >= max(os.path.getmtime(ped_filename), os.path.getmtime(map_filename))
+
+def convert_ped_to_bed(ped_filename, map_filename, bed_filename, block_size=10000):
+	'''
+	Converts a PED / MAP file pair to PLINK binary files (see: Packed_genotypes)
+	'''
+
+	print 'Converting %s to %s' % (ped_filename, bed_filename)
+	genotypes = Packed_genotypes.read_ped(ped_filename, map_filename, block_size)
+	genotypes.write_bed(bed_filename)
+	print 'PLINK binary files: %i SNPs, %i samples, %.1f MB' % (len(genotypes.snps), len(genotypes.samples), genotypes.packed.nbytes / 1024.0 / 1024.0)
+
+
+
+import os
+import json
+import string
+import numpy
+
+class Chain_index:
+	'''
+	The aligned blocks of a UCSC chain file (the input of liftOver) as sorted numpy arrays.
+	Every position of the source assembly has a 64-bit key: chromosome index << 32 | 0-based position.
+	Mapping a batch of positions is a binary search of their keys in the starts of the blocks.
+	Chromosome names are normalized (see: chromosome_name), so chr1 in the chain file matches 1 in a MAP file.
+	A source position in more than one block (overlapping chains) is not mapped, like the 'Duplicated in new' positions of liftOver.
+
+	The index of hg18ToHg19.over.chain is cached in hg18ToHg19.over.chain.index.npz, together with the size and modification time of the chain file.
+	'''
+
+	index_suffix = '.index.npz'
+	#PLINK chromosome codes
+	plink_chromosomes = {'23' : 'X', '24' : 'Y', '25' : 'X', '26' : 'M', 'XY' : 'X', 'MT' : 'M'}
+	arrays = ['starts', 'ends', 'targets', 'target_starts', 'reverse', 'target_sizes', 'sources', 'target_names', 'duplicated_starts', 'duplicated_ends']
+
+	def __init__(self, chain_filename):
+		'''
+		Loads the cached index of chain_filename, or builds it if the chain file has changed (see: parse)
+		'''
+
+		index = self.load(chain_filename)
+		if index is None:
+			index = self.parse(chain_filename)
+			self.save(chain_filename, index)
+
+		for name in self.arrays:
+			setattr(self, name, index[name])
+
+	@staticmethod
+	def chromosome_name(name):
+		'''
+		Chromosome name without the chr prefix. PLINK codes are converted to letters (23 -> X)
+		'''
+
+		if name[:3].lower() == 'chr':
+			name = name[3:]
+		return Chain_index.plink_chromosomes.get(name.upper(), name)
+
+	@staticmethod
+	def files_info(chain_filename):
+		return [os.path.getsize(chain_filename), int(os.path.getmtime(chain_filename))]
+
+	@staticmethod
+	def load(chain_filename):
+		'''
+		Returns the cached index of chain_filename, or None if it does not exist or the chain file has changed
+		'''
+
+		index_filename = chain_filename + Chain_index.index_suffix
+		if not os.path.isfile(index_filename):
+			return None
+
+		try:
+			index = numpy.load(index_filename)
+			if json.loads(str(index['files'])) != Chain_index.files_info(chain_filename):
+				return None
+			return {name : index[name] for name in Chain_index.arrays}
+		except (IOError, ValueError, KeyError):
+			print 'Warning: Could not read: %s' % index_filename
+			return None
+
+	@staticmethod
+	def save(chain_filename, index):
+		'''
+		Saves the index next to the chain file. A chain file in a read only directory is parsed every time
+		'''
+
+		index_filename = chain_filename + Chain_index.index_suffix
+		try:
+			with open(index_filename + '.tmp', 'wb') as index_file:
+				numpy.savez(index_file, files=numpy.array(json.dumps(Chain_index.files_info(chain_filename))), **index)
+			os.rename(index_filename + '.tmp', index_filename)
+		except (IOError, OSError):
+			print 'Warning: Could not save: %s' % index_filename
+
+	@staticmethod
+	def parse(chain_filename):
+		'''
+		Reads the aligned blocks of a chain file (it can be gzipped). Returns a dictionary with the arrays of the index
+		Format: https://genome.ucsc.edu/goldenPath/help/chain.html
+		'''
+
+		print 'Building chain index for: %s' % chain_filename
+
+		sources = {}
+		targets = {}
+		target_sizes = []
+		#source chromosome, source start, size, target chromosome, target start, reverse
+		blocks = []
+
+		chain_file = Compressed_io.open_read(chain_filename) if chain_filename.endswith('.gz') else open(chain_filename)
+		with chain_file:
+			for line_index, l in enumerate(chain_file):
+				s = l.split()
+				if not s or s[0][0] == '#':
+					continue
+
+				if s[0] == 'chain':
+					if len(s) < 12 or s[4] != '+':
+						raise Exception('Line %i of %s: Unsupported chain header' % (line_index + 1, chain_filename))
+					source = sources.setdefault(Chain_index.chromosome_name(s[2]), len(sources))
+					target = targets.setdefault(Chain_index.chromosome_name(s[7]), len(targets))
+					if target == len(target_sizes):
+						target_sizes.append(int(s[8]))
+					reverse = int(s[9] == '-')
+					source_pos = int(s[5])
+					target_pos = int(s[10])
+					continue
+
+				size = int(s[0])
+				blocks.append((source, source_pos, size, target, target_pos, reverse))
+				if len(s) == 3:
+					source_pos += size + int(s[1])
+					target_pos += size + int(s[2])
+
+		if not blocks:
+			raise Exception('Could not find any aligned blocks in %s' % chain_filename)
+
+		blocks = numpy.array(blocks, dtype=numpy.int64)
+		starts = (blocks[:, 0] << 32) | blocks[:, 1]
+		order = numpy.argsort(starts, kind='mergesort')
+		blocks = blocks[order]
+		starts = starts[order]
+		ends = starts + blocks[:, 2]
+
+		#Remove the parts of every block that are covered by the blocks before it
+		covered = numpy.maximum.accumulate(numpy.concatenate([starts[:1], ends[:-1]]))
+		trimmed = numpy.maximum(starts, covered)
+		keep = trimmed < ends
+
+		#These parts are in more than one block. Intervals sorted by start, with the maximum end of the intervals up to each one (see: duplicated)
+		duplicated = covered > starts
+		duplicated_starts = starts[duplicated]
+		duplicated_ends = numpy.maximum.accumulate(numpy.minimum(ends, covered)[duplicated]) if duplicated.any() else numpy.zeros(0, dtype=numpy.int64)
+
+		print 'Chain index: %i blocks, %i source and %i target chromosomes, %i overlaps' % (keep.sum(), len(sources), len(targets), duplicated.sum())
+
+		return {
+			'starts' : trimmed[keep],
+			'ends' : ends[keep],
+			'targets' : blocks[keep, 3],
+			'target_starts' : (blocks[:, 4] + trimmed - starts)[keep],
+			'reverse' : blocks[keep, 5].astype(bool),
+			'target_sizes' : numpy.array(target_sizes, dtype=numpy.int64),
+			'sources' : numpy.array(sorted(sources, key=sources.get), dtype=str),
+			'target_names' : numpy.array(sorted(targets, key=targets.get), dtype=str),
+			'duplicated_starts' : duplicated_starts,
+			'duplicated_ends' : duplicated_ends,
+		}
+
+	def duplicated(self, keys):
+		'''
+		Returns a boolean array that is True for the keys (see: map) of positions that are in more than one block
+		'''
+
+		if not len(self.duplicated_starts):
+			return numpy.zeros(len(keys), dtype=bool)
+
+		interval = numpy.searchsorted(self.duplicated_starts, keys, 'right') - 1
+		return (interval >= 0) & (keys < self.duplicated_ends[numpy.maximum(interval, 0)])
+
+	def map(self, chromosomes, positions):
+		'''
+		chromosomes: chromosome names in the source assembly. positions: 1-based positions in the source assembly
+		Returns a tuple of arrays: (chromosome, 1-based position, reverse strand, mapped) in the target assembly
+		Positions in more than one block are not mapped (see: duplicated)
+		Chromosome names of the target assembly are normalized (see: chromosome_name)
+		'''
+
+		positions = numpy.asarray(positions, dtype=numpy.int64)
+		names, inverse = numpy.unique(numpy.asarray(chromosomes, dtype=str), return_inverse=True)
+		source_index = {name : index for index, name in enumerate(self.sources)}
+		codes = numpy.array([source_index.get(self.chromosome_name(name), -1) for name in names], dtype=numpy.int64)[inverse]
+
+		keys = (codes << 32) | (positions - 1)
+		block = numpy.searchsorted(self.starts, keys, 'right') - 1
+		mapped = (codes >= 0) & (positions > 0) & (block >= 0)
+		block[~mapped] = 0
+		mapped &= keys < self.ends[block]
+		mapped &= ~self.duplicated(keys)
+
+		targets = self.targets[block]
+		target_positions = self.target_starts[block] + keys - self.starts[block]
+		reverse = self.reverse[block]
+		#Positions on the reverse strand are counted from the end of the target chromosome
+		target_positions = numpy.where(reverse, self.target_sizes[targets] - 1 - target_positions, target_positions)
+
+		return self.target_names[targets], target_positions + 1, reverse & mapped, mapped
+
+#Complement of the alleles of markers that are lifted over to the reverse strand
+complement_alleles = string.maketrans('ACGTacgt', 'TGCAtgca')
+
+def liftover_plink(input_filename, chain_filename, bed_filename):
+	'''
+	Lifts over a study panel to a new assembly with a chain file (see: Chain_index).
+	input_filename is a .ped file (with a .map file) or a .bed file (with .bim and .fam files).
+	The output is in PLINK binary format, sorted by the new positions (see: Packed_genotypes).
+	Alleles of markers that map to the reverse strand are complemented.
+	Markers that are not in the chain file or that map to another chromosome are removed.
+	Unmapped and strand flipped markers are reported in a tab separated file with the name of bed_filename and extension .liftover.txt
+	'''
+
+	print 'Lifting over %s with %s' % (input_filename, chain_filename)
+
+	prefix = os.path.splitext(input_filename)[0]
+	if input_filename.endswith('.bed'):
+		genotypes = Packed_genotypes.read_bed(input_filename)
+	else:
+		genotypes = Packed_genotypes.read_ped(input_filename, prefix + '.map')
+
+	chain_index = Chain_index(chain_filename)
+	chromosomes = [snp[0] for snp in genotypes.snps]
+	positions = [int(snp[3]) for snp in genotypes.snps]
+	new_chromosomes, new_positions, reverse, mapped = chain_index.map(chromosomes, positions)
+
+	same_chromosome = numpy.array([Chain_index.chromosome_name(x) for x in chromosomes], dtype=str) == new_chromosomes
+	keep = numpy.flatnonzero(mapped & same_chromosome)
+	keep = keep[numpy.argsort(new_positions[keep], kind='mergesort')]
+
+	report_filename = os.path.splitext(bed_filename)[0] + '.liftover.txt'
+	with open(report_filename, 'w') as report_file:
+		report_file.write('SNP\tchromosome\tposition\tnew_chromosome\tnew_position\tstatus\n')
+		for snp in numpy.flatnonzero(~mapped | ~same_chromosome | reverse):
+			if not mapped[snp]:
+				new, status = ['-', '-'], 'unmapped'
+			else:
+				new, status = [new_chromosomes[snp], str(new_positions[snp])], 'strand_flip' if same_chromosome[snp] else 'other_chromosome'
+			report_file.write('\t'.join([genotypes.snps[snp][1], chromosomes[snp], str(positions[snp])] + new + [status]) + '\n')
+
+	lifted = Packed_genotypes(
+		numpy.asarray(genotypes.packed)[keep],
+		[genotypes.allele1[snp].translate(complement_alleles) if reverse[snp] else genotypes.allele1[snp] for snp in keep],
+		[genotypes.allele2[snp].translate(complement_alleles) if reverse[snp] else genotypes.allele2[snp] for snp in keep],
+		[genotypes.snps[snp][:3] + (str(new_positions[snp]),) for snp in keep],
+		genotypes.samples)
+	lifted.write_bed(bed_filename)
+
+	print 'Liftover: %i markers, %i unmapped, %i mapped to other chromosomes, %i strand flipped. Report: %s' % (
+		len(positions), (~mapped).sum(), (mapped & ~same_chromosome).sum(), (reverse & same_chromosome).sum(), report_filename)
+
+
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+class Run_state:
+	'''
+	The state of the imputation jobs of an output directory. Saved in a SQLite database in this directory.
+	Every job has a key (for example chr1:1-5000000:1-500) and a hash of its inputs (see: input_hash).
+	A job is done if it was submitted with the same input hash, it has signaled success and its outputs exist.
+	Success is signaled by a file next to every output (see: done_suffix) that is created only after the job 
+	has exited without errors (see: impute2_output_check). Outputs alone are not enough, since a job that is 
+	still running or has failed may have written part of them.
+	The sizes of the outputs are saved when a job is found to be done, so that later changes (for example truncated files) are detected.
+	'''
+
+	filename = 'run_state.sqlite'
+	done_suffix = '.done'
+
+	def __init__(self, directory):
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+		self.connection = sqlite3.connect(os.path.join(directory, self.filename))
+		self.connection.execute('''CREATE TABLE IF NOT EXISTS jobs (
+			key TEXT PRIMARY KEY,
+			input_hash TEXT,
+			status TEXT,
+			outputs TEXT,
+			updated REAL
+		)''')
+		self.connection.commit()
+
+	@staticmethod
+	def input_hash(inputs):
+		'''
+		Returns a hash of inputs. inputs should be serializable to JSON
+		'''
+
+		return hashlib.md5(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+	def is_done(self, key, input_hash, outputs):
+		'''
+		Checks if the job with this key has finished with the same inputs and its outputs are valid
+		outputs: list of the output filenames of the job
+		'''
+
+		row = self.connection.execute('SELECT input_hash, status, outputs FROM jobs WHERE key = ?', (key,)).fetchone()
+		if not row or row[0] != input_hash:
+			return False
+
+		sizes = [os.path.getsize(output) if os.path.isfile(output) else None for output in outputs]
+		if row[1] == 'finished':
+			return sizes == json.loads(row[2])
+
+		if row[1] == 'submitted' and all(sizes) and all(os.path.isfile(output + self.done_suffix) for output in outputs):
+			#The job has finished successfully after it was submitted
+			self.connection.execute('UPDATE jobs SET status = ?, outputs = ?, updated = ? WHERE key = ?', ('finished', json.dumps(sizes), time.time(), key))
+			self.connection.commit()
+			return True
+
+		return False
+
+	def submitted(self, jobs):
+		'''
+		Saves that the jobs have been submitted
+		jobs: a list of (key, input hash, outputs) tuples
+		The success signals of previous runs of these jobs are removed, so that only the new run can signal success
+		'''
+
+		for key, input_hash, outputs in jobs:
+			for output in outputs:
+				if os.path.isfile(output + self.done_suffix):
+					os.remove(output + self.done_suffix)
+
+		self.connection.executemany('INSERT OR REPLACE INTO jobs (key, input_hash, status, outputs, updated) VALUES (?, ?, ?, ?, ?)', 
+			[(key, input_hash, 'submitted', None, time.time()) for key, input_hash, outputs in jobs])
+		self.connection.commit()
+
+	def close(self):
+		self.connection.close()
+
+
+
+import os
+import re
+import glob
+import heapq
+import itertools
+
+def impute2_output_finder(results, output_pattern, chromosome=None):
+	'''
+	Finds the outputs of the imputation jobs in the results directory.
+	output_pattern: the name of the output of a job with the fields: chr, fromChrPos, toChrPos, fromSample, toSample (see: Imputation.impute_output_pattern)
+	Returns a dictionary: chromosome -> sorted list of intervals: (from, to, [(from sample, to sample, filename), ...])
+	'''
+
+	fields = {'chr' : chromosome if chromosome else '*', 'fromChrPos' : '*', 'toChrPos' : '*', 'fromSample' : '*', 'toSample' : '*'}
+
+	#Regular expression of the output pattern. Escape everything except the fields
+	regex = ''
+	for index, piece in enumerate(re.split(r'%\((\w+)\)s', output_pattern)):
+		if index % 2:
+			regex += '(?P<%s>[^_/]+)' % piece if piece == 'chr' else '(?P<%s>\\d+)' % piece
+		else:
+			regex += re.escape(piece)
+	regex = re.compile(regex + '$')
+
+	ret = {}
+	for filename in glob.glob(os.path.join(results, output_pattern % fields)):
+		match = regex.match(os.path.basename(filename))
+		if not match:
+			continue
+		interval = (int(match.group('fromChrPos')), int(match.group('toChrPos')))
+		ret.setdefault(match.group('chr'), {}).setdefault(interval, []).append((int(match.group('fromSample')), int(match.group('toSample')), filename))
+
+	return {chromosome : [interval + (sorted(sample_chunks),) for interval, sample_chunks in sorted(intervals.iteritems())] for chromosome, intervals in ret.iteritems()}
+
+def impute2_output_check(output_filename):
+	'''
+	Checks that an imputation job that has exited without errors has created its output and signals its success (see: Run_state)
+	'''
+
+	if not os.path.isfile(output_filename):
+		raise Exception('Imputation job finished but its output does not exist: %s. If the pipeline names its output differently, set it with --impute_output_pattern' % output_filename)
+
+	open(output_filename + Run_state.done_suffix, 'w').close()
+
+def impute2_column_merger(sample_chunks):
+	'''
+	Merges the outputs (gen format) of the sample chunks of an interval column-wise.
+	sample_chunks: a list of (from sample, to sample, filename) sorted by sample
+	All files should have the same variants (the first 5 columns) in the same order.
+	Generates tuples: (position, line)
+	'''
+
+	files = [bioinformatics_file_helper.open_file_read(filename) for from_sample, to_sample, filename in sample_chunks]
+	try:
+		for line_index, lines in enumerate(itertools.izip_longest(*files)):
+			if None in lines:
+				raise Exception('Files have different number of lines: %s' % (', '.join([x[2] for x in sample_chunks])))
+
+			lines = [line.rstrip('\n').split(' ', 5) for line in lines]
+			variant = lines[0][:5]
+			for line, sample_chunk in zip(lines[1:], sample_chunks[1:]):
+				if line[:5] != variant:
+					raise Exception('Different variant in line %i of %s: %s (expected: %s)' % (line_index+1, sample_chunk[2], ' '.join(line[:5]), ' '.join(variant)))
+
+			yield int(variant[2]), ' '.join(variant + [line[5] for line in lines if len(line) == 6]) + '\n'
+	finally:
+		for f in files:
+			bioinformatics_file_helper.close_file(f)
+
+def merge_impute2_chromosome(results, chromosome, output_pattern, merged_filename):
+	'''
+	Merges the outputs of the imputation jobs of a chromosome in a single (compressed) file.
+	Sample chunks of each interval are merged column-wise (see: impute2_column_merger) and 
+	intervals are merged row-wise by position. Overlapping intervals are merged with a k-way merge,
+	so only the files of overlapping intervals are open at the same time.
+	Checks that the sample chunks of every interval cover the same samples.
+	'''
+
+	intervals = impute2_output_finder(results, output_pattern, chromosome).get(chromosome)
+	if not intervals:
+		raise Exception('Could not find any imputation output for chromosome %s in %s' % (chromosome, results))
+
+	samples = None
+	for from_pos, to_pos, sample_chunks in intervals:
+		expected_from_sample = 1
+		for from_sample, to_sample, filename in sample_chunks:
+			if from_sample != expected_from_sample:
+				raise Exception('Missing samples %i-%i in interval %s:%i-%i' % (expected_from_sample, from_sample - 1, chromosome, from_pos, to_pos))
+			expected_from_sample = to_sample + 1
+		if samples is None:
+			samples = expected_from_sample - 1
+		elif samples != expected_from_sample - 1:
+			raise Exception('Interval %s:%i-%i has %i samples instead of %i' % (chromosome, from_pos, to_pos, expected_from_sample - 1, samples))
+
+	#Groups of overlapping intervals
+	groups = []
+	for interval in intervals:
+		if groups and interval[0] <= max([x[1] for x in groups[-1]]):
+			groups[-1] += [interval]
+		else:
+			groups += [[interval]]
+
+	print 'Merging %i intervals of chromosome %s (%i samples) in: %s' % (len(intervals), chromosome, samples, merged_filename)
+
+	rows = 0
+	output_file = Compressed_io.open_write(merged_filename + '.tmp') if merged_filename.endswith('.gz') else open(merged_filename + '.tmp', 'w')
+	try:
+		for group in groups:
+			for position, line in heapq.merge(*[impute2_column_merger(sample_chunks) for from_pos, to_pos, sample_chunks in group]):
+				output_file.write(line)
+				rows += 1
+	except:
+		output_file.close()
+		os.remove(merged_filename + '.tmp')
+		raise
+	output_file.close()
+	os.rename(merged_filename + '.tmp', merged_filename)
+
+	print 'Merged chromosome %s: %i variants, %i samples' % (chromosome, rows, samples)
+
+
+
+import os
+import json
+import itertools
+
+class Binary_dosage:
+	'''
+	A binary, memory mapped copy of the imputed genotypes of one chromosome (a gen file, the output of impute2).
+	For a gen file chr1.impute2.gz the following files are created:
+		chr1.impute2.gz.variants.npy : The variants as a structured array with fields: SNP, rsid, pos, allele0, allele1. Sorted by position
+		chr1.impute2.gz.probabilities.npy : (format 'probabilities') The genotype probabilities as a (variants x samples x 3) uint16 array. 
+			Probabilities are quantized: 65535 is 1.0
+		chr1.impute2.gz.dosage.npy : (format 'dosage') The dosages of the second allele (P(AB) + 2*P(BB)) as a (variants x samples) float16 array. 
+			Missing genotypes (all probabilities 0) are NaN
+		chr1.impute2.gz.dosage.json : Format, number of variants and samples and the size and modification time of the gen file
+
+	Reading a genomic region is a binary search in the positions and a slice of the memory mapped arrays.
+	'''
+
+	suffixes = {
+		'variants' : '.variants.npy',
+		'probabilities' : '.probabilities.npy',
+		'dosage' : '.dosage.npy',
+		'info' : '.dosage.json',
+	}
+
+	formats = ['probabilities', 'dosage']
+
+	def __init__(self, gen_filename):
+		'''
+		gen_filename: The gen file that was used to build the binary dosage
+		'''
+
+		with open(gen_filename + self.suffixes['info']) as info_file:
+			self.info = json.load(info_file)
+
+		self.format = self.info['format']
+		self.samples = self.info['samples']
+		self.variants = numpy.load(gen_filename + self.suffixes['variants'], mmap_mode='r')
+		self.values = numpy.load(gen_filename + self.suffixes[self.format], mmap_mode='r')
+
+	def region(self, from_pos, to_pos):
+		'''
+		Returns the variants with from_pos <= position <= to_pos
+		Returns a tuple: (variants, values). variants is a structured array. 
+		values is a (variants x samples x 3) float32 array of probabilities (format 'probabilities')
+		or a (variants x samples) float32 array of dosages (format 'dosage')
+		'''
+
+		start = numpy.searchsorted(self.variants['pos'], from_pos, 'left')
+		end = numpy.searchsorted(self.variants['pos'], to_pos, 'right')
+
+		values = self.values[start:end]
+		if self.format == 'probabilities':
+			values = values.astype(numpy.float32) / 65535.0
+		else:
+			values = values.astype(numpy.float32)
+
+		return numpy.array(self.variants[start:end]), values
+
+	def dosages(self, from_pos, to_pos):
+		'''
+		Returns the dosages of the second allele of the variants with from_pos <= position <= to_pos (for both formats)
+		Returns a tuple: (variants, dosages). dosages is a (variants x samples) float32 array. Missing genotypes are NaN
+		'''
+
+		variants, values = self.region(from_pos, to_pos)
+		if self.format == 'probabilities':
+			missing = values.sum(axis=2) == 0
+			values = values[:, :, 1] + 2 * values[:, :, 2]
+			values[missing] = numpy.nan
+
+		return variants, values
+
+	@staticmethod
+	def is_built(gen_filename, output_format):
+		'''
+		Returns True if a binary dosage with this format exists and it is built from the current gen file
+		'''
+
+		info_filename = gen_filename + Binary_dosage.suffixes['info']
+		if not os.path.isfile(info_filename):
+			return False
+
+		with open(info_filename) as info_file:
+			info = json.load(info_file)
+
+		return info.get('format') == output_format and info.get('file') == [os.path.getsize(gen_filename), int(os.path.getmtime(gen_filename))]
+
+def build_binary_dosage(gen_filename, output_format='probabilities', block_size=1000):
+	'''
+	Builds the binary dosage (see: Binary_dosage) of a gen file. The file can be gzipped.
+	The file is read twice. Once to get the number of variants, samples and the width of the fields, and once to fill the arrays.
+	Every block of 'block_size' lines is parsed with numpy.
+	'''
+
+	if output_format not in Binary_dosage.formats:
+		raise Exception('Unknown binary dosage format: %s' % str(output_format))
+
+	if Binary_dosage.is_built(gen_filename, output_format):
+		print 'Binary dosage of %s is up to date' % gen_filename
+		return
+
+	def open_input(filename):
+		if filename.endswith('.gz'):
+			return Compressed_io.open_read(filename)
+		return open(filename)
+
+	print 'Building binary dosage (%s) for: %s' % (output_format, gen_filename)
+
+	#First pass
+	variants = 0
+	samples = None
+	widths = [1, 1, 1, 1]
+	with open_input(gen_filename) as gen_file:
+		for l in gen_file:
+			s = l.split(None, 5)
+			if samples is None:
+				samples = len(l.split()) - 5
+				if samples % 3:
+					raise Exception('File %s is not in gen format' % gen_filename)
+				samples /= 3
+			widths = [max(widths[0], len(s[0])), max(widths[1], len(s[1])), max(widths[2], len(s[3])), max(widths[3], len(s[4]))]
+			variants += 1
+
+	if not variants:
+		raise Exception('File %s is empty' % gen_filename)
+
+	variants_dtype = [('SNP', 'S%i' % widths[0]), ('rsid', 'S%i' % widths[1]), ('pos', numpy.int64), ('allele0', 'S%i' % widths[2]), ('allele1', 'S%i' % widths[3])]
+	variants_filename = gen_filename + Binary_dosage.suffixes['variants']
+	values_filename = gen_filename + Binary_dosage.suffixes[output_format]
+	variants_array = numpy.lib.format.open_memmap(variants_filename, mode='w+', dtype=variants_dtype, shape=(variants,))
+	if output_format == 'probabilities':
+		values = numpy.lib.format.open_memmap(values_filename, mode='w+', dtype=numpy.uint16, shape=(variants, samples, 3))
+	else:
+		values = numpy.lib.format.open_memmap(values_filename, mode='w+', dtype=numpy.float16, shape=(variants, samples))
+
+	try:
+		with open_input(gen_filename) as gen_file:
+			variant = 0
+			while True:
+				lines = [l.split(None, 5) for l in itertools.islice(gen_file, block_size)]
+				if not lines:
+					break
+
+				probabilities = numpy.fromstring(' '.join([l[5] for l in lines]), dtype=numpy.float32, sep=' ')
+				if len(probabilities) != len(lines) * samples * 3:
+					raise Exception('File %s has lines with different number of samples (line: %i - %i)' % (gen_filename, variant + 1, variant + len(lines)))
+				probabilities = probabilities.reshape(len(lines), samples, 3)
+
+				if output_format == 'probabilities':
+					values[variant:variant+len(lines)] = numpy.rint(numpy.clip(probabilities, 0.0, 1.0) * 65535)
+				else:
+					dosages = probabilities[:, :, 1] + 2 * probabilities[:, :, 2]
+					dosages[probabilities.sum(axis=2) == 0] = numpy.nan
+					values[variant:variant+len(lines)] = dosages
+
+				variants_array[variant:variant+len(lines)] = [(l[0], l[1], int(l[2]), l[3], l[4]) for l in lines]
+				variant += len(lines)
+
+		if (numpy.diff(variants_array['pos']) < 0).any():
+			raise Exception('Positions in %s are not sorted' % gen_filename)
+
+	except Exception:
+		del variants_array, values
+		os.remove(variants_filename)
+		os.remove(values_filename)
+		raise
+
+	variants_array.flush()
+	values.flush()
+
+	with open(gen_filename + Binary_dosage.suffixes['info'], 'w') as info_file:
+		json.dump({'format' : output_format, 'variants' : variants, 'samples' : samples, 'file' : [os.path.getsize(gen_filename), int(os.path.getmtime(gen_filename))]}, info_file)
+
+	size = variants_array.nbytes + values.nbytes
+	print 'Binary dosage: %i variants, %i samples, %.1f MB (gen file: %.1f MB)' % (variants, samples, size / 1024.0 / 1024.0, os.path.getsize(gen_filename) / 1024.0 / 1024.0)
+
+
+
+import os
+import numpy
+import itertools
+
+#Default thresholds of the quality control of imputed variants (see: impute2_qc_chromosome)
+impute2_qc_thresholds = {
+	'min_info' : 0.3,
+	'min_maf' : 0.0,
+	'min_call_rate' : 0.0,
+	'call_threshold' : 0.9,
+}
+
+#The statistics of the variants of a gen file that are needed for quality control. Sums are over samples
+impute2_qc_statistics_dtype = [('pos', numpy.int64), ('samples', numpy.int32), ('called', numpy.int32), ('sum_e', numpy.float64), ('sum_f', numpy.float64), ('sum_e2', numpy.float64)]
+
+def gen_block_reader(gen_filename, block_size=1000):
+	'''
+	Reads a gen file (the output of impute2) in blocks of 'block_size' lines.
+	Generates tuples: (list of the first 5 fields of every line, (lines x samples x 3) float32 array of probabilities)
+	'''
+
+	gen_file = bioinformatics_file_helper.open_file_read(gen_filename)
+	try:
+		while True:
+			lines = [l.split(None, 5) for l in itertools.islice(gen_file, block_size)]
+			if not lines:
+				break
+
+			probabilities = numpy.fromstring(' '.join([l[5] if len(l) == 6 else '' for l in lines]), dtype=numpy.float32, sep=' ')
+			if len(probabilities) % (3 * len(lines)):
+				raise Exception('File %s has lines with different number of samples' % gen_filename)
+
+			yield [l[:5] for l in lines], probabilities.reshape(len(lines), -1, 3)
+	finally:
+		bioinformatics_file_helper.close_file(gen_file)
+
+def impute2_qc_metrics(statistics, total_samples=None):
+	'''
+	Computes the quality metrics of variants from their statistics (see: impute2_qc_statistics_dtype)
+	The info score is the IMPUTE2 info measure: 1 - sum(f - e^2) / (2 N theta (1 - theta))
+	where e = P(AB) + 2 P(BB), f = P(AB) + 4 P(BB) for every sample, theta = sum(e) / 2N and N the number of samples with a genotype.
+	Returns a tuple of arrays: (maf, info, call rate)
+	'''
+
+	samples = statistics['samples'].astype(numpy.float64)
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		theta = statistics['sum_e'] / (2 * samples)
+		info = 1 - (statistics['sum_f'] - statistics['sum_e2']) / (2 * samples * theta * (1 - theta))
+	info[(theta <= 0) | (theta >= 1) | (samples == 0)] = 1.0
+	theta[samples == 0] = 0.0
+	maf = numpy.minimum(theta, 1 - theta)
+	call_rate = statistics['called'] / float(total_samples) if total_samples else numpy.ones(len(statistics))
+
+	return maf, info, call_rate
+
+def impute2_qc_statistics_filename(gen_filename, call_threshold):
+	'''
+	The file with the quality control statistics of a gen file. The number of called genotypes depends on the call threshold, so it is part of the name
+	'''
+
+	return '%s.qc_%g.npy' % (gen_filename, call_threshold)
+
+def impute2_qc_statistics(gen_filename, call_threshold=0.9, block_size=1000):
+	'''
+	Computes the quality control statistics of every variant of a gen file (usually the output of one imputation job)
+	and saves them in <gen_filename>.qc_<call_threshold>.npy (see: impute2_qc_statistics_filename). 
+	The statistics of the sample chunks of an interval can be added.
+	Returns the statistics
+	'''
+
+	statistics = []
+	for variants, probabilities in gen_block_reader(gen_filename, block_size):
+		e = probabilities[:, :, 1] + 2 * probabilities[:, :, 2]
+		f = probabilities[:, :, 1] + 4 * probabilities[:, :, 2]
+		present = probabilities.sum(axis=2) > 0
+
+		block = numpy.zeros(len(variants), dtype=impute2_qc_statistics_dtype)
+		block['pos'] = [int(x[2]) for x in variants]
+		block['samples'] = present.sum(axis=1)
+		block['called'] = (probabilities.max(axis=2) >= call_threshold).sum(axis=1)
+		block['sum_e'] = e.sum(axis=1)
+		block['sum_f'] = f.sum(axis=1)
+		block['sum_e2'] = (e * e).sum(axis=1)
+		statistics += [block]
+
+	statistics = numpy.concatenate(statistics) if statistics else numpy.zeros(0, dtype=impute2_qc_statistics_dtype)
+	numpy.save(impute2_qc_statistics_filename(gen_filename, call_threshold), statistics)
+
+	return statistics
+
+def impute2_qc_chromosome(results, chromosome, output_pattern, merged_filename, thresholds=None):
+	'''
+	Quality control of the imputed variants of a chromosome.
+	The statistics of every imputation output (see: impute2_qc_statistics) are computed if they do not exist for this call threshold
+	(usually they are computed as soon as every imputation job finishes). The statistics of the sample chunks of 
+	every interval are added. Then the MAF, info and call rate of every variant are computed (see: impute2_qc_metrics)
+	and compared with the thresholds (see: impute2_qc_thresholds).
+
+	Saves in the results directory:
+		chr<CHROMOSOME>.qc.gz : MAF, info, call rate and PASS / FAIL of every variant
+		chr<CHROMOSOME>.qc_summary.txt : Number of variants that pass and fail every threshold
+		<merged_filename without .impute2.gz>.filtered.impute2.gz : the merged file (see: merge_impute2_chromosome) with the variants that pass. Only if the merged file exists
+	'''
+
+	this_thresholds = dict(impute2_qc_thresholds)
+	this_thresholds.update(thresholds if thresholds else {})
+
+	intervals = impute2_output_finder(results, output_pattern, chromosome).get(chromosome)
+	if not intervals:
+		raise Exception('Could not find any imputation output for chromosome %s in %s' % (chromosome, results))
+
+	print 'Quality control of chromosome %s (%i intervals)' % (chromosome, len(intervals))
+
+	statistics = []
+	variants = []
+	total_samples = 0
+	for from_pos, to_pos, sample_chunks in intervals:
+		interval_statistics = None
+		interval_samples = 0
+		for from_sample, to_sample, filename in sample_chunks:
+			statistics_filename = impute2_qc_statistics_filename(filename, this_thresholds['call_threshold'])
+			if os.path.exists(statistics_filename) and os.path.getmtime(statistics_filename) >= os.path.getmtime(filename):
+				chunk_statistics = numpy.load(statistics_filename)
+			else:
+				chunk_statistics = impute2_qc_statistics(filename, this_thresholds['call_threshold'])
 
-					#delete old_temp_file anymore
-					os.unlink(old_temp_filename)
-					if not silent:
-						print 'Deleted: ', old_temp_filename
-				else:
-					for line in current_batch_transposed:
-						bioinformatics_file_helper.line_writer(new_temp_file, line)
+			interval_samples += to_sample - from_sample + 1
+			if interval_statistics is None:
+				interval_statistics = chunk_statistics.copy()
+			elif len(chunk_statistics) != len(interval_statistics) or (chunk_statistics['pos'] != interval_statistics['pos']).any():
+				raise Exception('File %s has different variants than the other sample chunks of the interval' % filename)
+			else:
+				for field in ['samples', 'called', 'sum_e', 'sum_f', 'sum_e2']:
+					interval_statistics[field] += chunk_statistics[field]
+
+		total_samples = max(total_samples, interval_samples)
+		statistics += [interval_statistics]
+		#The names of the variants from the first sample chunk
+		chunk_file = bioinformatics_file_helper.open_file_read(sample_chunks[0][2])
+		variants += [l.split(None, 5)[:5] for l in chunk_file]
+		bioinformatics_file_helper.close_file(chunk_file)
+
+	statistics = numpy.concatenate(statistics)
+	maf, info, call_rate = impute2_qc_metrics(statistics, total_samples)
+
+	failed_info = info < this_thresholds['min_info']
+	failed_maf = maf < this_thresholds['min_maf']
+	failed_call_rate = call_rate < this_thresholds['min_call_rate']
+	passed = ~(failed_info | failed_maf | failed_call_rate)
+
+	qc_filename = os.path.join(results, 'chr%s.qc.gz' % chromosome)
+	qc_file = Compressed_io.open_write(qc_filename)
+	qc_file.write('SNP rsid pos allele0 allele1 maf info call_rate filter\n')
+	for index, variant in enumerate(variants):
+		qc_file.write('%s %.4f %.4f %.4f %s\n' % (' '.join(variant), maf[index], info[index], call_rate[index], 'PASS' if passed[index] else 'FAIL'))
+	qc_file.close()
+
+	summary_filename = os.path.join(results, 'chr%s.qc_summary.txt' % chromosome)
+	with open(summary_filename, 'w') as summary_file:
+		summary_file.write('chromosome\tvariants\tpassed\tfailed_info\tfailed_maf\tfailed_call_rate\tmean_info\tmin_info\tmin_maf\tmin_call_rate\n')
+		summary_file.write('\t'.join(map(str, [chromosome, len(variants), passed.sum(), failed_info.sum(), failed_maf.sum(), failed_call_rate.sum(), 
+			'%.4f' % info.mean() if len(info) else 'NA', this_thresholds['min_info'], this_thresholds['min_maf'], this_thresholds['min_call_rate']])) + '\n')
+
+	print 'Chromosome %s: %i variants, %i passed QC (failed info: %i maf: %i call rate: %i)' % (chromosome, len(variants), passed.sum(), failed_info.sum(), failed_maf.sum(), failed_call_rate.sum())
+	print 'Saved:', qc_filename
+	print 'Saved:', summary_filename
+
+	if not os.path.exists(merged_filename):
+		print 'Merged file %s does not exist. Filtered output is not created' % merged_filename
+		return
 
-				old_temp_filename = new_temp_file.name
-				new_temp_file.close()
+	suffix = '.impute2.gz' if merged_filename.endswith('.impute2.gz') else ''
+	filtered_filename = merged_filename[:len(merged_filename) - len(suffix)] + '.filtered.impute2.gz'
+	merged_file = bioinformatics_file_helper.open_file_read(merged_filename)
+	filtered_file = Compressed_io.open_write(filtered_filename)
+	lines = 0
+	for index, line in enumerate(merged_file):
+		if index >= len(variants) or line.split(None, 5)[:5] != variants[index]:
+			filtered_file.close()
+			merged_file.close()
+			os.remove(filtered_filename)
+			raise Exception('Line %i of %s is not the same variant as in the imputation outputs' % (index + 1, merged_filename))
+		if passed[index]:
+			filtered_file.write(line)
+		lines += 1
+	filtered_file.close()
+	merged_file.close()
+
+	if lines != len(variants):
+		os.remove(filtered_filename)
+		raise Exception('File %s has %i variants but the imputation outputs have %i. Merge the chromosome again' % (merged_filename, lines, len(variants)))
+
+	print 'Saved:', filtered_filename
 
-		if type(filename) is str:
-			os.rename(old_temp_filename, filename)
-			if not silent:
-				print 'Moved %s to %s' % (old_temp_filename, filename)
-		else:
-			#Dump temporary file to stream. Then delete it
-			temp_file = bioinformatics_file_helper.open_file_read(old_temp_filename)
-			for l in temp_file:
-				filename.write(l)
-			bioinformatics_file_helper.close_file(old_temp_filename)
-			os.unlink(old_temp_filename)
-			if not silent:
-				print 'Delete: ', old_temp_filename
-		yield False
 
-	@staticmethod
-	def path_splitter(path):
-		'''
-		http://stackoverflow.com/questions/3167154/how-to-split-a-dos-path-into-its-components-in-python
-		'''
+import os
+import json
+import time
+import hashlib
+import itertools
+import multiprocessing
 
-		folders=[]
-		while True:
-			path,folder=os.path.split(path)
+def conversion_worker(conversion):
+	'''
+	Converts a single chromosome of a reference panel. Used by Imputation.convert_reference_chromosomes
+	conversion: a tuple (chromosome, commands). commands is anything that Install_tool_helper.execute accepts
+	Returns a tuple: (chromosome, wall time in seconds, error message or None)
+	'''
 
-			if folder!="":
-				folders.append(folder)
-			else:
-				if path!="":
- 					folders.append(path)
+	chromosome, commands = conversion
+	start = time.time()
+	try:
+		Install_tool_helper.execute(commands)
+	except Exception as e:
+		return chromosome, time.time() - start, str(e)
 
-        			break
+	return chromosome, time.time() - start, None
 
-		folders.reverse()
-		return folders
+def study_index_worker(entry):
+	'''
+	Indexes a single chromosome of a study panel. Used by Imputation.get_study_index
+	entry: a tuple (chromosome, positions filename, positions column, samples filename, samples type)
+	       samples type is 'haps' (the samples are the columns of the first line) or 'lines' (one sample per line)
+	Returns a tuple: (chromosome, sorted int32 numpy array with positions, number of samples, error message or None)
+	'''
 
+	chromosome, positions_filename, column, samples_filename, samples_type = entry
+	try:
+		positions = numpy.sort(bioinformatics_file_helper.position_reader(positions_filename, column)).astype(numpy.int32)
+		if samples_type == 'haps':
+			with open(samples_filename) as samples_file:
+				n_samples = (len(samples_file.readline().split()) - 5) / 2
+		else:
+			n_samples = bioinformatics_file_helper.line_counter(samples_filename, cache=True)
+	except Exception as e:
+		return chromosome, None, None, str(e)
 
-import os
+	return chromosome, positions, n_samples, None
 
 class Imputation:
 	'''
@@ -1058,15 +3747,59 @@ Link: http://mathgen.stats.ox.ac.uk/impute/1000GP%20Phase%203%20haplotypes%206%2
 		'hg18ToHg38' : 'resources/liftover/hg18ToHg38.over.chain', # http://hgdownload.cse.ucsc.edu/goldenPath/hg18/liftOver/hg18ToHg38.over.chain.gz
 	}
 	reference_dir = 'resources/imputationReference'
+	reference_manifest_filename = 'reference_manifest.json'
+
+	#Coefficients of the cost model of an impute2 job (see: job_planner). 
+	#A cell is: reference haplotypes x variants in the window (with buffer) x samples
+	impute2_seconds_per_cell = 4e-7
+	#Memory of a job: base + reference haplotypes x variants x per reference cell + samples x variants x per study cell
+	impute2_memory_base = 200 * 1024 * 1024
+	impute2_memory_per_reference_cell = 2
+	impute2_memory_per_study_cell = 16
+
+	#The main output file of an imputation job in the output directory. Used to check if a job has finished (see: Run_state)
+	#It is the output name of the impute2 protocol of the installed pipeline and can be changed with the impute_output_pattern parameter
+	impute_output_pattern = 'chr%(chr)s_%(fromChrPos)s-%(toChrPos)s_%(fromSample)s-%(toSample)s.impute2'
+
+	#The merged output of a chromosome in the output directory (see: perform_merge)
+	merged_output_pattern = 'chr%(chromosome)s.impute2.gz'
+
+	#The files of the study index (see: get_study_index). Saved in the study directory
+	study_index_filename = 'study_index.json'
+	study_index_positions_filename = 'study_index.npz'
+
+	#The positions of the variants of the reference panels (see: get_reference_positions). 
+	#Saved in the installation directory, since the reference directory can be shared or read-only
+	reference_positions_dir = 'reference_positions'
 	tools_dir = 'tools'
 	molgenis_compute_dir = 'molgenis-compute'
 	generated_dir = 'generated'
 
-	def __init__(self, installation_dir=None, reference_dir=None, verbose=True):
+	def __init__(self, installation_dir=None, reference_dir=None, verbose=True, conversion_workers=1, build_binary_reference=False, 
+		native_workers=None, native_max_memory=None, native_max_cpu_time=None, vcf_converter='vcftools', compression_threads=None, compression_level=None, 
+		impute_output_pattern=None):
 		'''
 		Set up Imputation class
+		conversion_workers: Number of chromosomes of a reference panel that are converted in parallel
+		build_binary_reference: Build a binary copy of the haps and legend files of reference panels when they are installed (see: Binary_reference)
+		native_workers, native_max_memory, native_max_cpu_time: Options of the native backend (see: Native_scheduler)
+		vcf_converter: How reference panels are converted from VCF to impute2. 'vcftools' or 'native' (see: convert_vcf_to_impute2)
+		compression_threads, compression_level: Options of gzip files that are read and written (see: Compressed_io)
+		impute_output_pattern: The name of the output of an imputation job, if the pipeline uses a different name than Imputation.impute_output_pattern
 		'''
+		if compression_threads:
+			Compressed_io.threads = compression_threads
+		if compression_level:
+			Compressed_io.level = compression_level
 		self.verbose = verbose
+		self.conversion_workers = max(1, conversion_workers)
+		self.vcf_converter = vcf_converter
+		if impute_output_pattern:
+			missing = [x for x in ['chr', 'fromChrPos', 'toChrPos', 'fromSample', 'toSample'] if '%%(%s)s' % x not in impute_output_pattern]
+			if missing:
+				raise Exception('The name of the output of imputation jobs: %s should contain the fields: %s' % (impute_output_pattern, ', '.join('%%(%s)s' % x for x in missing)))
+			self.impute_output_pattern = impute_output_pattern
+		self.use_binary_reference = build_binary_reference
 		self.bfh = bioinformatics_file_helper()
 		self.cwd = os.getcwd()
 		self.install_tool_helper = Install_tool_helper()
@@ -1079,6 +3812,9 @@ Link: http://mathgen.stats.ox.ac.uk/impute/1000GP%20Phase%203%20haplotypes%206%2
 		self.tools_dir = os.path.join(self.installation_dir, self.tools_dir)
 		self.molgenis_compute_dir = os.path.join(self.installation_dir, self.molgenis_compute_dir)
 		self.generated_dir = os.path.join(self.installation_dir, self.generated_dir)
+		self.reference_positions_dir = os.path.join(self.installation_dir, self.reference_positions_dir)
+		#(reference, chromosome) -> positions of the reference variants that have been read in this run
+		self.reference_positions = {}
 		self.genetic_map = os.path.join(self.installation_dir, self.genetic_map)
 
 		for x in self.assembly_chains:
@@ -1089,7 +3825,8 @@ Link: http://mathgen.stats.ox.ac.uk/impute/1000GP%20Phase%203%20haplotypes%206%2
 		else:
 			self.reference_dir = os.path.join(self.installation_dir, self.reference_dir)
 
-		self.mc = Molgenis_compute(self.tools_dir, self.molgenis_compute_dir, self.generated_dir, self.installation_dir)
+		native_scheduler = Native_scheduler(workers=native_workers, max_memory=native_max_memory, max_cpu_time=native_max_cpu_time)
+		self.mc = Molgenis_compute(self.tools_dir, self.molgenis_compute_dir, self.generated_dir, self.installation_dir, native_scheduler=native_scheduler)
 
 		print 'Checking for custom reference panels..'
 		self.add_custom_reference_panels()
@@ -1188,10 +3925,30 @@ and make sure that it was completed without errors.
 	def convert_vcf_to_IMPUTE2(self, reference_panel, chromosome):
 		'''
 		Convert a reference panel from VCF to IMPUTE2's hap and legend format
-		vcftools is used as a convertion tool
+		With self.vcf_converter == 'native' the conversion is done with convert_vcf_to_impute2 
+		With self.vcf_converter == 'vcftools' vcftools is used as a convertion tool
+		'''
+
+		self.install_tool_helper.execute(self.convert_vcf_to_IMPUTE2_commands(reference_panel, chromosome))
+
+	def convert_vcf_to_IMPUTE2_commands(self, reference_panel, chromosome):
+		'''
+		Returns the commands that convert_vcf_to_IMPUTE2 executes
 		'''
 	
 		vcfgz_fn = os.path.join(self.reference_dir, reference_panel, self.reference_panels[reference_panel]['vcfgz'])
+
+		if self.vcf_converter == 'native':
+			return (convert_vcf_to_impute2, [], {
+				'input_vcf_filename' : vcfgz_fn % {'chromosome' : chromosome},
+				'output_haps_filename' : vcfgz_fn.replace('vcf.gz', 'haps.gz') % {'chromosome' : chromosome},
+				'output_legend_filename' : vcfgz_fn.replace('vcf.gz', 'legend.gz') % {'chromosome' : chromosome},
+				#Share the CPUs between the chromosomes that are converted in parallel
+				'threads' : max(1, multiprocessing.cpu_count() / self.conversion_workers),
+			})
+		elif self.vcf_converter != 'vcftools':
+			raise Exception('Unknown value for parameter vcf_converter: ' + str(self.vcf_converter))
+
 		total_commands = []
 	
 		command = []
@@ -1220,8 +3977,51 @@ and make sure that it was completed without errors.
 		command = ' '.join(['mv', vcfgz_fn + '.pyp.impute.legend.gz', vcfgz_fn.replace('vcf.gz', 'legend.gz')])
 		total_commands += [command % {'chromosome' : chromosome}]
 
-		#Execute commands
-		self.install_tool_helper.execute(total_commands)
+		return total_commands
+
+	@Instrumentation.instrumented('reference_conversion')
+	def convert_reference_chromosomes(self, conversions):
+		'''
+		Runs the conversions of a reference panel. One conversion per chromosome.
+		conversions: a list of (chromosome, commands) tuples. commands is anything that Install_tool_helper.execute accepts
+
+		If self.conversion_workers is more than 1, the chromosomes are converted in parallel in a process pool.
+		A failed chromosome does not stop the conversion of the rest. An exception is raised at the end if any conversion failed
+		'''
+
+		if not conversions:
+			return
+
+		workers = min(self.conversion_workers, len(conversions))
+		print 'Converting %i chromosomes with %i worker(s)..' % (len(conversions), workers)
+
+		if workers > 1:
+			pool = multiprocessing.Pool(workers)
+			results_g = pool.imap_unordered(conversion_worker, conversions)
+		else:
+			pool = None
+			results_g = itertools.imap(conversion_worker, conversions)
+
+		results = []
+		for chromosome, wall_time, error in results_g:
+			results += [(chromosome, wall_time, error)]
+			if error:
+				print '[%i/%i] Conversion of chromosome %s FAILED after %.1f sec: %s' % (len(results), len(conversions), chromosome, wall_time, error)
+			else:
+				print '[%i/%i] Converted chromosome %s in %.1f sec' % (len(results), len(conversions), chromosome, wall_time)
+
+		if pool:
+			pool.close()
+			pool.join()
+
+		print 'Conversion summary:'
+		print '%-12s %-8s %10s' % ('chromosome', 'status', 'wall time')
+		for chromosome, wall_time, error in sorted(results, key=lambda x : x[1], reverse=True):
+			print '%-12s %-8s %9.1fs' % (chromosome, 'FAILED' if error else 'OK', wall_time)
+
+		failed = [chromosome for chromosome, wall_time, error in results if error]
+		if failed:
+			raise Exception('Conversion failed for chromosomes: %s' % (', '.join(failed)))
 
 	def check_reference_panel_installation(self, reference_panel, rformat='vcfgz', suffix='vcf.gz'):
 		'''
@@ -1250,7 +4050,7 @@ and make sure that it was completed without errors.
 			'%(chromosome)s' not in self.reference_panels[reference_panel]['hapsgz'] or \
 			'%(chromosome)s' not in self.reference_panels[reference_panel]['legendgz']:
 
-			chrosomes_to_convert = chromosomes[:]
+			chromosomes_to_convert = chromosomes[:]
 			self.reference_panels[reference_panel]['hapsgz'] = self.reference_panels[reference_panel][rformat].replace(suffix, 'haps.gz')
 			self.reference_panels[reference_panel]['legendgz'] = self.reference_panels[reference_panel][rformat].replace(suffix, 'legend.gz')
 		else:
@@ -1273,25 +4073,31 @@ and make sure that it was completed without errors.
 						self.reference_panels[reference_panel]['legendgz'] = self.reference_panels[reference_panel]['legendgz'].replace('.legend.gz', '.legend')
 
 		#Create missing haps and legends files
+		conversions = []
 		for chromosome in chromosomes_to_convert:
 
 			if rformat == 'vcfgz':
 				print 'Converting: %s to hap and legend' % self.reference_panels[reference_panel][rformat] % {'chromosome' : chromosome}
-				self.convert_vcf_to_IMPUTE2(reference_panel, chromosome)
+				conversions += [(chromosome, self.convert_vcf_to_IMPUTE2_commands(reference_panel, chromosome))]
 			elif rformat == 'shapeithaps':
 				input_haps_filename = os.path.join(this_reference_dir, self.reference_panels[reference_panel][rformat] % {'chromosome' : chromosome})
-				convert_shapeit_reference_to_impute2(
-					input_haps_filename = input_haps_filename,
-					input_sample_filename = input_haps_filename.replace('.haps', '.sample'),
-					output_haps_filename = input_haps_filename.replace('_SHAPEIT.haps', '.haps.gz'),
-					output_legend_filename = input_haps_filename.replace('_SHAPEIT.haps', '.legend.gz'),
-					output_sample_filename = input_haps_filename.replace('_SHAPEIT.haps', '.sample'),
-					chromosome = chromosome,
-					output_gzip = True,
-				)
+				conversions += [(chromosome, (convert_shapeit_reference_to_impute2, [], {
+					'input_haps_filename' : input_haps_filename,
+					'input_sample_filename' : input_haps_filename.replace('.haps', '.sample'),
+					'output_haps_filename' : input_haps_filename.replace('_SHAPEIT.haps', '.haps.gz'),
+					'output_legend_filename' : input_haps_filename.replace('_SHAPEIT.haps', '.legend.gz'),
+					'output_sample_filename' : input_haps_filename.replace('_SHAPEIT.haps', '.sample'),
+					'chromosome' : chromosome,
+					'output_gzip' : True,
+				}))]
 
 			else:
 				raise Exception('Invalid rformat value:' + str(rformat))
+
+		self.convert_reference_chromosomes(conversions)
+
+		if self.use_binary_reference:
+			self.check_binary_reference(reference_panel)
 			
 		print 'Checking if vcf index files exist..'
 		if rformat == 'vcfgz':
@@ -1299,129 +4105,229 @@ and make sure that it was completed without errors.
 				if not os.path.isfile(os.path.join(this_reference_dir, self.reference_panels[reference_panel]['vcfgz']  % {'chromosome' : chromosome} ).replace('vcf.gz', 'vcf.gz.tbi')):
 					self.build_vcf_index_file(reference_panel, chromosome)
 
-	def add_custom_reference_panels(self):
+	def check_binary_reference(self, reference_panel):
+		'''
+		Builds the binary reference files (see: Binary_reference) of all chromosomes of a reference panel that do not have one, or have an outdated one
+		'''
+
+		print 'Checking if binary reference files exist..'
+		this_reference_dir = os.path.join(self.reference_dir, self.reference_panels[reference_panel]['dir'])
+		haps_pattern, chromosomes = self.bfh.get_chromosome_files(os.path.join(this_reference_dir, self.reference_panels[reference_panel]['hapsgz'].replace('%(chromosome)s', '*')))
+		if not chromosomes:
+			return
+
+		conversions = []
+		for chromosome in chromosomes:
+			haps_filename = os.path.join(this_reference_dir, self.reference_panels[reference_panel]['hapsgz'] % {'chromosome' : chromosome})
+			legend_filename = os.path.join(this_reference_dir, self.reference_panels[reference_panel]['legendgz'] % {'chromosome' : chromosome})
+			if not Binary_reference.is_built(haps_filename, legend_filename):
+				conversions += [(chromosome, (build_binary_reference, [haps_filename, legend_filename]))]
+
+		self.convert_reference_chromosomes(conversions)
+
+	@Instrumentation.instrumented('reference_scan', profile=True)
+	def add_custom_reference_panels(self, use_manifest=True):
 		'''
 		Searches for reference panels that are not in the reference_panels dictionary.
 		If any found, it is added
+
+		The detected panels are saved in a manifest file in the reference directory (see: reference_manifest_filename).
+		If use_manifest is True, a panel whose files have not changed since the last scan is loaded from the manifest instead of being scanned again.
 		'''
 
-		for dir_entry in glob.glob(os.path.join(self.reference_dir, '*')):
-			if os.path.isdir(dir_entry):
-				reference_name = os.path.split(dir_entry)[1]
-				reference_name_dir = os.path.join(self.reference_dir, reference_name)
-				if not self.reference_panels.has_key(reference_name):
-					#Try to add this to the reference panels
-					print 'Adding custom reference: ' + reference_name
-					self.reference_panels[reference_name] = {'description' : '\tCustom panel add from %s' % self.reference_dir}
+		manifest = self.load_reference_manifest() if use_manifest else {}
+		new_manifest = {}
 
-					stem_vcf = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*.vcf'))
-					stem_vcfgz = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*.vcf.gz'))
+		try:
+			for dir_entry in glob.glob(os.path.join(self.reference_dir, '*')):
+				if os.path.isdir(dir_entry):
+					reference_name = os.path.split(dir_entry)[1]
+					if not self.reference_panels.has_key(reference_name):
+						files = self.reference_panel_fingerprint(dir_entry)
+						if manifest.has_key(reference_name) and manifest[reference_name]['files'] == files:
+							self.reference_panels[reference_name] = manifest[reference_name]['panel']
+							if self.use_binary_reference and self.reference_panels[reference_name].has_key('hapsgz'):
+								self.check_binary_reference(reference_name)
+						else:
+							self.add_custom_reference_panel(dir_entry)
+							#Conversions might have created new files
+							files = self.reference_panel_fingerprint(dir_entry)
 
-					#Are there any vcf files that haven't been converted to .gz?
-					if not stem_vcf[0] and not stem_vcfgz[0]:
-						print 'Could not find *.vcf or *.vcf.gz files in %s' % self.reference_dir
+						new_manifest[reference_name] = {'files' : files, 'panel' : self.reference_panels[reference_name]}
+		finally:
+			if new_manifest != manifest:
+				self.save_reference_manifest(new_manifest)
+
+	def reference_panel_fingerprint(self, reference_panel_dir):
+		'''
+		Returns a dictionary with the size and the modification time of all files in a reference panel directory
+		'''
 
-						print 'Looking for SHAPEIT files: *_SHAPEIT.haps and *_SHAPEIT.sample'
-						stem_shapeit_haps = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*_SHAPEIT.haps'))
-						stem_shapeit_sample = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*_SHAPEIT.sample'))
+		ret = {}
+		for filename in os.listdir(reference_panel_dir):
+			#Skip index files and binary references. These are created and updated after the panel has been added.
+			if filename.endswith('.npy') or filename.endswith(Binary_reference.suffixes['info']):
+				continue
+			stat = os.stat(os.path.join(reference_panel_dir, filename))
+			ret[filename] = [stat.st_size, int(stat.st_mtime)]
 
-						if stem_shapeit_haps[0] and stem_shapeit_sample[0]:
-							print 'Found SHAPEIT files: *_SHAPEIT.haps and *_SHAPEIT.sample files'
-							self.reference_panels[reference_name]['dir'] = reference_name
-							self.reference_panels[reference_name]['shapeithaps'] = stem_shapeit_haps[0]
-							self.reference_panels[reference_name]['shapeitsample'] = stem_shapeit_sample[0]
-							self.reference_panels[reference_name]['hapsgz'] = stem_shapeit_haps[0].replace('_SHAPEIT.haps', '.haps.gz')
-							self.reference_panels[reference_name]['legendgz'] = stem_shapeit_haps[0].replace('_SHAPEIT.haps', '.legend.gz')
-							self.check_reference_panel_installation(reference_name, rformat='shapeithaps', suffix='_SHAPEIT.haps')
+		return ret
 
-						else:
-							print 'Could not find SHAPEIT files: *_SHAPEIT.haps and *_SHAPEIT.sample'
-							print 'Looking for *.haps, *.legend and *.sample files'
-							stem_haps = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*.haps'))
-							stem_legend = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*.legend'))
-							stem_hapsgz = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*.haps.gz'))
-
-							#If 'haps.gz files are not available. Maybe hap.gz files exist'
-							#if not stem_hapsgz[0]:
-							#	stem_hapsgz = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*.hap.gz'))
-
-							stem_legendgz = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*.legend.gz'))
-							stem_sample = [x for x in glob.glob(os.path.join(dir_entry, '*.sample')) if '_SHAPEIT.sample' not in x]
-							can_convert_to_shapeit = False
-							if not stem_sample:
-								raise Exception('Could not find *.sample file in ' + dir_entry)
-							if len(stem_sample) > 1:
-								raise Exception('Multiple *.sample files found. Don\'t know which to use:' + str(stem_sample))
-							print 'Found sample file:', stem_sample[0]
-							if not stem_haps[0] or not stem_legend[0]:
-								print 'Could not find *.haps and *.legend files'
-							else:
-								print 'Found *.haps and *.legend files'
-								input_gzip = False
-								chromosome_haps = stem_haps[1]
-								stem_haps = stem_haps  #For uniformity
-								haps_suffix = '.haps'
-								stem_legend = stem_legend
-								stem_haps_dir = os.path.join(reference_name_dir, stem_haps[0])
-								stem_legend_dir = os.path.join(reference_name_dir, stem_legend[0])
-								can_convert_to_shapeit = True
-
-							if (not stem_hapsgz[0] or not stem_legendgz[0]) and not can_convert_to_shapeit:
-								print 'Could not find *.haps.gz (or *.hap.gz) and *.legend.gz files'
-								print 'Neither VCF, SHAPEIT or IMPUTE2 files found in %s ..' % (reference_name_dir)
-							elif not can_convert_to_shapeit:
-								print 'Found *.haps.gz and *.legend.gz files'
-								input_gzip = True
-								chromosome_haps = stem_hapsgz[1]
-								haps_suffix = '.haps.gz'
-								stem_haps = stem_hapsgz
-								stem_legend = stem_legendgz
-								stem_haps_dir = os.path.join(reference_name_dir, stem_hapsgz[0])
-								stem_legend_dir = os.path.join(reference_name_dir, stem_legendgz[0])
-								can_convert_to_shapeit = True
-
-							if can_convert_to_shapeit:
-								for chromosome in chromosome_haps:
-									convert_impute2_reference_to_shapeit(
-										input_haps_filename = stem_haps_dir % {'chromosome' : chromosome}, 
-										input_legend_filename = stem_legend_dir % {'chromosome' : chromosome},
-										input_sample_filename = stem_sample[0],
-										output_haps_filename = (stem_haps_dir % {'chromosome' : chromosome}).replace(haps_suffix, '_SHAPEIT.haps'),
-										output_sample_filename = (stem_haps_dir % {'chromosome' : chromosome}).replace(haps_suffix, '_SHAPEIT.sample'),
-										chromosome = chromosome,
-										input_gzip = input_gzip,
-									)
-								self.reference_panels[reference_name]['dir'] = reference_name
-								self.reference_panels[reference_name]['shapeithaps'] = stem_haps[0].replace(haps_suffix, '_SHAPEIT.haps')
-								self.reference_panels[reference_name]['shapeitsample'] = stem_haps[0].replace(haps_suffix, '_SHAPEIT.sample')
-								self.reference_panels[reference_name]['hapsgz'] = stem_haps[0]
-								self.reference_panels[reference_name]['legendgz'] = stem_legend[0]
-								self.check_reference_panel_installation(reference_name, rformat='shapeithaps', suffix='_SHAPEIT.haps')
-								
-					elif not stem_vcfgz[0]:
-						print 'Could not find any *.vcf.gz but found *.vcf in %s' % self.reference_dir
-						print 'Converting vcf files to vcf.gz'
-						stem_vcf_dir = os.path.join(reference_name_dir, stem_vcf[0])
-						[self.convert_vcf_to_vcfgz(stem_vcf_dir % {'chromosome' : chromosome}) for chromosome in stem_vcf[1]]
-					elif not stem_vcf[0]:
-						pass # No vcf files but vcf.gz exist. We do not care about that
-					else:
-						#Both vcf and vcf.gz exist. Take the vcf that have not been converted to vcf.gz
-						for vcf_chromosome in stem_vcf[1]:
-							if vcf_chromosome not in stem_vcfgz[1]:
-								vcf_filename = os.path.join(reference_name_dir, stem_vcf[0] % {'chromosome' : vcf_chromosome})
-								print 'File %s has not been converted to ' % vcf_filename
-								self.convert_vcf_to_vcfgz(vcf_filename)
+	def load_reference_manifest(self):
+		'''
+		Loads the manifest of custom reference panels. Returns an empty dictionary if there is no (valid) manifest
+		'''
+
+		manifest_filename = os.path.join(self.reference_dir, self.reference_manifest_filename)
+		if not os.path.isfile(manifest_filename):
+			return {}
+
+		try:
+			with open(manifest_filename) as manifest_file:
+				manifest = json.load(manifest_file)
+		except ValueError as e:
+			print 'Warning: Ignoring invalid reference manifest %s : %s' % (manifest_filename, str(e))
+			return {}
+
+		#json returns unicode strings
+		return {str(reference_name) : {
+				'files' : {str(filename) : values for filename, values in entry['files'].iteritems()},
+				'panel' : {str(key) : str(value) for key, value in entry['panel'].iteritems()},
+			} for reference_name, entry in manifest.iteritems()}
+
+	def save_reference_manifest(self, manifest):
+		'''
+		Saves the manifest of custom reference panels
+		'''
+
+		manifest_filename = os.path.join(self.reference_dir, self.reference_manifest_filename)
+		try:
+			with open(manifest_filename + '.tmp', 'w') as manifest_file:
+				json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+			os.rename(manifest_filename + '.tmp', manifest_filename)
+		except (IOError, OSError) as e:
+			print 'Warning: Could not save reference manifest %s : %s' % (manifest_filename, str(e))
+
+	def add_custom_reference_panel(self, dir_entry):
+		'''
+		Scans the directory of a custom reference panel, converts the files if necessary
+		and adds the panel to the reference_panels dictionary
+		'''
+
+		reference_name = os.path.split(dir_entry)[1]
+		reference_name_dir = os.path.join(self.reference_dir, reference_name)
+
+		#Try to add this to the reference panels
+		print 'Adding custom reference: ' + reference_name
+		self.reference_panels[reference_name] = {'description' : '\tCustom panel add from %s' % self.reference_dir}
+
+		stem_vcf = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*.vcf'))
+		stem_vcfgz = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*.vcf.gz'))
+
+		#Are there any vcf files that haven't been converted to .gz?
+		if not stem_vcf[0] and not stem_vcfgz[0]:
+			print 'Could not find *.vcf or *.vcf.gz files in %s' % self.reference_dir
 
-					#Take all converted VCF files
-					stem = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*.vcf.gz'))
+			print 'Looking for SHAPEIT files: *_SHAPEIT.haps and *_SHAPEIT.sample'
+			stem_shapeit_haps = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*_SHAPEIT.haps'))
+			stem_shapeit_sample = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*_SHAPEIT.sample'))
 
-					if stem and stem[0]:
-						self.reference_panels[reference_name]['vcfgz'] = stem[0]
-						self.reference_panels[reference_name]['hapsgz'] = stem[0].replace('vcf.gz', 'haps.gz')
-						self.reference_panels[reference_name]['legendgz'] = stem[0].replace('vcf.gz', 'legend.gz')
-						self.reference_panels[reference_name]['dir'] = reference_name
-						self.check_reference_panel_installation(reference_name)
+			if stem_shapeit_haps[0] and stem_shapeit_sample[0]:
+				print 'Found SHAPEIT files: *_SHAPEIT.haps and *_SHAPEIT.sample files'
+				self.reference_panels[reference_name]['dir'] = reference_name
+				self.reference_panels[reference_name]['shapeithaps'] = stem_shapeit_haps[0]
+				self.reference_panels[reference_name]['shapeitsample'] = stem_shapeit_sample[0]
+				self.reference_panels[reference_name]['hapsgz'] = stem_shapeit_haps[0].replace('_SHAPEIT.haps', '.haps.gz')
+				self.reference_panels[reference_name]['legendgz'] = stem_shapeit_haps[0].replace('_SHAPEIT.haps', '.legend.gz')
+				self.check_reference_panel_installation(reference_name, rformat='shapeithaps', suffix='_SHAPEIT.haps')
+
+			else:
+				print 'Could not find SHAPEIT files: *_SHAPEIT.haps and *_SHAPEIT.sample'
+				print 'Looking for *.haps, *.legend and *.sample files'
+				stem_haps = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*.haps'))
+				stem_legend = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*.legend'))
+				stem_hapsgz = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*.haps.gz'))
+
+				#If 'haps.gz files are not available. Maybe hap.gz files exist'
+				#if not stem_hapsgz[0]:
+				#	stem_hapsgz = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*.hap.gz'))
+
+				stem_legendgz = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*.legend.gz'))
+				stem_sample = [x for x in glob.glob(os.path.join(dir_entry, '*.sample')) if '_SHAPEIT.sample' not in x]
+				can_convert_to_shapeit = False
+				if not stem_sample:
+					raise Exception('Could not find *.sample file in ' + dir_entry)
+				if len(stem_sample) > 1:
+					raise Exception('Multiple *.sample files found. Don\'t know which to use:' + str(stem_sample))
+				print 'Found sample file:', stem_sample[0]
+				if not stem_haps[0] or not stem_legend[0]:
+					print 'Could not find *.haps and *.legend files'
+				else:
+					print 'Found *.haps and *.legend files'
+					input_gzip = False
+					chromosome_haps = stem_haps[1]
+					stem_haps = stem_haps  #For uniformity
+					haps_suffix = '.haps'
+					stem_legend = stem_legend
+					stem_haps_dir = os.path.join(reference_name_dir, stem_haps[0])
+					stem_legend_dir = os.path.join(reference_name_dir, stem_legend[0])
+					can_convert_to_shapeit = True
+
+				if (not stem_hapsgz[0] or not stem_legendgz[0]) and not can_convert_to_shapeit:
+					print 'Could not find *.haps.gz (or *.hap.gz) and *.legend.gz files'
+					print 'Neither VCF, SHAPEIT or IMPUTE2 files found in %s ..' % (reference_name_dir)
+				elif not can_convert_to_shapeit:
+					print 'Found *.haps.gz and *.legend.gz files'
+					input_gzip = True
+					chromosome_haps = stem_hapsgz[1]
+					haps_suffix = '.haps.gz'
+					stem_haps = stem_hapsgz
+					stem_legend = stem_legendgz
+					stem_haps_dir = os.path.join(reference_name_dir, stem_hapsgz[0])
+					stem_legend_dir = os.path.join(reference_name_dir, stem_legendgz[0])
+					can_convert_to_shapeit = True
+
+				if can_convert_to_shapeit:
+					self.convert_reference_chromosomes([(chromosome, (convert_impute2_reference_to_shapeit, [], {
+						'input_haps_filename' : stem_haps_dir % {'chromosome' : chromosome}, 
+						'input_legend_filename' : stem_legend_dir % {'chromosome' : chromosome},
+						'input_sample_filename' : stem_sample[0],
+						'output_haps_filename' : (stem_haps_dir % {'chromosome' : chromosome}).replace(haps_suffix, '_SHAPEIT.haps'),
+						'output_sample_filename' : (stem_haps_dir % {'chromosome' : chromosome}).replace(haps_suffix, '_SHAPEIT.sample'),
+						'chromosome' : chromosome,
+						'input_gzip' : input_gzip,
+					})) for chromosome in chromosome_haps])
+					self.reference_panels[reference_name]['dir'] = reference_name
+					self.reference_panels[reference_name]['shapeithaps'] = stem_haps[0].replace(haps_suffix, '_SHAPEIT.haps')
+					self.reference_panels[reference_name]['shapeitsample'] = stem_haps[0].replace(haps_suffix, '_SHAPEIT.sample')
+					self.reference_panels[reference_name]['hapsgz'] = stem_haps[0]
+					self.reference_panels[reference_name]['legendgz'] = stem_legend[0]
+					self.check_reference_panel_installation(reference_name, rformat='shapeithaps', suffix='_SHAPEIT.haps')
+					
+		elif not stem_vcfgz[0]:
+			print 'Could not find any *.vcf.gz but found *.vcf in %s' % self.reference_dir
+			print 'Converting vcf files to vcf.gz'
+			stem_vcf_dir = os.path.join(reference_name_dir, stem_vcf[0])
+			[self.convert_vcf_to_vcfgz(stem_vcf_dir % {'chromosome' : chromosome}) for chromosome in stem_vcf[1]]
+		elif not stem_vcf[0]:
+			pass # No vcf files but vcf.gz exist. We do not care about that
+		else:
+			#Both vcf and vcf.gz exist. Take the vcf that have not been converted to vcf.gz
+			for vcf_chromosome in stem_vcf[1]:
+				if vcf_chromosome not in stem_vcfgz[1]:
+					vcf_filename = os.path.join(reference_name_dir, stem_vcf[0] % {'chromosome' : vcf_chromosome})
+					print 'File %s has not been converted to ' % vcf_filename
+					self.convert_vcf_to_vcfgz(vcf_filename)
+
+		#Take all converted VCF files
+		stem = self.bfh.get_chromosome_files(os.path.join(dir_entry, '*.vcf.gz'))
+
+		if stem and stem[0]:
+			self.reference_panels[reference_name]['vcfgz'] = stem[0]
+			self.reference_panels[reference_name]['hapsgz'] = stem[0].replace('vcf.gz', 'haps.gz')
+			self.reference_panels[reference_name]['legendgz'] = stem[0].replace('vcf.gz', 'legend.gz')
+			self.reference_panels[reference_name]['dir'] = reference_name
+			self.check_reference_panel_installation(reference_name)
 
 
 	def list_reference_panels(self):
@@ -1454,9 +4360,335 @@ and make sure that it was completed without errors.
 			for from_pos in range(1, length, position_interval):
 				yield (chromosome, from_pos, from_pos + position_interval - 1)
 
-	def perform_liftover(self, study, results, assembly='hg18ToHg19', backend='local', submit=True, return_worksheet=False):
+	@staticmethod
+	def merge_regions(regions, distance):
+		'''
+		regions: a dictionary: chromosome -> list of (from, to) intervals (see: region_reader)
+		Merges the overlapping regions of every chromosome and the regions that are at most 'distance' bases apart.
+		Returns a dictionary: chromosome -> sorted list of (from, to) intervals
+		'''
+
+		ret = {}
+		for chromosome, chromosome_regions in regions.iteritems():
+			merged = []
+			for from_pos, to_pos in sorted(chromosome_regions):
+				if merged and from_pos - merged[-1][1] - 1 <= distance:
+					merged[-1] = (merged[-1][0], max(merged[-1][1], to_pos))
+				else:
+					merged.append((from_pos, to_pos))
+			ret[chromosome] = merged
+
+		return ret
+
+	@staticmethod
+	def region_intervals(positions, regions):
+		'''
+		positions: a list of (chromosome, from, to) intervals (see: chr_pos_generator, chr_pos_planner)
+		regions: a dictionary: chromosome -> sorted list of (from, to) intervals (see: merge_regions)
+		Returns the intersections of the intervals with the regions as a list of (chromosome, from, to) intervals.
+		Intervals that do not touch a region are removed
+		'''
+
+		ret = []
+		for chromosome, from_pos, to_pos in positions:
+			for region_from, region_to in regions.get(chromosome, []):
+				if region_from <= to_pos and region_to >= from_pos:
+					ret.append((chromosome, max(from_pos, region_from), min(to_pos, region_to)))
+
+		return ret
+
+	@Instrumentation.instrumented('reference_positions', profile=True)
+	def get_reference_positions(self, reference, chromosome):
+		'''
+		Returns a sorted numpy array with the positions of the variants of a reference panel in a chromosome.
+		The positions are read from the legend file and are saved in an index file in reference_positions_dir.
+		The name of the index file has a hash of the path, size and modification time of the legend file,
+		so the index of a legend file that has changed is not used.
+		'''
+
+		if self.reference_positions.has_key((reference, chromosome)):
+			return self.reference_positions[(reference, chromosome)]
+
+		legend_filename = os.path.join(self.reference_dir, self.reference_panels[reference]['dir'], self.reference_panels[reference]['legendgz'] % {'chromosome' : chromosome})
+		key = json.dumps([os.path.abspath(legend_filename), os.path.getsize(legend_filename), int(os.path.getmtime(legend_filename))])
+		index_filename = os.path.join(self.reference_positions_dir, '%s_chr%s_%s.positions.npy' % (reference, chromosome, hashlib.sha1(key).hexdigest()[:12]))
+
+		if os.path.isfile(index_filename):
+			positions = numpy.load(index_filename)
+		else:
+			print 'Reading variant positions from: %s' % legend_filename
+			positions = numpy.sort(self.bfh.position_reader(legend_filename, 1, header=True))
+
+			try:
+				if not os.path.isdir(self.reference_positions_dir):
+					os.makedirs(self.reference_positions_dir)
+				numpy.save(index_filename, positions)
+			except (IOError, OSError) as e:
+				print 'Warning: Could not save positions index file %s : %s' % (index_filename, str(e))
+
+		self.reference_positions[(reference, chromosome)] = positions
+		return positions
+
+	@Instrumentation.instrumented('study_index', profile=True)
+	def get_study_index(self, study, study_files):
+		'''
+		Returns an index of the study panel: chromosome -> {'positions', 'samples', 'variants', 'min', 'max'}
+		positions is a sorted int32 numpy array with the positions of the study variants of the chromosome.
+		study_files: chromosome -> (positions filename, positions column, samples filename, samples type) (see: study_index_worker)
+
+		The index is saved in the study directory (see: study_index_filename). Chromosomes whose files have
+		changed (name, size or modification time) are indexed again. Chromosomes are indexed in parallel.
+		Raises an Exception if the chromosomes have different numbers of samples.
+		'''
+
+		index_filename = os.path.join(study, self.study_index_filename)
+		positions_filename = os.path.join(study, self.study_index_positions_filename)
+
+		index = {}
+		positions = {}
+		if os.path.exists(index_filename) and os.path.exists(positions_filename):
+			try:
+				with open(index_filename) as index_file:
+					index = json.load(index_file)
+				index = {str(chromosome) : entry for chromosome, entry in index.iteritems()}
+				positions_file = numpy.load(positions_filename)
+				positions = {chromosome : positions_file['chr' + chromosome] for chromosome in index if 'chr' + chromosome in positions_file.files}
+			except (IOError, ValueError) as e:
+				print 'Warning: Could not read study index %s : %s' % (index_filename, str(e))
+				index = {}
+				positions = {}
+
+		def fingerprint(entry):
+			return [[os.path.abspath(filename), os.path.getsize(filename), os.path.getmtime(filename)] for filename in [entry[0], entry[2]]] + [entry[1], entry[3]]
+
+		to_index = [(chromosome,) + tuple(entry) for chromosome, entry in study_files.iteritems() 
+			if not index.has_key(chromosome) or not positions.has_key(chromosome) or index[chromosome]['files'] != fingerprint(entry)]
+
+		if to_index:
+			print 'Indexing %i chromosomes of study panel: %s' % (len(to_index), study)
+			start = time.time()
+			if len(to_index) > 1:
+				pool = multiprocessing.Pool(min(len(to_index), multiprocessing.cpu_count()))
+				results = pool.map(study_index_worker, to_index)
+				pool.close()
+				pool.join()
+			else:
+				results = map(study_index_worker, to_index)
+
+			for chromosome, chromosome_positions, n_samples, error in results:
+				if error:
+					raise Exception('Could not index chromosome %s of the study panel: %s' % (chromosome, error))
+				positions[chromosome] = chromosome_positions
+				index[chromosome] = {
+					'files' : fingerprint(study_files[chromosome]),
+					'samples' : n_samples,
+					'variants' : len(chromosome_positions),
+					'min' : int(chromosome_positions[0]) if len(chromosome_positions) else None,
+					'max' : int(chromosome_positions[-1]) if len(chromosome_positions) else None,
+				}
+
+			try:
+				with open(index_filename + '.tmp', 'w') as index_file:
+					json.dump(index, index_file, indent=1, sort_keys=True)
+				with open(positions_filename + '.tmp', 'wb') as positions_file:
+					numpy.savez(positions_file, **{'chr' + chromosome : chromosome_positions for chromosome, chromosome_positions in positions.iteritems()})
+				os.rename(index_filename + '.tmp', index_filename)
+				os.rename(positions_filename + '.tmp', positions_filename)
+				size = os.path.getsize(index_filename) + os.path.getsize(positions_filename)
+			except (IOError, OSError) as e:
+				print 'Warning: Could not save study index %s : %s' % (index_filename, str(e))
+				size = sum([x.nbytes for x in positions.itervalues()])
+
+			print 'Study index built in %.1f sec. Size: %.2f MB' % (time.time() - start, size / (1024.0 * 1024.0))
+
+		ret = {}
+		for chromosome in study_files:
+			ret[chromosome] = dict(index[chromosome])
+			ret[chromosome]['positions'] = positions[chromosome]
+
+		samples = set([entry['samples'] for entry in ret.itervalues()])
+		if len(samples) > 1:
+			raise Exception('The chromosomes of the study panel have different numbers of samples: %s' % 
+				(', '.join(['chr%s: %s' % (chromosome, ret[chromosome]['samples']) for chromosome in sorted(ret)])))
+
+		return ret
+
+	def get_reference_haplotypes(self, reference, chromosome):
+		'''
+		Returns the number of haplotypes of a reference panel in a chromosome (the columns of the first line of the haps file)
+		'''
+
+		haps_filename = os.path.join(self.reference_dir, self.reference_panels[reference]['dir'], self.reference_panels[reference]['hapsgz'] % {'chromosome' : chromosome})
+		haps_file = self.bfh.open_file_read(haps_filename)
+		ret = len(haps_file.readline().split())
+		haps_file.close()
+
+		return ret
+
+	@staticmethod
+	def plan_sample_chunks(n_samples, n_chunks):
+		'''
+		Splits n_samples in n_chunks chunks. The sizes of the chunks differ at most by one.
+		Returns a list of [from, to] pairs (1-based, inclusive)
+		'''
+
+		n_chunks = max(1, min(n_chunks, n_samples))
+		ret = []
+		from_sample = 1
+		for chunk in range(n_chunks):
+			size = n_samples / n_chunks + (1 if chunk < n_samples % n_chunks else 0)
+			ret += [[from_sample, from_sample + size - 1]]
+			from_sample += size
+
+		return ret
+
+	@Instrumentation.instrumented('job_planning', profile=True)
+	def job_planner(self, positions, reference, n_samples, sample_batch_size=500, target_job_minutes=None, max_job_memory=None, buffer_size=250000):
+		'''
+		Plans the sample chunks of every position interval. 
+		positions: a list of (chromosome, from, to) intervals
+		
+		The cost of a job is: reference haplotypes x reference variants in the interval (plus the buffer) x samples
+		The predicted run time and memory of a job are computed from the cost with the impute2_* coefficients of this class.
+
+		If target_job_minutes or max_job_memory (in MB) are set, each interval gets the minimum number of 
+		sample chunks so that every job runs in less than target_job_minutes and uses less than max_job_memory.
+		Otherwise every interval is split in chunks of at least sample_batch_size samples. The reference panel is
+		not read in this case, and the predictions are printed only if its positions have already been read (for example by adaptive chunking).
+		Sample chunks of an interval are balanced (see: plan_sample_chunks).
+
+		Prints the table of jobs. 
+		Returns a list of (chromosome, from, to, sample chunks) tuples
+		'''
+
+		cost_mode = target_job_minutes or max_job_memory
+		haplotypes = {}
+		reference_positions = {}
+
+		ret = []
+		total_jobs = 0
+		total_minutes = 0.0
+		print 'Jobs per interval (predicted minutes and memory per job):'
+		print '%-5s %11s %11s %9s %11s %7s %9s %9s %11s' % ('chr', 'from', 'to', 'ref haps', 'variants', 'chunks', 'samples', 'minutes', 'memory(MB)')
+		predicted = True
+		for chromosome, from_pos, to_pos in positions:
+			if not haplotypes.has_key(chromosome) and (cost_mode or self.reference_positions.has_key((reference, chromosome))):
+				reference_positions[chromosome] = self.get_reference_positions(reference, chromosome)
+				haplotypes[chromosome] = self.get_reference_haplotypes(reference, chromosome)
+
+			if not haplotypes.has_key(chromosome):
+				sample_chunks = self.plan_sample_chunks(n_samples, max(1, n_samples / sample_batch_size))
+				samples = sample_chunks[0][1] - sample_chunks[0][0] + 1
+				print '%-5s %11i %11i %9s %11s %7i %9i %9s %11s' % (chromosome, from_pos, to_pos, '-', '-', len(sample_chunks), samples, '-', '-')
+				ret += [(chromosome, from_pos, to_pos, sample_chunks)]
+				total_jobs += len(sample_chunks)
+				predicted = False
+				continue
+
+			variants = max(1, numpy.searchsorted(reference_positions[chromosome], to_pos + buffer_size, 'right') - numpy.searchsorted(reference_positions[chromosome], from_pos - buffer_size, 'left'))
+			reference_cells = haplotypes[chromosome] * variants
+
+			if cost_mode:
+				max_samples = n_samples
+				if target_job_minutes:
+					max_samples = min(max_samples, int(target_job_minutes * 60 / (self.impute2_seconds_per_cell * reference_cells)))
+				if max_job_memory:
+					max_samples = min(max_samples, int((max_job_memory * 1024 * 1024 - self.impute2_memory_base - self.impute2_memory_per_reference_cell * reference_cells) / (self.impute2_memory_per_study_cell * variants)))
+				if max_samples < 1:
+					print 'Warning: interval chr%s:%i-%i does not fit in the target even with one sample per job' % (chromosome, from_pos, to_pos)
+					max_samples = 1
+				n_chunks = (n_samples + max_samples - 1) / max_samples
+			else:
+				n_chunks = max(1, n_samples / sample_batch_size)
+
+			sample_chunks = self.plan_sample_chunks(n_samples, n_chunks)
+			samples = sample_chunks[0][1] - sample_chunks[0][0] + 1
+			minutes = self.impute2_seconds_per_cell * reference_cells * samples / 60.0
+			memory = (self.impute2_memory_base + self.impute2_memory_per_reference_cell * reference_cells + self.impute2_memory_per_study_cell * variants * samples) / (1024.0 * 1024.0)
+			print '%-5s %11i %11i %9i %11i %7i %9i %9.1f %11.0f' % (chromosome, from_pos, to_pos, haplotypes[chromosome], variants, len(sample_chunks), samples, minutes, memory)
+
+			ret += [(chromosome, from_pos, to_pos, sample_chunks)]
+			total_jobs += len(sample_chunks)
+			total_minutes += minutes * len(sample_chunks)
+
+		if predicted:
+			print 'Intervals: %i Jobs: %i Predicted total run time: %.1f hours' % (len(ret), total_jobs, total_minutes / 60.0)
+		else:
+			print 'Intervals: %i Jobs: %i' % (len(ret), total_jobs)
+
+		return ret
+
+	@Instrumentation.instrumented('chunk_planning', profile=True)
+	def chr_pos_planner(self, chromosomes, reference, study_positions=None, position_interval=5000000, variants_per_chunk=None, min_chunk_size=500000, max_chunk_size=5000000, buffer_size=250000):
+		'''
+		Generates the chr position intervals for the imputation jobs. In contrast to chr_pos_generator,
+		the intervals contain approximately the same number of reference variants.
+
+		study_positions: a dictionary. chromosome -> numpy array with the positions of the study variants.
+		                 Intervals without study variants are skipped. Can be None
+		variants_per_chunk: Number of reference variants per interval. If None then this is the mean number
+		                    of variants in the intervals of chr_pos_generator with the same position_interval
+		min_chunk_size, max_chunk_size: The minimum and maximum length of an interval
+		buffer_size: The buffer that impute2 uses on both sides of the interval (-buffer option).
+		             The reference variants in the buffer are part of the cost of a job.
+
+		Intervals without reference variants are skipped.
+		Returns a list of (chromosome, from, to) tuples and prints the predicted cost of each job.
+		The cost of a job is the number of reference variants in the interval plus the buffer.
+		'''
+
+		chromosome_lengths = Length_of_chromosomes_build_37()
+
+		ret = []
+		costs = []
+		print 'Adaptive chunking. Predicted cost per job (reference variants in the interval plus buffer of %i):' % buffer_size
+		print '%-5s %11s %11s %11s %11s %11s' % ('chr', 'from', 'to', 'reference', 'study', 'cost')
+		for chromosome in chromosomes:
+			positions = self.get_reference_positions(reference, chromosome)
+			if not len(positions):
+				print 'Warning: No variants in reference panel %s for chromosome %s' % (reference, chromosome)
+				continue
+
+			this_study_positions = study_positions.get(chromosome) if study_positions else None
+			last_position = positions[-1]
+			if this_study_positions is not None and len(this_study_positions):
+				last_position = max(last_position, this_study_positions.max())
+
+			this_variants_per_chunk = variants_per_chunk
+			if not this_variants_per_chunk:
+				length = chromosome_lengths.get(chromosome, last_position)
+				this_variants_per_chunk = max(1, len(positions) / ((length + position_interval - 1) / position_interval))
+
+			from_pos = 1
+			while from_pos <= last_position:
+				first_variant = numpy.searchsorted(positions, from_pos, 'left')
+				to_pos = positions[min(first_variant + this_variants_per_chunk, len(positions)) - 1] if first_variant < len(positions) else last_position
+				to_pos = min(max(to_pos, from_pos + min_chunk_size - 1), from_pos + max_chunk_size - 1)
+
+				reference_variants = numpy.searchsorted(positions, to_pos, 'right') - first_variant
+				study_variants = None
+				if this_study_positions is not None:
+					study_variants = numpy.searchsorted(this_study_positions, to_pos, 'right') - numpy.searchsorted(this_study_positions, from_pos, 'left')
+
+				if reference_variants and study_variants != 0:
+					cost = numpy.searchsorted(positions, to_pos + buffer_size, 'right') - numpy.searchsorted(positions, from_pos - buffer_size, 'left')
+					print '%-5s %11i %11i %11i %11s %11i' % (chromosome, from_pos, to_pos, reference_variants, '-' if study_variants is None else str(study_variants), cost)
+					ret += [(chromosome, int(from_pos), int(to_pos))]
+					costs += [cost]
+
+				from_pos = to_pos + 1
+
+		if costs:
+			print 'Jobs: %i  Cost min: %i mean: %.0f max: %i  (max/mean: %.2f)' % (len(costs), min(costs), numpy.mean(costs), max(costs), max(costs) / numpy.mean(costs))
+
+		return ret
+
+	@Instrumentation.instrumented('perform_liftover')
+	def perform_liftover(self, study, results, assembly='hg18ToHg19', backend='local', submit=True, return_worksheet=False, engine='liftover'):
 		'''
 		Generates and submits the liftover scripts
+		engine: 'liftover' runs the UCSC liftOver tool and plink in the liftover pipeline.
+		        'native' lifts over the study panel now, without external tools (see: native_liftover). Returns the output directory
 		'''
 
 		stem_ped = self.bfh.get_chromosome_files(os.path.join(study, '*.ped'))
@@ -1470,7 +4702,7 @@ and make sure that it was completed without errors.
 		chromosomes = stem_ped[1]
 
 		#Get the number of samples
-		n_samples = self.bfh.line_counter(os.path.join(study, os.path.splitext(stem_ped[0] % {'chromosome' : chromosomes[0]})[0] + '.ped'))
+		n_samples = self.bfh.line_counter(os.path.join(study, os.path.splitext(stem_ped[0] % {'chromosome' : chromosomes[0]})[0] + '.ped'), cache=True)
 
 		if self.assembly_chains.has_key(assembly):
 			assembly_filename = self.assembly_chains[assembly]
@@ -1478,6 +4710,11 @@ and make sure that it was completed without errors.
 			print 'Using custom assembly filename: ', str(assembly)
 			assembly_filename = assembly
 
+		if engine == 'native':
+			return self.native_liftover(study, results, stem_ped[0], chromosomes, os.path.join(self.cwd, assembly_filename))
+		elif engine != 'liftover':
+			raise Exception('Unknown liftover engine: ' + str(engine))
+
 		worksheet_data = [
 			['study'] + [self.mc.job_id for chromosome in chromosomes],
 			['studyInputDir'] + [study for chromosome in chromosomes],
@@ -1492,12 +4729,101 @@ and make sure that it was completed without errors.
 			self.mc.worksheet_generate_submit('liftover', [worksheet_data], backend, submit)
 
 
-	def perform_phase(self, study, results, studyDataType=None, additional_shapeit_parameters=' ', backend='local', submit=True, return_worksheet=False, chromosomes=None, n_samples=None):
+	@staticmethod
+	def impute2_buffer(additional_impute2_parameters):
+		'''
+		Returns the buffer (in bases) of the -buffer option (in kb) of impute2 in additional_impute2_parameters, or None if it is not set
+		'''
+
+		arguments = additional_impute2_parameters.split()
+		if '-buffer' not in arguments:
+			return None
+
+		index = arguments.index('-buffer')
+		if index + 1 == len(arguments):
+			raise Exception('Missing value of -buffer in the additional impute2 parameters: %s' % additional_impute2_parameters)
+		return int(float(arguments[index + 1]) * 1000)
+
+	@Instrumentation.instrumented('reference_slices')
+	def reference_slices(self, reference, jobs, buffer_size, results, cache_dir, cache_size=None):
+		'''
+		Builds the slices of the reference panel for the windows of the jobs (interval plus buffer) in a local cache (see: Reference_cache).
+		Slices of previous runs are reused. The slices of every chromosome are built in parallel with the native scheduler (see: Native_scheduler).
+		cache_size: The maximum size of the cache in MB. The least recently used slices of previous runs are removed
+		Returns a dictionary: (chromosome, from, to) -> (haps slice filename, legend slice filename)
+		'''
+
+		cache = Reference_cache(cache_dir, cache_size * 1024 * 1024 if cache_size else None)
+		reference_dir = os.path.join(self.reference_dir, self.reference_panels[reference]['dir'])
+
+		ret = {}
+		#chromosome -> list of (from, to, haps slice, legend slice)
+		windows = {}
+		for chromosome, from_pos, to_pos in sorted(set([job[:3] for job in jobs])):
+			haps_filename, legend_filename = [os.path.join(reference_dir, self.reference_panels[reference][x] % {'chromosome' : chromosome}) for x in ['hapsgz', 'legendgz']]
+			window = (max(1, from_pos - buffer_size), to_pos + buffer_size)
+			slice_filenames = cache.slice_filenames(chromosome, haps_filename, legend_filename, *window)
+			ret[(chromosome, from_pos, to_pos)] = slice_filenames
+			if cache.is_cached(slice_filenames):
+				cache.touch(slice_filenames)
+			else:
+				windows.setdefault(chromosome, []).append(window + slice_filenames)
+
+		print 'Reference slices: %i in the cache, %i to build' % (len(ret) - sum([len(x) for x in windows.values()]), sum([len(x) for x in windows.values()]))
+
+		status = self.mc.native_scheduler.run([{
+			'name' : 'reference_slices_chr%s' % chromosome,
+			'command' : (cache.build_slices, [os.path.join(reference_dir, self.reference_panels[reference][x] % {'chromosome' : chromosome}) for x in ['hapsgz', 'legendgz']] + [windows[chromosome]]),
+			'dependencies' : [],
+			'log' : os.path.join(results, 'reference_slices_chr%s.log' % chromosome),
+		} for chromosome in sorted(windows)]) if windows else {}
+
+		failed = [name for name, job_status in status.iteritems() if job_status != 'finished']
+		if failed:
+			raise Exception('Building reference slices failed: %s. See the reference_slices_chr<CHROMOSOME>.log files in %s' % (', '.join(sorted(failed)), results))
+
+		size = cache.evict([x for slice_filenames in ret.values() for x in slice_filenames])
+		print 'Reference cache: %.1f MB in %s' % (size / 1024.0 / 1024.0, cache_dir)
+
+		return ret
+
+	@Instrumentation.instrumented('native_liftover')
+	def native_liftover(self, study, results, ped_pattern, chromosomes, chain_filename):
+		'''
+		Lifts over the PED / MAP files of every chromosome to PLINK binary files chr<CHROMOSOME>.bed in results (see: liftover_plink).
+		The chain index is built (or loaded) once. Chromosomes are lifted over in parallel with the native scheduler (see: Native_scheduler)
+		'''
+
+		if not os.path.isfile(chain_filename):
+			raise Exception('Could not find chain file: %s' % chain_filename)
+
+		#Build the cached index before the jobs read it
+		Chain_index(chain_filename)
+
+		if not os.path.exists(results):
+			os.makedirs(results)
+
+		status = self.mc.native_scheduler.run([{
+			'name' : 'liftover_chr%s' % chromosome,
+			'command' : (liftover_plink, [os.path.join(study, ped_pattern % {'chromosome' : chromosome}), chain_filename, os.path.join(results, 'chr%s.bed' % chromosome)]),
+			'dependencies' : [],
+			'log' : os.path.join(results, 'liftover_chr%s.log' % chromosome),
+		} for chromosome in chromosomes])
+
+		failed = [name for name, job_status in status.iteritems() if job_status != 'finished']
+		if failed:
+			raise Exception('Liftover failed: %s. See the liftover_chr<CHROMOSOME>.log files in %s' % (', '.join(sorted(failed)), results))
+
+		return results
+
+	@Instrumentation.instrumented('perform_phase')
+	def perform_phase(self, study, results, studyDataType=None, additional_shapeit_parameters=' ', backend='local', submit=True, return_worksheet=False, chromosomes=None, n_samples=None, ped_to_bed=False):
 		'''
 		Generates and submits the phasing scripts
 		studyDataType can take the following values: 
 			BED : for binary plink files
 			PED : for text plink files
+		ped_to_bed: Convert a PED study panel to PLINK binary files before phasing (see: convert_study_ped_to_bed)
 		'''
 		
 		if not chromosomes:
@@ -1511,14 +4837,19 @@ and make sure that it was completed without errors.
 				extensions = ['bed', 'bim', 'fam']
 				if chromosomes:
 					studyDataType = 'BED'
-					n_samples = self.bfh.line_counter(os.path.join(study, os.path.splitext(pedmap_pattern % {'chromosome' : chromosomes[0]})[0] + '.fam'))
+					n_samples = self.bfh.line_counter(os.path.join(study, os.path.splitext(pedmap_pattern % {'chromosome' : chromosomes[0]})[0] + '.fam'), cache=True)
 
 			if not chromosomes and studyDataType != 'BED':
 				pedmap_pattern, chromosomes = self.bfh.get_chromosome_files(os.path.join(study, '*.ped'))
 				extensions = ['ped', 'map']
 				if chromosomes:
 					studyDataType = 'PED'
-					n_samples = self.bfh.line_counter(os.path.join(study, os.path.splitext(pedmap_pattern % {'chromosome' : chromosomes[0]})[0] + '.ped'))
+					n_samples = self.bfh.line_counter(os.path.join(study, os.path.splitext(pedmap_pattern % {'chromosome' : chromosomes[0]})[0] + '.ped'), cache=True)
+
+					if ped_to_bed:
+						study, pedmap_pattern = self.convert_study_ped_to_bed(study, pedmap_pattern, chromosomes, os.path.join(results, 'study_bed'))
+						studyDataType = 'BED'
+						extensions = ['bed', 'bim', 'fam']
 
 			if not chromosomes:
 				if not studyDataType:
@@ -1545,6 +4876,42 @@ and make sure that it was completed without errors.
 		else:
 			self.mc.worksheet_generate_submit('phase', [worksheet_data], backend, submit)
 
+	@Instrumentation.instrumented('ped_to_bed')
+	def convert_study_ped_to_bed(self, study, pedmap_pattern, chromosomes, bed_dir):
+		'''
+		Converts the PED / MAP files of a study panel to PLINK binary files in bed_dir (see: convert_ped_to_bed).
+		Chromosomes are converted in parallel with the native scheduler (see: Native_scheduler). Up to date conversions are skipped.
+		Returns the directory and the filename pattern of the .bed files
+		'''
+
+		bed_pattern = os.path.splitext(pedmap_pattern)[0] + '.bed'
+		if not os.path.exists(bed_dir):
+			os.makedirs(bed_dir)
+
+		jobs = []
+		for chromosome in chromosomes:
+			ped_filename = os.path.join(study, pedmap_pattern % {'chromosome' : chromosome})
+			map_filename = os.path.splitext(ped_filename)[0] + '.map'
+			bed_filename = os.path.join(bed_dir, bed_pattern % {'chromosome' : chromosome})
+			if Packed_genotypes.is_converted(ped_filename, map_filename, bed_filename):
+				print 'PLINK binary files are up to date: %s' % bed_filename
+				continue
+
+			jobs.append({
+				'name' : 'ped_to_bed_chr%s' % chromosome,
+				'command' : (convert_ped_to_bed, [ped_filename, map_filename, bed_filename]),
+				'dependencies' : [],
+				'log' : os.path.join(bed_dir, 'ped_to_bed_chr%s.log' % chromosome),
+			})
+
+		status = self.mc.native_scheduler.run(jobs) if jobs else {}
+		failed = [name for name, job_status in status.iteritems() if job_status != 'finished']
+		if failed:
+			raise Exception('Conversion of PED files failed: %s. See the ped_to_bed_chr<CHROMOSOME>.log files in %s' % (', '.join(sorted(failed)), bed_dir))
+
+		return bed_dir, bed_pattern
+
+	@Instrumentation.instrumented('perform_impute')
 	def perform_impute(self, study, results, reference, 
 		additional_impute2_parameters=' ', 
 		additional_shapeit_parameters=' ',
@@ -1556,41 +4923,81 @@ and make sure that it was completed without errors.
 		custom_chromosomes=None,
 		java_executable='java',
 		backend='local', 
-		submit=True):
+		submit=True,
+		chunking='fixed',
+		variants_per_chunk=None,
+		min_chunk_size=500000,
+		max_chunk_size=5000000,
+		buffer_size=250000,
+		target_job_minutes=None,
+		max_job_memory=None,
+		binary_dosage=None,
+		qc=None,
+		ped_to_bed=False,
+		liftover_engine='liftover',
+		regions=None,
+		reference_cache_dir=None,
+		reference_cache_size=None):
 		'''
 		Generates and submits the imputation scripts
+		chunking: 'fixed' splits the chromosomes in intervals of position_batch_size (see: chr_pos_generator)
+		          'adaptive' splits the chromosomes in intervals with the same number of reference variants (see: chr_pos_planner)
+		target_job_minutes, max_job_memory: Split the samples of each interval so that every job fits in this run time and memory (MB) (see: job_planner)
+		binary_dosage: 'probabilities' or 'dosage'. Only with the native backend, save the merged results as binary dosages (see: Binary_dosage)
+		qc: a dictionary of thresholds (see: impute2_qc_thresholds). With the native backend, perform quality control of the results (see: impute2_qc_chromosome)
+		ped_to_bed: Convert a PED study panel to PLINK binary files before phasing (see: perform_phase)
+		liftover_engine: 'native' lifts over the study panel before the other stages. The lifted panel is phased and imputed with the phase_impute pipeline (see: perform_liftover)
+		regions: a BED file. Impute only these regions. Regions closer than two buffers are merged (see: merge_regions) and the intervals are cut to the regions (see: region_intervals)
+		reference_cache_dir, reference_cache_size: Jobs read slices of the reference panel from a local cache (see: reference_slices)
+		buffer_size: The buffer of impute2 on each side of an interval. A -buffer option in additional_impute2_parameters overrides it (see: impute2_buffer).
+		             With reference_cache_dir the slices contain only this buffer, so -buffer is passed to impute2 if it is not set
 		'''
 		
-		def get_sample_chunks(n):
-			'''
-			Create a list with (from, to) pairs. For sample chunking
-			'''
-			if sample_batch_size >= n:
-				return [[1, n]]
-
-			ratio = n / (n/sample_batch_size)
-
-			ret = []
-			for r in range(1, n, ratio):
-				if n-r-ratio+1 < ratio:
-					ret += [[r, n]]
-					break
-				else:
-					ret += [[r, r+ratio-1]]
-
-			return ret
-
 		if not reference:
 			raise Exception('Invalid reference value: ' + str(reference))
 
+		if position_batch_size < 1:
+			raise Exception('Invalid position batch size: %i. It should be positive' % position_batch_size)
+		if chunking == 'adaptive':
+			if min_chunk_size < 1 or max_chunk_size < 1:
+				raise Exception('Invalid chunk sizes: min %i, max %i. They should be positive' % (min_chunk_size, max_chunk_size))
+			if min_chunk_size > max_chunk_size:
+				raise Exception('The minimum chunk size (%i) is larger than the maximum chunk size (%i)' % (min_chunk_size, max_chunk_size))
+			if variants_per_chunk is not None and variants_per_chunk < 1:
+				raise Exception('Invalid number of variants per chunk: %i. It should be positive' % variants_per_chunk)
+
 		if not self.reference_panels.has_key(reference):
 			self.list_reference_panels()
 			raise Exception('Unknown reference panel: ' + reference)
 
 		reference_dir = os.path.join(self.reference_dir, self.reference_panels[reference]['dir'] )
 
+		if binary_dosage and backend != 'native':
+			raise Exception('Binary dosages are built after the merge of the results. With backend %s merge the results with the merge action when the jobs have finished' % backend)
+
+		#Plan, merge regions and slice the reference with the buffer that impute2 actually uses
+		impute2_buffer = self.impute2_buffer(additional_impute2_parameters)
+		if impute2_buffer is not None:
+			if impute2_buffer != buffer_size:
+				print 'Using the buffer of the additional impute2 parameters: %i' % impute2_buffer
+			buffer_size = impute2_buffer
+		elif reference_cache_dir:
+			additional_impute2_parameters = ('%s -buffer %i' % (additional_impute2_parameters.strip(), buffer_size / 1000)).strip()
+
 		phase_worksheet_data = []
 		liftover_worksheet_data = []
+		#The complete worksheets of the liftover and phase stages. For the native backend
+		phase_stage_worksheet_data = []
+		liftover_stage_worksheet_data = []
+		#The files of the study panel for the study index. chromosome -> (positions filename, column, samples filename, samples type) (see: get_study_index)
+		study_files = {}
+		#The positions of the study variants are not known before liftover
+		study_positions_known = True
+		if perform_liftover_argument and liftover_engine == 'native':
+			study = self.perform_liftover(study, os.path.join(results, 'results_liftover'), assembly=assembly, engine='native')
+			perform_liftover_argument = False
+			perform_phase_argument = True
+
 		if perform_liftover_argument:
 			#The name of the pipeline
 			pipeline_name = 'liftover_phase_impute'
@@ -1605,6 +5012,10 @@ and make sure that it was completed without errors.
 				submit=False, 
 				return_worksheet=True)
 
+			liftover_stage_worksheet_data = liftover_worksheet_data
+			stem_ped = self.bfh.get_chromosome_files(os.path.join(study, '*.ped'))[0]
+			study_files = {chromosome : (os.path.join(study, os.path.splitext(stem_ped % {'chromosome' : chromosome})[0] + '.map'), 3, os.path.join(study, stem_ped % {'chromosome' : chromosome}), 'lines') for chromosome in chromosomes}
+			study_positions_known = False
 			liftover_worksheet_data = [x for x in liftover_worksheet_data if x[0] in ['study', 'studyInputDir', 'liftOverChainFile', 'LiftoverOutputFolder']]
 
 			#This is the output of phase and the input of imputation
@@ -1621,6 +5032,7 @@ and make sure that it was completed without errors.
 				chromosomes=chromosomes, #Do not check for input files
 				n_samples=n_samples)
 
+			phase_stage_worksheet_data = phase_worksheet_data
 			phase_worksheet_data = [x for x in phase_worksheet_data if x[0] in ['PhaseOutputFolder','additonalShapeitParam','studyData','studyDataType']]
 
 		elif perform_phase_argument:
@@ -1637,8 +5049,15 @@ and make sure that it was completed without errors.
 				additional_shapeit_parameters=additional_shapeit_parameters,
 				backend=backend,
 				submit=False,
-				return_worksheet=True)
+				return_worksheet=True,
+				ped_to_bed=ped_to_bed)
 
+			#Phasing does not change the positions of the study. studyData is: bed bim fam or ped map
+			for chromosome, study_data in zip(chromosomes, [x for x in phase_worksheet_data if x[0] == 'studyData'][0][1:]):
+				study_data = study_data.split()
+				study_files[chromosome] = (study_data[1], 3, study_data[2] if len(study_data) == 3 else study_data[0], 'lines')
+
+			phase_stage_worksheet_data = phase_worksheet_data
 			phase_worksheet_data = [x for x in phase_worksheet_data if x[0] in ['PhaseOutputFolder','additonalShapeitParam','studyData','studyDataType']]		
 
 		else:
@@ -1651,9 +5070,7 @@ and make sure that it was completed without errors.
 			if not chromosomes:
 				raise Exception('Could not find any files named chr<1-22>.haps in %s' % study)
 
-			#Get number of samples
-			with open(os.path.join(study, haps_pattern % {'chromosome': str(chromosomes[0])})) as haps_pattern_f:
-				n_samples = (len(haps_pattern_f.readline().split())-5)/2
+			study_files = {chromosome : (os.path.join(study, haps_pattern % {'chromosome': chromosome}), 2, os.path.join(study, haps_pattern % {'chromosome': chromosome}), 'haps') for chromosome in chromosomes}
 
 	
 		#Check for custom chromosomes
@@ -1664,10 +5081,54 @@ and make sure that it was completed without errors.
 					raise Exception('Cannot locate reference panel for requested chromosome: %s' % (str(custom_chromosome)))
 			chromosomes = custom_chromosomes
 
-		sample_chunks = get_sample_chunks(n_samples)
-		sample_chunks_n = len(sample_chunks)
-
-		positions = [position for position in self.chr_pos_generator(chromosomes, position_interval=position_batch_size)]
+		#Regions closer than two buffers are merged. A single job costs less than their overlapping buffers
+		target_regions = None
+		if regions:
+			target_regions = self.merge_regions(self.bfh.region_reader(regions), 2 * buffer_size)
+			other_chromosomes = sorted(set(target_regions) - set(chromosomes))
+			if other_chromosomes:
+				print 'Warning: Skipping the regions of chromosomes that are not imputed: %s' % ', '.join(other_chromosomes)
+			chromosomes = [chromosome for chromosome in chromosomes if target_regions.has_key(chromosome)]
+			if not chromosomes:
+				raise Exception('None of the regions in %s is in the imputed chromosomes' % regions)
+			print 'Regions: %i (after merging), %i bases in %i chromosomes' % (sum([len(target_regions[x]) for x in chromosomes]), sum([to_pos - from_pos + 1 for x in chromosomes for from_pos, to_pos in target_regions[x]]), len(chromosomes))
+
+		#Index the study panel. This also checks that all chromosomes have the same samples
+		study_index = self.get_study_index(study, {chromosome : study_files[chromosome] for chromosome in chromosomes})
+		n_samples = study_index[chromosomes[0]]['samples']
+		study_positions = {chromosome : study_index[chromosome]['positions'] for chromosome in chromosomes} if study_positions_known else None
+
+		if chunking == 'fixed':
+			positions = [position for position in self.chr_pos_generator(chromosomes, position_interval=position_batch_size)]
+		elif chunking == 'adaptive':
+			positions = self.chr_pos_planner(chromosomes, reference, 
+				study_positions=study_positions, 
+				position_interval=position_batch_size, 
+				variants_per_chunk=variants_per_chunk, 
+				min_chunk_size=min_chunk_size, 
+				max_chunk_size=max_chunk_size, 
+				buffer_size=buffer_size)
+		else:
+			raise Exception('Unknown value for parameter chunking: ' + str(chunking))
+
+		if target_regions:
+			positions = self.region_intervals(positions, target_regions)
+			print 'Intervals in the regions: %i' % len(positions)
+
+		if study_positions and chunking == 'adaptive':
+			#Skip the intervals without study variants. Intervals that are cut to regions can be short, 
+			#so the study variants in the buffer of impute2 around them are also counted
+			margin = buffer_size if target_regions else 0
+			with_study_variants = [p for p in positions if numpy.searchsorted(study_positions[p[0]], p[2] + margin, 'right') > numpy.searchsorted(study_positions[p[0]], p[1] - margin, 'left')]
+			if len(with_study_variants) < len(positions):
+				print 'Skipping %i intervals without study variants' % (len(positions) - len(with_study_variants))
+			positions = with_study_variants
+
+		if target_regions:
+			not_imputed = ['chr%s:%i-%i' % (chromosome, from_pos, to_pos) for chromosome in chromosomes for from_pos, to_pos in target_regions[chromosome] 
+				if not any(p[0] == chromosome and p[1] <= to_pos and p[2] >= from_pos for p in positions)]
+			if not_imputed:
+				print 'Warning: %i regions are not imputed (no reference or study variants in them or in their buffer): %s' % (len(not_imputed), ', '.join(not_imputed))
 
 		if self.reference_panels[reference].has_key('vcfgz'):
 			refType = 'VCF'
@@ -1677,26 +5138,260 @@ and make sure that it was completed without errors.
 		else:
 			raise Exception('Cannot find compatible reference panel')
 
+		#Plan the sample chunks of every interval
+		plan = self.job_planner(positions, reference, n_samples, 
+			sample_batch_size=sample_batch_size, 
+			target_job_minutes=target_job_minutes, 
+			max_job_memory=max_job_memory, 
+			buffer_size=buffer_size)
+
+		#One job per (interval, sample chunk): (chromosome, from, to, sample chunk, number of sample chunks of the interval)
+		jobs = [(chromosome, from_pos, to_pos, sample_chunk, len(sample_chunks)) for chromosome, from_pos, to_pos, sample_chunks in plan for sample_chunk in sample_chunks]
+
+		#Keep only the jobs whose inputs have changed or whose outputs are missing (see: Run_state)
+		run_state = Run_state(results)
+		parameters = [pipeline_name, refType, additional_impute2_parameters, additional_shapeit_parameters if pipeline_name != 'impute' else None, assembly if pipeline_name == 'liftover_phase_impute' else None]
+		job_states = []
+		for job in jobs:
+			key = 'chr%s:%i-%i:%i-%i' % (job[0], job[1], job[2], job[3][0], job[3][1])
+			reference_files = [os.path.join(reference_dir, self.reference_panels[reference][x] % {'chromosome' : job[0]}) for x in ['hapsgz', 'legendgz']]
+			input_hash = run_state.input_hash([
+				parameters, 
+				study_index[job[0]]['files'], 
+				[[os.path.getsize(x), os.path.getmtime(x)] for x in reference_files],
+				job[1:],
+			])
+			output = os.path.join(results, self.impute_output_pattern % {'chr' : job[0], 'fromChrPos' : job[1], 'toChrPos' : job[2], 'fromSample' : job[3][0], 'toSample' : job[3][1]})
+			job_states += [(key, input_hash, output, run_state.is_done(key, input_hash, [output]))]
+
+		done = len([x for x in job_states if x[3]])
+		if done:
+			print 'Skipping %i of %i jobs. Their inputs have not changed and they have finished with valid outputs (see: %s)' % (done, len(jobs), os.path.join(results, Run_state.filename))
+		jobs = [job for job, job_state in zip(jobs, job_states) if not job_state[3]]
+		outputs = [output for key, input_hash, output, is_done in job_states if not is_done]
+		if not jobs:
+			print 'All jobs have finished. Nothing to do'
+			run_state.close()
+			return
+		if submit:
+			run_state.submitted([(key, input_hash, [output]) for key, input_hash, output, is_done in job_states if not is_done])
+		run_state.close()
+
+		#(chromosome, from, to) -> (haps, legend) slices of the reference panel
+		reference_slices = self.reference_slices(reference, jobs, buffer_size, results, reference_cache_dir, reference_cache_size) if reference_cache_dir else None
+
 		worksheet_data = [
-			['project'] + [self.mc.job_id for p in positions for sample_chunk in sample_chunks],
-			['knownHapsG'] + [os.path.join(knownHapsG_dir, 'chr%s.haps' % p[0]) for p in positions for sample_chunk in sample_chunks],
-			['m'] + [os.path.join(self.cwd, self.genetic_map % {'chromosome' : p[0]}) for p in positions for sample_chunk in sample_chunks],
-			['h'] + [os.path.join(reference_dir, self.reference_panels[reference]['hapsgz'] % {'chromosome'  : p[0]}) for p in positions for sample_chunk in sample_chunks],
-			['l'] + [os.path.join(reference_dir, self.reference_panels[reference]['legendgz'] % {'chromosome' : p[0]}) for p in positions for sample_chunk in sample_chunks],
-			['vcf'] + [os.path.join(reference_dir, self.reference_panels[reference]['vcfgz'] % {'chromosome' : p[0]}).replace('.vcf.gz', '') for p in positions for sample_chunk in sample_chunks],
-			['refType'] + [refType for p in positions for sample_chunk in sample_chunks],
-			['additonalImpute2Param'] + [additional_impute2_parameters for p in positions for sample_chunk in sample_chunks],
-			['ImputeOutputFolder'] + [results for p in positions for sample_chunk in sample_chunks],
-			['chr'] + [p[0] for p in positions for sample_chunk in sample_chunks],
-			['fromChrPos'] + [str(p[1]) for p in positions for sample_chunk in sample_chunks],
-			['toChrPos'] + [str(p[2]) for p in positions for sample_chunk in sample_chunks],
-			['fromSample'] + [str(sample_chunk[0]) for p in positions for sample_chunk in sample_chunks],
-			['toSample'] + [str(sample_chunk[1]) for p in positions for sample_chunk in sample_chunks],
-			['samplechunksn'] + [str(sample_chunks_n) for p in positions for sample_chunk in sample_chunks],
-			['javaExecutable'] + [java_executable for p in positions for sample_chunk in sample_chunks],
+			['project'] + [self.mc.job_id for job in jobs],
+			['knownHapsG'] + [os.path.join(knownHapsG_dir, 'chr%s.haps' % job[0]) for job in jobs],
+			['m'] + [os.path.join(self.cwd, self.genetic_map % {'chromosome' : job[0]}) for job in jobs],
+			['h'] + [reference_slices[job[:3]][0] if reference_slices else os.path.join(reference_dir, self.reference_panels[reference]['hapsgz'] % {'chromosome'  : job[0]}) for job in jobs],
+			['l'] + [reference_slices[job[:3]][1] if reference_slices else os.path.join(reference_dir, self.reference_panels[reference]['legendgz'] % {'chromosome' : job[0]}) for job in jobs],
+			['vcf'] + [os.path.join(reference_dir, self.reference_panels[reference]['vcfgz'] % {'chromosome' : job[0]}).replace('.vcf.gz', '') for job in jobs],
+			['refType'] + [refType for job in jobs],
+			['additonalImpute2Param'] + [additional_impute2_parameters for job in jobs],
+			['ImputeOutputFolder'] + [results for job in jobs],
+			['chr'] + [job[0] for job in jobs],
+			['fromChrPos'] + [str(job[1]) for job in jobs],
+			['toChrPos'] + [str(job[2]) for job in jobs],
+			['fromSample'] + [str(job[3][0]) for job in jobs],
+			['toSample'] + [str(job[3][1]) for job in jobs],
+			['samplechunksn'] + [str(job[4]) for job in jobs],
+			['javaExecutable'] + [java_executable for job in jobs],
 		]
 
-		self.mc.worksheet_generate_submit(pipeline_name, [worksheet_data, phase_worksheet_data, liftover_worksheet_data], backend, submit)
+		if backend == 'native':
+			self.native_impute_submit(worksheet_data, phase_stage_worksheet_data, liftover_stage_worksheet_data, submit, binary_dosage, qc)
+		elif phase_stage_worksheet_data:
+			#Combined pipeline. Generate the scripts of every chromosome separately
+			#so that imputation of a chromosome starts as soon as it is phased
+			impute_rows = self.worksheet_rows_of_chromosome(worksheet_data)
+			phase_rows = self.worksheet_rows_of_chromosome(phase_stage_worksheet_data)
+			liftover_rows = self.worksheet_rows_of_chromosome(liftover_stage_worksheet_data)
+
+			self.mc.worksheet_generate_submit_per_chromosome(pipeline_name, [(chromosome, [
+				self.mc.worksheet_rows(worksheet_data, impute_rows[chromosome]),
+				self.mc.worksheet_rows(phase_worksheet_data, phase_rows[chromosome]),
+				self.mc.worksheet_rows(liftover_worksheet_data, liftover_rows[chromosome]) if liftover_worksheet_data else [],
+			]) for chromosome in sorted(impute_rows, key=lambda x : impute_rows[x][0])], backend, submit)
+		else:
+			self.mc.worksheet_generate_submit(pipeline_name, [worksheet_data, phase_worksheet_data, liftover_worksheet_data], backend, submit)
+
+		if backend == 'local' and submit:
+			#The local backend runs the jobs before it returns and stops at the first error
+			for output in outputs:
+				impute2_output_check(output)
+
+	def worksheet_rows_of_chromosome(self, worksheet_data):
+		'''
+		Returns chromosome -> list of row indexes of a worksheet with a 'chr' column
+		'''
+
+		ret = {}
+		if worksheet_data:
+			chr_column = [x for x in worksheet_data if x[0] == 'chr'][0]
+			for row, chromosome in enumerate(chr_column[1:]):
+				ret.setdefault(chromosome, []).append(row)
+		return ret
+
+	def native_impute_submit(self, impute_worksheet_data, phase_worksheet_data, liftover_worksheet_data, submit=True, binary_dosage=None, qc=None):
+		'''
+		Runs the stages of imputation with the native backend as a DAG:
+		liftover of chromosome C -> phase of chromosome C -> impute of every chunk of chromosome C -> merge of chromosome C
+		Every stage uses its own pipeline. Stage worksheets can be empty (for example no liftover)
+		The merge stage merges all outputs of chromosome C (see: merge_impute2_chromosome) 
+		and saves them as a binary dosage if binary_dosage is set (see: build_binary_dosage)
+		If qc is set (a dictionary of thresholds), the QC statistics of every chunk are computed as soon as it is imputed (see: impute2_qc_statistics)
+		and the quality control of chromosome C runs after the merge (see: impute2_qc_chromosome)
+		'''
+
+		liftover_rows = self.worksheet_rows_of_chromosome(liftover_worksheet_data)
+		phase_rows = self.worksheet_rows_of_chromosome(phase_worksheet_data)
+		impute_rows = self.worksheet_rows_of_chromosome(impute_worksheet_data)
+
+		results = [x for x in impute_worksheet_data if x[0] == 'ImputeOutputFolder'][0][1]
+
+		jobs = []
+		merge_jobs = []
+		#Chromosomes in the order of the impute worksheet
+		for chromosome in sorted(impute_rows, key=lambda x : impute_rows[x][0]):
+			dependencies = []
+			for stage, worksheet_data, rows in [('liftover', liftover_worksheet_data, liftover_rows), ('phase', phase_worksheet_data, phase_rows)]:
+				if not rows.has_key(chromosome):
+					continue
+				name = '%s_chr%s' % (stage, chromosome)
+				jobs += [{
+					'name' : name,
+					'pipeline' : stage,
+					'worksheet_data' : [self.mc.worksheet_row(worksheet_data, rows[chromosome][0])],
+					'dependencies' : dependencies,
+				}]
+				dependencies = [name]
+
+			for chunk_index, row in enumerate(impute_rows[chromosome]):
+				worksheet_row = self.mc.worksheet_row(impute_worksheet_data, row)
+				jobs += [{
+					'name' : 'impute_chr%s_%i' % (chromosome, chunk_index),
+					'pipeline' : 'impute',
+					'worksheet_data' : [worksheet_row],
+					'dependencies' : dependencies,
+				}]
+
+				#Fails if the job did not create its output, otherwise signals its success (see: Run_state)
+				output_filename = os.path.join(results, self.impute_output_pattern % dict((x[0], x[1]) for x in worksheet_row))
+				merge_jobs += [{
+					'name' : 'check_chr%s_%i' % (chromosome, chunk_index),
+					'command' : (impute2_output_check, [output_filename]),
+					'dependencies' : ['impute_chr%s_%i' % (chromosome, chunk_index)],
+					'log' : output_filename + '.check.log',
+				}]
+
+				if qc is not None:
+					merge_jobs += [{
+						'name' : 'qc_chr%s_%i' % (chromosome, chunk_index),
+						'command' : (impute2_qc_statistics, [output_filename, qc.get('call_threshold', impute2_qc_thresholds['call_threshold'])]),
+						'dependencies' : ['check_chr%s_%i' % (chromosome, chunk_index)],
+						'log' : output_filename + '.qc.log',
+					}]
+
+			merge_jobs += [{
+				'name' : 'merge_chr%s' % chromosome,
+				'command' : self.merge_command(results, chromosome, binary_dosage),
+				'dependencies' : ['check_chr%s_%i' % (chromosome, chunk_index) for chunk_index in range(len(impute_rows[chromosome]))],
+				'log' : os.path.join(results, 'merge_chr%s.log' % chromosome),
+			}]
+
+			if qc is not None:
+				merge_jobs += [{
+					'name' : 'qc_chr%s' % chromosome,
+					'command' : self.qc_command(results, chromosome, qc),
+					'dependencies' : ['merge_chr%s' % chromosome] + ['qc_chr%s_%i' % (chromosome, chunk_index) for chunk_index in range(len(impute_rows[chromosome]))],
+					'log' : os.path.join(results, 'qc_chr%s.log' % chromosome),
+				}]
+
+		self.mc.native_generate_submit(jobs, submit, extra_jobs=merge_jobs)
+
+	def merge_command(self, results, chromosome, binary_dosage=None):
+		'''
+		Returns the command that merges the outputs of the imputation jobs of a chromosome (see: merge_impute2_chromosome)
+		binary_dosage: if set ('probabilities' or 'dosage') the merged file is also saved as a binary dosage (see: build_binary_dosage)
+		'''
+
+		merged_filename = os.path.join(results, self.merged_output_pattern % {'chromosome' : chromosome})
+		command = [(merge_impute2_chromosome, [results, chromosome, self.impute_output_pattern, merged_filename])]
+		if binary_dosage:
+			command += [(build_binary_dosage, [merged_filename, binary_dosage])]
+
+		return command
+
+	def qc_command(self, results, chromosome, thresholds=None):
+		'''
+		Returns the command that performs quality control of the imputed variants of a chromosome (see: impute2_qc_chromosome)
+		'''
+
+		merged_filename = os.path.join(results, self.merged_output_pattern % {'chromosome' : chromosome})
+		return (impute2_qc_chromosome, [results, chromosome, self.impute_output_pattern, merged_filename, thresholds])
+
+	def output_chromosomes(self, results, custom_chromosomes=None):
+		'''
+		Returns the chromosomes that have imputation outputs in results. 
+		custom_chromosomes: comma separated chromosomes. All of them should have outputs
+		'''
+
+		chromosomes = sorted(impute2_output_finder(results, self.impute_output_pattern).keys())
+		if custom_chromosomes:
+			custom_chromosomes = custom_chromosomes.split(',')
+			for custom_chromosome in custom_chromosomes:
+				if custom_chromosome not in chromosomes:
+					raise Exception('Cannot find imputation outputs for chromosome: %s in %s' % (custom_chromosome, results))
+			chromosomes = custom_chromosomes
+
+		if not chromosomes:
+			raise Exception('Could not find any imputation output in %s' % results)
+
+		return chromosomes
+
+	@Instrumentation.instrumented('perform_merge')
+	def perform_merge(self, results, custom_chromosomes=None, binary_dosage=None):
+		'''
+		Merges the outputs of the imputation jobs in one file per chromosome (see: merged_output_pattern).
+		Chromosomes are merged in parallel with the native scheduler (see: Native_scheduler)
+		binary_dosage: if set ('probabilities' or 'dosage') the merged files are also saved as binary dosages (see: Binary_dosage)
+		'''
+
+		chromosomes = self.output_chromosomes(results, custom_chromosomes)
+
+		status = self.mc.native_scheduler.run([{
+			'name' : 'merge_chr%s' % chromosome,
+			'command' : self.merge_command(results, chromosome, binary_dosage),
+			'dependencies' : [],
+			'log' : os.path.join(results, 'merge_chr%s.log' % chromosome),
+		} for chromosome in chromosomes])
+
+		failed = [name for name, job_status in status.iteritems() if job_status != 'finished']
+		if failed:
+			raise Exception('Merge failed: %s. See the merge_chr<CHROMOSOME>.log files in %s' % (', '.join(sorted(failed)), results))
+
+	@Instrumentation.instrumented('perform_qc')
+	def perform_qc(self, results, custom_chromosomes=None, thresholds=None):
+		'''
+		Quality control of the imputed variants of every chromosome (see: impute2_qc_chromosome).
+		The filtered outputs are created from the merged files (see: perform_merge).
+		Chromosomes are processed in parallel with the native scheduler (see: Native_scheduler)
+		thresholds: a dictionary that updates the default thresholds (see: impute2_qc_thresholds)
+		'''
+
+		chromosomes = self.output_chromosomes(results, custom_chromosomes)
+
+		status = self.mc.native_scheduler.run([{
+			'name' : 'qc_chr%s' % chromosome,
+			'command' : self.qc_command(results, chromosome, thresholds),
+			'dependencies' : [],
+			'log' : os.path.join(results, 'qc_chr%s.log' % chromosome),
+		} for chromosome in chromosomes])
+
+		failed = [name for name, job_status in status.iteritems() if job_status != 'finished']
+		if failed:
+			raise Exception('Quality control failed: %s. See the qc_chr<CHROMOSOME>.log files in %s' % (', '.join(sorted(failed)), results))
 
 	def perform_action(action, reference, study, results, backend):
 		'''
@@ -22,7 +22,7 @@ if sys.version_info[0] == 2 and sys.version_info[1] >= 7:
 else:
 	raise Exception('Incompatible python version. (v. 2.7 needed)')
 
-from imputation import Imputation
+from imputation import Imputation, Instrumentation
 import argparse
 
 #Check OS version
@@ -77,18 +77,52 @@ if __name__ == '__main__':
 	parser.add_argument('--additional_shapeit_parameters', help='Extra command line arguments to pass to SHAPEIT tool', default=' ')
 	parser.add_argument('--additional_impute2_parameters', help='Extra command line arguments to pass to impute2 tool', default=' ')
 	parser.add_argument('--position_batch_size', help='Size of the chromosomal size of each imputation batch', default=5000000, type=int)
+	parser.add_argument('--chunking', help='How to split chromosomes in imputation batches. fixed: batches of --position_batch_size length. adaptive: batches with the same number of reference variants. Default: fixed', choices=['fixed', 'adaptive'], default='fixed')
+	parser.add_argument('--variants_per_chunk', help='Number of reference variants in each batch for --chunking adaptive. Default: the mean number of variants in batches of --position_batch_size length', type=int)
+	parser.add_argument('--min_chunk_size', help='Minimum chromosomal size of each batch for --chunking adaptive. Default: 500000', default=500000, type=int)
+	parser.add_argument('--max_chunk_size', help='Maximum chromosomal size of each batch for --chunking adaptive. Default: 5000000', default=5000000, type=int)
+	parser.add_argument('--buffer_size', help='Size of the buffer region that impute2 uses on each side of a batch (-buffer option, in bases). Used to predict the cost of each batch and for the slices of --reference_cache_dir. A -buffer option in --additional_impute2_parameters (in kb) overrides it. Default: 250000', default=250000, type=int)
+	parser.add_argument('--regions', help='A BED file with the regions to impute. Only the batches that touch a region are imputed, and they are cut to the regions. Regions closer than two buffers (see --buffer_size) are merged')
+	parser.add_argument('--reference_cache_dir', help='A local directory for slices of the reference panel. Every imputation job reads the slice of its batch (plus the buffer) instead of the haps and legend files of the whole chromosome')
+	parser.add_argument('--reference_cache_size', help='Maximum size (in MB) of --reference_cache_dir. The least recently used slices are removed. Default: no limit', type=int)
 	parser.add_argument('--sample_batch_size', help='Minimum number of samples in imputation batches', default=500, type=int)
+	parser.add_argument('--target_job_minutes', help='Split the samples of each imputation batch so that the predicted run time of every job is less than this (in minutes). Overrides --sample_batch_size', type=float)
+	parser.add_argument('--max_job_memory', help='Split the samples of each imputation batch so that the predicted memory of every job is less than this (in MB). Overrides --sample_batch_size', type=int)
 	parser.add_argument('--reference', help='name of the imputation reference panel')
-	parser.add_argument('--action', help='Action to do: liftover, phase, impute', choices=['liftover', 'phase', 'impute', 'phase_impute', 'liftover_phase_impute'])
+	parser.add_argument('--binary_dosage', help='Save the merged results of every chromosome also in a binary, memory mapped format. probabilities: genotype probabilities as 16-bit integers. dosage: dosages as 16-bit floats. Only with --action merge or with --backend native', choices=['probabilities', 'dosage'])
+	parser.add_argument('--qc', help='With --backend native, perform quality control of the imputed variants after the merge of every chromosome', action='store_true')
+	parser.add_argument('--qc_min_info', help='Quality control: minimum IMPUTE2 info score of a variant. Default: 0.3', type=float)
+	parser.add_argument('--qc_min_maf', help='Quality control: minimum minor allele frequency of a variant. Default: 0', type=float)
+	parser.add_argument('--qc_min_call_rate', help='Quality control: minimum fraction of samples with a called genotype. Default: 0', type=float)
+	parser.add_argument('--qc_call_threshold', help='Quality control: minimum genotype probability of a called genotype. Default: 0.9', type=float)
+	parser.add_argument('--liftover_engine', help='How to perform liftover. liftover: the UCSC liftOver tool and plink. native: in python, with an index of the chain file that is cached next to it. Default: liftover', choices=['liftover', 'native'], default='liftover')
+	parser.add_argument('--impute_output_pattern', help='The name of the output of an imputation job in the output directory, as written by the impute2 protocol of the pipeline. Fields: %%(chr)s, %%(fromChrPos)s, %%(toChrPos)s, %%(fromSample)s, %%(toSample)s. Default: chr%%(chr)s_%%(fromChrPos)s-%%(toChrPos)s_%%(fromSample)s-%%(toSample)s.impute2')
+	parser.add_argument('--ped_to_bed', help='Convert a study panel in PED / MAP format to PLINK binary files (bed, bim, fam) before phasing', action='store_true')
+	parser.add_argument('--action', help='Action to do: liftover, phase, impute, merge, qc', choices=['liftover', 'phase', 'impute', 'phase_impute', 'liftover_phase_impute', 'merge', 'qc'])
 	parser.add_argument('--add_reference', help='Add a new reference panel', action='store_true')
-	parser.add_argument('--backend', help='Execution environment. Default: local', choices=['pbs',  'grid', 'local'], default='local')
+	parser.add_argument('--backend', help='Execution environment. native: run the jobs of each chromosome as soon as their dependencies finish with a local pool of processes. Default: local', choices=['pbs',  'grid', 'local', 'native'], default='local')
+	parser.add_argument('--native_workers', help='Number of jobs that run in parallel with --backend native. Default: number of CPUs', type=int)
+	parser.add_argument('--native_max_memory', help='Maximum memory (in MB) of every process of a job with --backend native. Default: no limit', type=int)
+	parser.add_argument('--native_max_cpu_time', help='Maximum CPU time (in seconds) of every process of a job with --backend native. Default: no limit', type=int)
 	parser.add_argument('--chain_file', help='Genomic assembly for the liftover step', default='hg18ToHg19')
 	parser.add_argument('--nosubmit', help='Create scripts but don\'t submit them for execution', action='store_true')
+	parser.add_argument('--conversion_workers', help='Number of chromosomes of a reference panel that are converted in parallel. Default: 1', default=1, type=int)
+	parser.add_argument('--vcf_converter', help='Tool that converts the VCF files of new reference panels to impute2 format. native: built-in converter (not yet verified against vcftools, see benchmark.py --vcftools). vcftools: vcftools --IMPUTE. Default: vcftools', choices=['native', 'vcftools'], default='vcftools')
+	parser.add_argument('--compression_threads', help='Number of threads that compress and decompress gzip files. Default: 1', type=int)
+	parser.add_argument('--compression_level', help='Compression level (1-9) of the gzip files that are created. Default: 6', type=int, choices=range(1, 10))
+	parser.add_argument('--binary_reference', help='Build a binary, memory mapped copy of the haps and legend files of the reference panels for fast access to genomic windows', action='store_true')
+	parser.add_argument('--profile_events', help='Record the wall time, cpu time, peak memory and I/O of every stage of the run in this file (JSON lines) and print a summary at the end')
+	parser.add_argument('--cprofile_dir', help='Profile the python stages of the run with cProfile and save the .prof files in this directory')
 	parser.add_argument('--java_executable', help='java executable. Default: java .This is useful when java is not in the PATH', default='java')
 	
 	args = parser.parse_args()
 
-	imp = Imputation(installation_dir=args.installation_dir, reference_dir=args.reference_dir)
+	Instrumentation.configure(events_filename=args.profile_events, cprofile_dir=args.cprofile_dir)
+
+	imp = Imputation(installation_dir=args.installation_dir, reference_dir=args.reference_dir, conversion_workers=args.conversion_workers, build_binary_reference=args.binary_reference,
+		native_workers=args.native_workers, native_max_memory=args.native_max_memory, native_max_cpu_time=args.native_max_cpu_time,
+		vcf_converter=args.vcf_converter, compression_threads=args.compression_threads, compression_level=args.compression_level,
+		impute_output_pattern=args.impute_output_pattern)
 
 	#Check for absolute paths:
 	check_for_absolute_path('--study', args.study)
@@ -103,6 +137,8 @@ if __name__ == '__main__':
 		else:
 			args.output = args.results
 
+	qc_thresholds = dict([(x, getattr(args, 'qc_' + x)) for x in ['min_info', 'min_maf', 'min_call_rate', 'call_threshold'] if getattr(args, 'qc_' + x) is not None])
+
 	if args.dl_tools:
 		imp.install_imputation_tools()
 
@@ -115,6 +151,18 @@ if __name__ == '__main__':
 	elif args.add_reference:
 		imp.add_custom_reference_panels()
 
+	elif args.action == 'merge':
+		if not args.output:
+			raise Exception('You need to define the directory of the imputation results (parameter --output')
+
+		imp.perform_merge(args.output, custom_chromosomes=args.chromosomes, binary_dosage=args.binary_dosage)
+
+	elif args.action == 'qc':
+		if not args.output:
+			raise Exception('You need to define the directory of the imputation results (parameter --output')
+
+		imp.perform_qc(args.output, custom_chromosomes=args.chromosomes, thresholds=qc_thresholds)
+
 	elif args.action:
 		if not args.study:
 			raise Exception('You need to define a directory where the study panel is, in order to perform this action (parameter --study)')
@@ -123,10 +171,10 @@ if __name__ == '__main__':
 			raise Exception('You need to define a directory where the output results will be stored (parameter --output')
 
 		if args.action == 'liftover':
-			imp.perform_liftover(args.study, args.output, assembly=args.chain_file, backend=args.backend, submit=not args.nosubmit)
+			imp.perform_liftover(args.study, args.output, assembly=args.chain_file, backend=args.backend, submit=not args.nosubmit, engine=args.liftover_engine)
 
 		elif args.action == 'phase':
-			imp.perform_phase(args.study, args.output, additional_shapeit_parameters=args.additional_shapeit_parameters, backend=args.backend, submit=not args.nosubmit)
+			imp.perform_phase(args.study, args.output, additional_shapeit_parameters=args.additional_shapeit_parameters, backend=args.backend, submit=not args.nosubmit, ped_to_bed=args.ped_to_bed)
 
 		elif args.action == 'impute' or args.action == 'phase_impute' or args.action == 'liftover_phase_impute':
 			if not args.reference:
@@ -141,6 +189,20 @@ if __name__ == '__main__':
 					custom_chromosomes=args.chromosomes,
 					sample_batch_size=args.sample_batch_size,
 					position_batch_size=args.position_batch_size,
+					chunking=args.chunking,
+					variants_per_chunk=args.variants_per_chunk,
+					min_chunk_size=args.min_chunk_size,
+					max_chunk_size=args.max_chunk_size,
+					buffer_size=args.buffer_size,
+					target_job_minutes=args.target_job_minutes,
+					max_job_memory=args.max_job_memory,
+					binary_dosage=args.binary_dosage,
+					qc=qc_thresholds if args.qc else None,
+					ped_to_bed=args.ped_to_bed,
+					liftover_engine=args.liftover_engine,
+					regions=args.regions,
+					reference_cache_dir=args.reference_cache_dir,
+					reference_cache_size=args.reference_cache_size,
 					java_executable=args.java_executable,
 					backend=args.backend,
 					submit=not args.nosubmit)